@@ -1,8 +1,68 @@
 
 
+# functions for taking the formula ast's and generating python functions
+# from them, and also other memory management stuff
+#
+# Every formula cell becomes a function returning its value, memoized in
+# the module's values dict, and every range that is read becomes a function
+# returning a runtime.CellRange. Cells that are constants are the inputs of
+# the module, read out of its inputs dict. Operators and worksheet
+# functions are the ones in runtime.py, IF / IFERROR / IFNA become
+# conditional expressions so only the branch that is taken is evaluated.
+#
+#   program_info = ProgramInfo()
+#   ... program_info.define_const(...) for each constant
+#   code = generate_module(formulas_parsed, program_info)
+#
+# and the module has calculate(), get_value(sheet, cell) and
+# set_input(sheet, cell, value)
+
+import zlib
+
+from . import diagnostics
+from .graph import build_dependency_graph, range_side, range_rect, FORMULA, NAME
+from .parse import IRError, rebuild_ast, walk
+from .range_index import RangeIndex
+from .refs import parse_cell_ref, format_cell_ref, split_coordinate, parse_range
+from .runtime import function_key, takes_arguments, excel_serial, FUNCTIONS
+
+
+# bump when the generated code changes, so cached code is not reused
+CODEGEN_VERSION = 8
+
+GLOBAL_SCOPE = "$$$GLOBAL$$$"
+
+# how deeply a generated expression may nest before a part of it is
+# hoisted, see ExpressionGenerator. Each level is at most 3 brackets
+MAX_DEPTH = 40
+
+# runtime names for the operators
+BINARY_OPERATOR_FUNCTIONS = {
+    "+" : "add",
+    "-" : "sub",
+    "*" : "mul",
+    "/" : "div",
+    "^" : "power",
+    "&" : "concat",
+    "=" : "eq",
+    "<>" : "ne",
+    "<" : "lt",
+    "<=" : "le",
+    ">" : "gt",
+    ">=" : "ge",
+}
+
+UNARY_OPERATOR_FUNCTIONS = {
+    "-" : "neg",
+    "+" : "pos",
+    "%" : "percent",
+}
+
+# what the generated module imports from runtime.py
+RUNTIME_IMPORTS = sorted(list(BINARY_OPERATOR_FUNCTIONS.values()) + list(UNARY_OPERATOR_FUNCTIONS.values())
+                         + ["CellRange", "ExcelError", "FUNCTIONS", "condition", "error", "NA_ERROR", "NAME_ERROR", "VALUE_ERROR"])
+
 
-# functions for taking the formula ast's and generating python functions 
-# from them, and also other memory management stuff 
 
 # maintains info for supporting code generation
 class ProgramInfo:
@@ -10,44 +70,552 @@ class ProgramInfo:
     def __init__(self):
         self.formula_name_to_function_name = dict()
         self.program_constants = dict()
+        self.names = dict()  # (scope, NAME) -> function name of a defined name
+        self.ranges_used = dict()  # range function name -> (sheet, rect)
+        self.cyclic = dict()  # function name -> number of its circular reference, for the cells on one
+        self.order = []  # function names in the order to evaluate them
+        self.cells = None  # RangeIndex of the cells with something in them, made when first needed
 
     def set_func_name_for(self, sheet, name, fnc):
         self.formula_name_to_function_name[(sheet, name)] = fnc
- 
+        if sheet == GLOBAL_SCOPE or parse_cell_ref(name) is None:
+            self.names[(sheet, name.upper())] = fnc
+        self.cells = None
+
     def get_func_name_for(self, sheet, name):
         return self.formula_name_to_function_name[(sheet, name)]
 
+    # None when the cell isn't a formula
+    def find_func_name_for(self, sheet, name):
+        return self.formula_name_to_function_name.get((sheet, name))
+
     def get_const(self, sheet, name):
         return self.program_constants[(sheet, name)]
-    
+
+    # dates and times are kept as Excel's serial numbers, the generated
+    # code can only have plain values in it
     def define_const(self, sheet, name, value):
-        self.program_constants[(sheet, name)] = value 
+        self.program_constants[(sheet, name)] = excel_serial(value)
+        self.cells = None
+
+    # function names for a parsed formula, every cell of a shared formula
+    # gets one
+    def define_formula(self, formula_obj):
+        sheet = formula_obj["sheet"]
+        for cell in formula_cells(formula_obj):
+            self.set_func_name_for(sheet, cell, function_name(formula_obj, cell))
+
+    # a defined name the way Excel looks it up, in the sheet first
+    def resolve_name(self, scope, name):
+        fnc = self.names.get((scope, name.upper()))
+        if fnc is None and scope != GLOBAL_SCOPE:
+            fnc = self.names.get((GLOBAL_SCOPE, name.upper()))
+        return fnc
+
+    # (row, col, cell) of the cells in a rectangle that have something in
+    # them, row major
+    def cells_in(self, sheet, c1, r1, c2, r2):
+        if self.cells is None:
+            self.cells = RangeIndex()
+            for key in self.program_constants:
+                self.add_cell_to_index(key)
+            for key in self.formula_name_to_function_name:
+                self.add_cell_to_index(key)
+        found = self.cells.points_in(sheet, c1, r1, c2, r2)
+        found.sort()
+        return found
+
+    def add_cell_to_index(self, key):
+        parsed = parse_cell_ref(key[1]) if key[0] != GLOBAL_SCOPE else None
+        if parsed is not None:
+            self.cells.add_point(key[0], parsed[0], parsed[1], (parsed[1], parsed[0], key[1]))
+
+    # the function for a range, the same name for the same rectangle
+    def use_range(self, sheet, rect):
+        name = range_function_name(sheet, rect)
+        self.ranges_used[name] = (sheet, rect)
+        return name
+
+    # what the code of formulas depends on besides their own text, for
+    # what they look up (see formula_reads): the function name each cell
+    # or name has, None for a constant or empty cell, and its circular
+    # reference. Caches of generated code are keyed on this
+    def lookups(self, reads):
+        found = []
+        for kind, sheet, name in reads:
+            if kind == "name":
+                fnc = self.resolve_name(sheet, name)
+            else:
+                fnc = self.find_func_name_for(sheet, name)
+            found.append((fnc, self.cyclic.get(fnc)))
+        return found
+
+
+
+# the cells a formula is for, the master cell first for a shared formula
+def formula_cells(formula_obj):
+    ref = formula_obj.get("ref")
+    if ref is None:
+        return [formula_obj["name"]]
+    mcol, mrow = split_coordinate(formula_obj["name"])
+    cells = [formula_obj["name"]]
+    c1, r1, c2, r2 = parse_range(ref)
+    for row in range(r1, r2 + 1):
+        for col in range(c1, c2 + 1):
+            if row != mrow or col != mcol:
+                cells.append(format_cell_ref(col, row))
+    return cells
+
+
+
+def function_name(formula_obj, cell):
+    if cell == formula_obj["name"]:
+        return "formula_" + str(formula_obj["formula_id"])
+    return "formula_" + str(formula_obj["formula_id"]) + "_" + cell
+
+
+
+def range_function_name(sheet, rect):
+    c1, r1, c2, r2 = rect
+    sheet_tag = "%08x" % zlib.crc32(sheet.encode("utf-8"))
+    return "range_" + sheet_tag + "_" + format_cell_ref(c1, r1) + "_" + format_cell_ref(c2, r2)
+
+
+
+# python source for a value
+def literal(v):
+    if isinstance(v, float) and (v != v or v in (float("inf"), float("-inf"))):
+        return "float(" + repr(repr(v)) + ")"
+    return repr(v)
+
+
+
+# turns one formula AST into a python expression. temps are the names for
+# the walrus assignments of IF / IFERROR, numbered within a function.
+# func_name is the function the expression is for, a cell or name on the
+# same circular reference as it reads 0 instead of calling back into it.
+# Reading cells, names and ranges goes through cell_reference,
+# name_reference and range_reference so other code generators (see
+# straight_line.py) can read them some other way.
+#
+# The AST is gone through bottom up with parse.rebuild_ast, so a long
+# chain (=A1+A2+...+A1000) doesn't recurse, and a part that nests calls
+# and brackets MAX_DEPTH deep goes through hoist, which gives back
+# something short to use instead. Python can't compile code that nests
+# more than 200 brackets. Here a part becomes a function of its own in
+# parts, put in the module in front of the formula's function, so IF
+# branches are still only worked out when taken
+class ExpressionGenerator:
+
+    def __init__(self, program_info, drow=0, dcol=0, func_name=None):
+        self.program_info = program_info
+        self.drow = drow  # how far a cell of a shared formula is from the master
+        self.dcol = dcol
+        self.func_name = func_name
+        self.cycle = program_info.cyclic.get(func_name)
+        self.ntemps = 0
+        self.nparts = 0
+        self.parts = []  # source lines of the functions hoist made
+
+    def new_temp(self):
+        self.ntemps = self.ntemps + 1
+        return "_t" + str(self.ntemps)
+
+
+    def expression(self, node):
+        return rebuild_ast(node, self.node_expression)[0]
+
+
+    # (expression, depth) for node from the ones of its children
+    def node_expression(self, node, children):
+        t = node.nodetype()
+        if t == "variable":
+            return self.variable(node), 1
+        elif t == "constant":
+            return self.constant(node), 1
+        elif t == "variablerange":
+            return self.variable_range(node), 1
+
+        depth = 0
+        codes = []
+        for code, d in children:
+            codes.append(code)
+            if d > depth:
+                depth = d
+        if t == "unary":
+            code = self.unary(node, codes[0])
+        elif t == "binary":
+            code = self.binary(node, codes[0], codes[1])
+        elif t == "function":
+            code = self.function(node, codes)
+        else:
+            raise Exception("dont have the code to generate the type " + str(t))
+
+        if depth + 1 >= MAX_DEPTH:
+            return self.hoist(code, node), 1
+        return code, depth + 1
+
+
+    def hoist(self, code, node=None):
+        self.nparts = self.nparts + 1
+        name = str(self.func_name) + "_part" + str(self.nparts)
+        self.parts.extend(["def " + name + "():", "    return " + code, "", ""])
+        return name + "()"
+
+
+    def constant(self, node):
+        if isinstance(node, IRError):
+            return "error(" + repr(node.get_value()) + ")"
+        return literal(node.get_value())
+
+
+    # a cell (moved for shared formula cells) or a defined name
+    def variable(self, node):
+        sheet = node.get_sheet_scope()
+        parsed = parse_cell_ref(node.get_varname())
+        if parsed is None:
+            fnc = self.program_info.resolve_name(sheet, node.get_varname())
+            if fnc is None:
+                diagnostics.warning("undefined name " + str(node.get_varname()) + " in " + str(sheet))
+                return "NAME_ERROR"
+            if self.on_cycle(fnc):
+                return "0"
+            return self.name_reference(fnc)
+        col, row, col_abs, row_abs = parsed
+        if not col_abs:
+            col = col + self.dcol
+        if not row_abs:
+            row = row + self.drow
+        if parse_cell_ref(format_cell_ref(col, row)) is None:
+            return "error('#REF!')"
+        cell = format_cell_ref(col, row)
+        if self.on_cycle(self.program_info.find_func_name_for(sheet, cell)):
+            return "0"
+        return self.cell_reference(sheet, cell)
+
+
+    def on_cycle(self, fnc):
+        return self.cycle is not None and self.program_info.cyclic.get(fnc) == self.cycle
+
+    def cell_reference(self, sheet, cell):
+        return cell_value(self.program_info, sheet, cell)
+
+    def name_reference(self, fnc):
+        return fnc + "()"
+
+    def range_reference(self, sheet, rect):
+        return self.program_info.use_range(sheet, rect) + "()"
+
+
+    def variable_range(self, node):
+        sheet = node.get_sheet_scope()
+        first = range_side(node.get_varname1())
+        last = range_side(node.get_varname2())
+        if first is None or last is None:
+            diagnostics.warning("unsupported range " + str(node))
+            return "VALUE_ERROR"
+        rect = range_rect(first[0], first[1], last[0], last[1], (first[2], first[3], last[2], last[3]), self.drow, self.dcol)
+        if rect is None:
+            return "error('#REF!')"
+        return self.range_reference(sheet, rect)
+
+
+    # the operator and function parts get the expressions of the children
+    def unary(self, node, inner):
+        op = node.get_operator()
+        if op == "-" and node.get_node().nodetype() == "constant" and type(node.get_node().get_value()) in (int, float):
+            return "(" + literal(-node.get_node().get_value()) + ")"
+        if op not in UNARY_OPERATOR_FUNCTIONS:
+            raise Exception("dont know the unary operator " + str(op))
+        return UNARY_OPERATOR_FUNCTIONS[op] + "(" + inner + ")"
+
+
+    def binary(self, node, left, right):
+        op = node.get_operator()
+        if op not in BINARY_OPERATOR_FUNCTIONS:
+            raise Exception("dont know the binary operator " + str(op))
+        return BINARY_OPERATOR_FUNCTIONS[op] + "(" + left + ", " + right + ")"
+
+
+    def function(self, node, params):
+        name = function_key(node.get_func_name())
+
+        if name == "IF" and 1 <= len(params) <= 3:
+            t = self.new_temp()
+            if_true = params[1] if len(params) > 1 else "True"
+            if_false = params[2] if len(params) > 2 else "False"
+            return ("(" + if_true + " if (" + t + " := condition(" + params[0] + ")) is True else ("
+                    + if_false + " if " + t + " is False else " + t + "))")
+
+        if name == "IFERROR" and len(params) == 2:
+            t = self.new_temp()
+            return "(" + params[1] + " if type(" + t + " := " + params[0] + ") is ExcelError else " + t + ")"
+
+        if name == "IFNA" and len(params) == 2:
+            t = self.new_temp()
+            return "(" + params[1] + " if (" + t + " := " + params[0] + ") == NA_ERROR else " + t + ")"
+
+        if name is None:
+            diagnostics.warning("unsupported function " + str(node.get_func_name()))
+            return "NAME_ERROR"
+        if not takes_arguments(name, len(params)):
+            diagnostics.warning(str(node.get_func_name()) + " can't take " + str(len(params)) + " arguments")
+            return "VALUE_ERROR"
+
+        return function_variable(name) + "(" + ", ".join(params) + ")"
+
+
+
+# the variable the generated module keeps a worksheet function in
+def function_variable(name):
+    return "fn_" + name.lower().replace(".", "_")
+
+
+
+# reading a cell: its function when it's a formula, otherwise out of the
+# inputs (None when it's empty)
+def cell_value(program_info, sheet, cell):
+    fnc = program_info.find_func_name_for(sheet, cell)
+    if fnc is not None:
+        return fnc + "()"
+    return "inputs.get(" + repr((sheet, cell)) + ")"
+
+
+
+# memoized function body: the value is worked out the first time and kept
+# in values until calculate() or set_input() clears it. A cell on a
+# circular reference is set to 0 first, in case it reads itself through a
+# range
+def memoized_function(func_name, comment_lines, expression, cyclic=False):
+    lines = ["def " + func_name + "():"]
+    for line in comment_lines:
+        lines.append("    # " + line)
+    lines.append("    v = values.get(" + repr(func_name) + ", missing)")
+    lines.append("    if v is missing:")
+    if cyclic:
+        lines.append("        values[" + repr(func_name) + "] = 0  # circular reference")
+    lines.append("        v = values[" + repr(func_name) + "] = " + expression)
+    lines.append("    return v")
+    lines.append("")
+    lines.append("")
+    return lines
 
 
 
 def formula_to_python_function(formula_obj, program_info):
-    
+
     formula_id = formula_obj["formula_id"]
     sheet = formula_obj["sheet"]
     name = formula_obj["name"]
     formula_txt = formula_obj["formula"]
     nodes = formula_obj["parsed"]
-    python_function_name = program_info.get_func_name_for(sheet, name)
-
-    # analyze the variables that are involved in the nodes and generate a parameter list 
-    param_list = []
+    ref = formula_obj.get("ref")  # shared formula range, None for a single cell
 
     func_lines = []
     func_lines.append("# formula " + str(formula_id))
     func_lines.append("# sheet = " + str(sheet))
     func_lines.append("# name = " + str(name))
+    if ref is not None:
+        func_lines.append("# shared over = " + str(ref))
     func_lines.append("# Excel formula:")
-    func_lines.append("# " + str(formula_txt))
-    func_lines.append("def " + str(python_function_name) + "(" + ",".join(param_list) + ")")
-    func_lines.append("    pass")
-    func_lines.append("")
-    func_lines.append("")
+    func_lines.append("# " + str(formula_txt).replace("\n", " "))
+
+    if ref is None or parse_cell_ref(name) is None:
+        cells = [name]
+        mcol, mrow = None, None
+    else:
+        cells = formula_cells(formula_obj)
+        mcol, mrow = split_coordinate(name)
+
+    for cell in cells:
+        python_function_name = program_info.get_func_name_for(sheet, cell)
+        if nodes is None:
+            expression = "None"  # didn't parse
+        else:
+            if mcol is None:
+                generator = ExpressionGenerator(program_info, func_name=python_function_name)
+            else:
+                col, row = split_coordinate(cell)
+                generator = ExpressionGenerator(program_info, row - mrow, col - mcol, python_function_name)
+            expression = generator.expression(nodes)
+            func_lines.extend(generator.parts)
+        comment = [str(sheet) + "!" + str(cell)]
+        func_lines.extend(memoized_function(python_function_name, comment, expression, cyclic=python_function_name in program_info.cyclic))
+
+    return "\n".join(func_lines)
+
+
+
+# what the code of a formula looks up in the ProgramInfo, a list of
+# ("cell", sheet, cell or name) for the cells it is for and the cells it
+# reads, moved for each cell of a shared formula like
+# ExpressionGenerator.variable does, and ("name", scope, NAME) for the
+# defined names it reads. Not the ranges, their functions are generated
+# with the module
+def formula_reads(formula_obj):
+    sheet = formula_obj["sheet"]
+    name = formula_obj["name"]
+    nodes = formula_obj["parsed"]
+
+    if formula_obj.get("ref") is None or parse_cell_ref(name) is None:
+        cells = [name]
+        mcol, mrow = None, None
+    else:
+        cells = formula_cells(formula_obj)
+        mcol, mrow = split_coordinate(name)
+    reads = [("cell", sheet, cell) for cell in cells]
+    if nodes is None:
+        return reads
+
+    names = set()
+    refs = []  # (sheet, col, row, col_abs, row_abs)
+    for node in walk(nodes):
+        if node.nodetype() == "variable":
+            parsed = parse_cell_ref(node.get_varname())
+            if parsed is None:
+                names.add(("name", node.get_sheet_scope(), node.get_varname().upper()))
+            else:
+                refs.append((node.get_sheet_scope(),) + tuple(parsed))
+
+    moved = set()
+    for cell in cells:
+        drow, dcol = 0, 0
+        if mcol is not None:
+            col, row = split_coordinate(cell)
+            drow, dcol = row - mrow, col - mcol
+        for ref_sheet, col, row, col_abs, row_abs in refs:
+            if not col_abs:
+                col = col + dcol
+            if not row_abs:
+                row = row + drow
+            ref = format_cell_ref(col, row)
+            if parse_cell_ref(ref) is not None:
+                moved.add(("cell", ref_sheet, ref))
+    return reads + sorted(names) + sorted(moved)
+
+
+
+# the CellRange functions for every range the formulas read
+def range_functions_source(program_info):
+    lines = []
+    for func_name in sorted(program_info.ranges_used):
+        sheet, rect = program_info.ranges_used[func_name]
+        c1, r1, c2, r2 = rect
+        items = []
+        for row, col, cell in program_info.cells_in(sheet, c1, r1, c2, r2):
+            items.append("(" + str(row - r1) + ", " + str(col - c1) + ", " + cell_value(program_info, sheet, cell) + ")")
+        expression = "CellRange(" + str(r2 - r1 + 1) + ", " + str(c2 - c1 + 1) + ", [" + ", ".join(items) + "])"
+        comment = [str(sheet) + "!" + format_cell_ref(c1, r1) + ":" + format_cell_ref(c2, r2)]
+        lines.extend(memoized_function(func_name, comment, expression))
+    return "\n".join(lines)
+
+
+
+# registers the formulas and works out the evaluation order and the
+# circular references from the dependency graph. Call before generating
+# the code of the formulas
+def prepare_program(formulas_parsed, program_info, graph=None):
+    for formula_obj in formulas_parsed:
+        program_info.define_formula(formula_obj)
+
+    if graph is None:
+        graph = build_dependency_graph(formulas_parsed, program_info)
+
+    program_info.cyclic = dict()
+    for i, cycle in enumerate(graph.find_cycles()):
+        for node in cycle:
+            kind = graph.get_kind(node)
+            if kind == FORMULA or kind == NAME:
+                program_info.cyclic[program_info.get_func_name_for(*graph.get_key(node))] = i
+
+    program_info.order = []
+    for component in graph.strongly_connected_components():
+        for node in component:
+            kind = graph.get_kind(node)
+            if kind == FORMULA or kind == NAME:
+                program_info.order.append(program_info.get_func_name_for(*graph.get_key(node)))
+
+    return graph
+
+
+
+# the whole module around the formula functions from formula_to_python_function
+def module_source(program_info, functions_code):
+
+    package = __name__.rsplit(".", 1)[0]
+    lines = []
+    lines.append("")
+    lines.append("# generated from an Excel workbook, see ast_to_python.py. calculate() works out")
+    lines.append("# every formula, set_input(sheet, cell, value) changes a constant cell")
+    lines.append("")
+    lines.append("from " + package + ".runtime import " + ", ".join(RUNTIME_IMPORTS))
+    lines.append("")
+    lines.append("missing = object()")
+    lines.append("values = dict()")
+    lines.append("")
+
+    for name in function_names_in(functions_code):
+        lines.append(function_variable(name) + " = FUNCTIONS[" + repr(name) + "]")
+    lines.append("")
+
+    lines.append("inputs = {")
+    for key in program_info.program_constants:
+        lines.append("    " + repr(key) + " : " + literal(program_info.program_constants[key]) + ",")
+    lines.append("}")
+    lines.append("")
+    lines.append("")
+
+    lines.append(functions_code)
+    lines.append(range_functions_source(program_info))
+
+    lines.append("FORMULAS = {")
+    for key in program_info.formula_name_to_function_name:
+        lines.append("    " + repr(key) + " : " + program_info.formula_name_to_function_name[key] + ",")
+    lines.append("}")
+    lines.append("")
+    lines.append("ORDER = [")
+    for func_name in program_info.order:
+        lines.append("    " + func_name + ",")
+    lines.append("]")
+    lines.append("")
+    lines.append("")
+    lines.append("def set_input(sheet, cell, value):")
+    lines.append("    inputs[(sheet, cell)] = value")
+    lines.append("    values.clear()")
+    lines.append("")
+    lines.append("")
+    lines.append("def get_value(sheet, cell):")
+    lines.append("    fnc = FORMULAS.get((sheet, cell))")
+    lines.append("    if fnc is None:")
+    lines.append("        return inputs.get((sheet, cell))")
+    lines.append("    return fnc()")
+    lines.append("")
+    lines.append("")
+    lines.append("# every formula's value, by (sheet, cell or name). Going in ORDER means")
+    lines.append("# what a formula reads is already worked out, so nothing recurses deeply")
+    lines.append("def calculate():")
+    lines.append("    values.clear()")
+    lines.append("    for fnc in ORDER:")
+    lines.append("        fnc()")
+    lines.append("    return dict((key, FORMULAS[key]()) for key in FORMULAS)")
+    lines.append("")
+
+    return "\n".join(lines)
+
+
+
+# the worksheet functions the generated code calls, found by their fn_
+# variable names so code that came out of a cache counts too
+def function_names_in(code):
+    return [name for name in sorted(FUNCTIONS) if function_variable(name) + "(" in code]
+
 
-    return "\n".join(func_lines)    
-    
 
+# formulas to the source of a module that can calculate them
+def generate_module(formulas_parsed, program_info, graph=None):
+    prepare_program(formulas_parsed, program_info, graph)
+    parts = []
+    for formula_obj in formulas_parsed:
+        parts.append(formula_to_python_function(formula_obj, program_info))
+        parts.append("\n")
+    return module_source(program_info, "".join(parts))
@@ -0,0 +1,330 @@
+
+# the part of a workbook that some output cells depend on (their backward
+# dependency cone), worked out from the formula text before anything is
+# parsed. A big workbook often has a few cells anyone wants out of it, and
+# the formulas outside their cone don't need to be parsed, optimized or
+# generated at all.
+#
+#   with IntermediateFile(formulas_bin) as rows:
+#       cone = FormulaCone(rows, [("Sheet1", "C10"), (GLOBAL_SCOPE, "total")])
+#   formulas_parsed = parse.parse_formula_rows(cone.get_rows())
+#   ... and define_const only the constants where cone.has_constant(sheet, name)
+#
+# References are picked out of the lexer.tokenize tokens the same way
+# parse.parse_reference joins them, so a formula reads the same cells here
+# as in the dependency graph. Of a shared formula only the rectangle of
+# the cells that are needed is kept, moved so its top left cell is the
+# master when that's not the old master.
+
+from bisect import bisect_left, bisect_right
+
+from .graph import GLOBAL_SCOPE, range_side, range_rect
+from .lexer import tokenize
+from .range_index import RangeIndex
+from .refs import parse_cell_ref, format_cell_ref, split_coordinate, parse_range, shift_formula, COLUMN_OR_ROW_RE, MAX_COL, MAX_ROW
+
+
+
+# the references in the text of a formula, the same tuples as
+# graph.formula_references gives for its AST:
+#   ("cell", sheet, col, row, col_abs, row_abs)
+#   ("range", sheet, col1, row1, col2, row2, (abs flags))
+#   ("name", sheet, name)
+def text_references(formula, in_sheet):
+    try:
+        tokens = tokenize(formula)
+    except Exception:
+        return []  # it won't parse either, and parsing reports it
+
+    found = []
+    n = len(tokens)
+    i = 0
+    while i < n:
+        token = tokens[i]
+        sheet = in_sheet
+        if token.type == "SHEET":
+            sheet = token.value
+            i = i + 1
+            if i >= n:
+                break
+            token = tokens[i]
+
+        if token.type == "RANGE":
+            first, last = token.value.split(":")
+            add_range_reference(found, sheet, first, last)
+        elif token.type == "CELLNAME" or (token.type == "NAME" and not (i + 1 < n and tokens[i + 1].type == "LPAREN")):
+            end = i + 2
+            if end < n and tokens[i + 1].type == "COLON":
+                if tokens[end].type == "SHEET" and tokens[end].value == sheet:
+                    end = end + 1
+                if end < n and (tokens[end].type == "CELLNAME" or tokens[end].type == "NAME"):
+                    add_range_reference(found, sheet, token.value, tokens[end].value)
+                    i = end + 1
+                    continue
+            add_reference(found, sheet, token.value)
+        i = i + 1
+    return found
+
+
+def add_reference(found, sheet, ref):
+    parsed = parse_cell_ref(ref)
+    if parsed is not None:
+        found.append(("cell", sheet) + parsed)
+    else:
+        found.append(("name", sheet, ref))
+
+
+def add_range_reference(found, sheet, ref1, ref2):
+    first = range_side(ref1)
+    last = range_side(ref2)
+    if first is None or last is None:
+        # something like name1:name2, read both
+        for side in (ref1, ref2):
+            if parse_cell_ref(side) is not None or COLUMN_OR_ROW_RE.match(side) is None:
+                add_reference(found, sheet, side)
+        return
+    found.append(("range", sheet, first[0], first[1], last[0], last[1], (first[2], first[3], last[2], last[3])))
+
+
+
+# (col, row) of the master cell and the rectangle of a shared formula
+# row, None for a single cell or a name
+def shared_rect(row):
+    ref = row.get("ref")
+    if ref is None or row["sheet"] == GLOBAL_SCOPE or parse_cell_ref(row["cell_or_name"]) is None:
+        return None
+    mcol, mrow = split_coordinate(row["cell_or_name"])
+    return (mcol, mrow), parse_range(ref)
+
+
+
+# a shared formula row for just the rectangle of its cells that is
+# needed, with the top left cell the master (and the formula moved there)
+def narrow_shared_row(row, rect):
+    c1, r1, c2, r2 = rect
+    mcol, mrow = split_coordinate(row["cell_or_name"])
+    formula = row["formula"]
+    if c1 != mcol or r1 != mrow:
+        formula = shift_formula(formula, r1 - mrow, c1 - mcol)
+    ref = None
+    if c1 != c2 or r1 != r2:
+        ref = format_cell_ref(c1, r1) + ":" + format_cell_ref(c2, r2)
+    return dict(row, cell_or_name=format_cell_ref(c1, r1), formula=formula, ref=ref)
+
+
+
+class FormulaCone:
+
+    # rows are formula rows (formula_id, sheet, cell_or_name, formula,
+    # ref) like an IntermediateFile or parse_formulas_csv reads, outputs
+    # are (sheet, cell) or (sheet or GLOBAL_SCOPE, defined name)
+    def __init__(self, rows, outputs):
+        self.rows = list(rows)
+        self.cells = dict()  # (sheet, cell) -> index of its row, for the single cell formulas
+        self.names = dict()  # (scope, NAME) -> index of its row
+        self.shared = dict()  # index of a shared formula row -> ((master col, row), rect)
+        self.shared_columns = dict()  # (sheet, col) -> sorted (r1, r2, index) of the shared formulas in the column
+        self.formula_index = RangeIndex()  # (index, col, row) of the single cell formulas, to find the ones in a range
+        for k, row in enumerate(self.rows):
+            sheet = row["sheet"]
+            name = row["cell_or_name"]
+            if sheet == GLOBAL_SCOPE or parse_cell_ref(name) is None:
+                self.names[(sheet, name.upper())] = k
+                continue
+            shared = shared_rect(row)
+            if shared is None:
+                col, rw = split_coordinate(name)
+                self.cells[(sheet, format_cell_ref(col, rw))] = k
+                self.formula_index.add_point(sheet, col, rw, (k, col, rw))
+                continue
+            self.shared[k] = shared
+            c1, r1, c2, r2 = shared[1]
+            for col in range(c1, c2 + 1):
+                self.shared_columns.setdefault((sheet, col), []).append((r1, r2, k))
+
+        self.sheet_columns = dict()  # sheet -> sorted columns that have shared formulas
+        for sheet, col in self.shared_columns:
+            self.shared_columns[(sheet, col)].sort()
+            self.sheet_columns.setdefault(sheet, []).append(col)
+        for sheet in self.sheet_columns:
+            self.sheet_columns[sheet].sort()
+
+        self.needed = dict()  # index of a row in the cone -> rectangle of its cells that are, None for one cell or a name
+        self.references = dict()  # index of a row -> text_references of its formula
+        self.constant_cells = set()  # (sheet, cell) read that aren't formulas
+        self.constant_names = set()  # (scope, NAME) read that aren't formulas
+        self.ranges_read = set()  # (sheet, rect)
+        self.range_index = RangeIndex()  # the same rectangles, for has_constant
+        self.unresolved = []  # outputs that aren't formulas, they have to be constants
+
+        stack = []  # (index of a row, (drow, dcol) of the cells of it to visit)
+        for sheet, name in outputs:
+            parsed = parse_cell_ref(name) if sheet != GLOBAL_SCOPE else None
+            if parsed is not None:
+                if not self.read_cell(sheet, parsed[0], parsed[1], stack):
+                    self.unresolved.append((sheet, format_cell_ref(parsed[0], parsed[1])))
+            elif not self.read_name(sheet, name, stack):
+                self.unresolved.append((sheet, name))
+
+        while len(stack) > 0:
+            k, offsets = stack.pop()
+            self.visit(k, offsets, stack)
+
+
+    def find_name(self, scope, name):
+        k = self.names.get((scope, name.upper()))
+        if k is None and scope != GLOBAL_SCOPE:
+            k = self.names.get((GLOBAL_SCOPE, name.upper()))
+        return k
+
+
+    # the shared formula row with the cell in it, None if there isn't one
+    def find_shared(self, sheet, col, row):
+        column = self.shared_columns.get((sheet, col))
+        if column is None:
+            return None
+        i = bisect_right(column, (row, MAX_ROW + 1, 0)) - 1
+        if i >= 0 and column[i][0] <= row <= column[i][1]:
+            return column[i][2]
+        return None
+
+
+    # a cell or name that is not a shared formula is needed
+    def add(self, k, stack):
+        if k not in self.needed:
+            self.needed[k] = None
+            stack.append((k, [(0, 0)]))
+
+
+    # the cells c1, r1 .. c2, r2 of shared formula row k are needed. The
+    # needed part is kept a rectangle (it stays one formula), so the cells
+    # it grows by are visited
+    def add_shared(self, k, c1, r1, c2, r2, stack):
+        old = self.needed.get(k)
+        if old is None:
+            new = (c1, r1, c2, r2)
+        else:
+            new = (min(old[0], c1), min(old[1], r1), max(old[2], c2), max(old[3], r2))
+            if new == old:
+                return
+        self.needed[k] = new
+        mcol, mrow = self.shared[k][0]
+        if old is None:
+            strips = [new]
+        else:
+            # the rows above and below the old rectangle, then left and right of it
+            strips = [(new[0], new[1], new[2], old[1] - 1), (new[0], old[3] + 1, new[2], new[3]),
+                      (new[0], old[1], old[0] - 1, old[3]), (old[2] + 1, old[1], new[2], old[3])]
+        offsets = []
+        for s1, t1, s2, t2 in strips:
+            if s1 > s2:
+                continue
+            for r in range(t1, t2 + 1):
+                for c in range(s1, s2 + 1):
+                    offsets.append((r - mrow, c - mcol))
+        stack.append((k, offsets))
+
+
+    # True when the cell is a formula
+    def read_cell(self, sheet, col, row, stack):
+        cell = format_cell_ref(col, row)
+        k = self.cells.get((sheet, cell))
+        if k is not None:
+            self.add(k, stack)
+            return True
+        k = self.find_shared(sheet, col, row)
+        if k is not None:
+            self.add_shared(k, col, row, col, row, stack)
+            return True
+        self.constant_cells.add((sheet, cell))
+        return False
+
+
+    # True when the name is a formula
+    def read_name(self, sheet, name, stack):
+        k = self.find_name(sheet, name)
+        if k is not None:
+            self.add(k, stack)
+            return True
+        self.constant_names.add((sheet, name.upper()))
+        self.constant_names.add((GLOBAL_SCOPE, name.upper()))
+        return False
+
+
+    def read_range(self, sheet, rect, stack):
+        if (sheet, rect) in self.ranges_read:
+            return
+        self.ranges_read.add((sheet, rect))
+        c1, r1, c2, r2 = rect
+        self.range_index.add_rect(sheet, c1, r1, c2, r2, rect)
+        for k, col, row in self.formula_index.points_in(sheet, c1, r1, c2, r2):
+            self.add(k, stack)
+        columns = self.sheet_columns.get(sheet, [])
+        for i in range(bisect_left(columns, c1), bisect_right(columns, c2)):
+            col = columns[i]
+            for s1, s2, k in self.shared_columns[(sheet, col)]:
+                if s1 <= r2 and s2 >= r1:
+                    self.add_shared(k, col, max(r1, s1), col, min(r2, s2), stack)
+
+
+    # what the cells at offsets (from the master) of row k read, relative
+    # references moved to each cell
+    def visit(self, k, offsets, stack):
+        row = self.rows[k]
+        found = self.references.get(k)
+        if found is None:
+            found = text_references(row["formula"], row["sheet"])
+            self.references[k] = found
+        for r in found:
+            kind = r[0]
+            if kind == "cell":
+                sheet, col, rw, col_abs, row_abs = r[1:]
+                for drow, dcol in (offsets if not (col_abs and row_abs) else [(0, 0)]):
+                    c = col if col_abs else col + dcol
+                    ro = rw if row_abs else rw + drow
+                    if 1 <= c <= MAX_COL and 1 <= ro <= MAX_ROW:
+                        self.read_cell(sheet, c, ro, stack)
+            elif kind == "range":
+                flags = r[6]
+                for drow, dcol in (offsets if not all(flags) else [(0, 0)]):
+                    rect = range_rect(r[2], r[3], r[4], r[5], flags, drow, dcol)
+                    if rect is not None:
+                        self.read_range(r[1], rect, stack)
+            else:
+                self.read_name(r[1], r[2], stack)
+
+
+    # the rows in the cone in the order they were given, shared formulas
+    # cut down to the cells that are needed
+    def get_rows(self):
+        rows = []
+        for k in sorted(self.needed):
+            rect = self.needed[k]
+            if rect is not None and rect != self.shared[k][1]:
+                rows.append(narrow_shared_row(self.rows[k], rect))
+            else:
+                rows.append(self.rows[k])
+        return rows
+
+
+    # whether a constant cell or name is read by something in the cone
+    def has_constant(self, sheet, name):
+        parsed = parse_cell_ref(name) if sheet != GLOBAL_SCOPE else None
+        if parsed is None:
+            return (sheet, name.upper()) in self.constant_names
+        if (sheet, name) in self.constant_cells:
+            return True
+        return len(self.range_index.rects_containing(sheet, parsed[0], parsed[1])) > 0
+
+
+    def stats(self):
+        ncells = 0
+        for k in self.needed:
+            rect = self.needed[k]
+            ncells = ncells + (1 if rect is None else (rect[2] - rect[0] + 1) * (rect[3] - rect[1] + 1))
+        return {
+            "formulas" : len(self.rows),
+            "formulas_in_cone" : len(self.needed),
+            "cells_in_cone" : ncells,
+            "ranges_read" : len(self.ranges_read),
+        }
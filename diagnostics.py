@@ -0,0 +1,92 @@
+
+# what the scanner and parser print. Everything goes through here with a
+# level, and only what is at or below the current level is printed. The
+# default only prints errors, so batch runs are quiet.
+#
+#   transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.INFO)
+#
+# INFO is progress (scanning, rows/sec), DEBUG is more detail and TRACE
+# prints every formula and its AST as it is parsed. Hot paths check the
+# module level flags (info_enabled, tracing) before building a message, so
+# a disabled level costs one attribute lookup.
+
+import sys
+
+
+SILENT = 0
+ERROR = 1
+WARNING = 2
+INFO = 3
+DEBUG = 4
+TRACE = 5
+
+LEVEL_NAMES = {
+    "silent" : SILENT,
+    "error" : ERROR,
+    "warning" : WARNING,
+    "info" : INFO,
+    "debug" : DEBUG,
+    "trace" : TRACE,
+}
+
+
+level = ERROR
+info_enabled = False
+debug_enabled = False
+tracing = False
+
+output = None  # file to write to, None for stdout
+
+
+
+# level is one of the constants above or its name ("info")
+def set_level(new_level):
+    global level, info_enabled, debug_enabled, tracing
+    if isinstance(new_level, str):
+        if new_level.lower() not in LEVEL_NAMES:
+            raise Exception("Unknown diagnostics level " + new_level)
+        new_level = LEVEL_NAMES[new_level.lower()]
+    level = new_level
+    info_enabled = level >= INFO
+    debug_enabled = level >= DEBUG
+    tracing = level >= TRACE
+
+
+def get_level():
+    return level
+
+
+def set_output(fp):
+    global output
+    output = fp
+
+
+def enabled(at_level):
+    return level >= at_level
+
+
+
+def emit(at_level, msg):
+    if level >= at_level:
+        fp = output if output is not None else sys.stdout
+        fp.write(str(msg) + "\n")
+
+
+def error(msg):
+    emit(ERROR, msg)
+
+
+def warning(msg):
+    emit(WARNING, msg)
+
+
+def info(msg):
+    emit(INFO, msg)
+
+
+def debug(msg):
+    emit(DEBUG, msg)
+
+
+def trace(msg):
+    emit(TRACE, msg)
@@ -2,10 +2,30 @@
 # functions for generating the intermediate 
 # files based on an Excel document 
 
-import openpyxl 
 import os 
 import sys 
 import csv 
+import time 
+
+from .xlsx_reader import XlsxWorkbook, rows_per_sec
+from .runtime import excel_serial
+from . import intermediate
+from . import diagnostics
+from . import profiling
+
+
+# openpyxl takes a while to import and the xml backend doesn't use it, 
+# so it is imported the first time a workbook is opened with it 
+def load_workbook(input_excel, **options):
+    import openpyxl
+    return openpyxl.load_workbook(input_excel, **options)
+
+
+# openpyxl gives date formatted cells as datetime and the like, the xml
+# backend gives the serial number in the cell. Both scan to the number
+def constant_value(wb, value):
+    return excel_serial(value, wb.epoch.year == 1904)
+
 
 
 class ExcelScanResults:
@@ -17,6 +37,9 @@ class ExcelScanResults:
         self.const = dict()
         self.const["$$$GLOBAL$$$"] = dict()
         self.const_indexes = dict()
+        self.formula_ranges = dict()  # (scope, master cell) -> range of a shared formula 
+        self.next_formula_id = 1
+        self.next_const_id = 1
 
 
 
@@ -34,6 +57,19 @@ class ExcelScanResults:
             self.formulas["$$$GLOBAL$$$"][in_cell_or_name] = formula_str
 
 
+    # a shared formula (a filled down/right block stored once in the xlsx) 
+    # is kept as the master formula in its top left cell plus the range 
+    # it applies to, instead of one formula per cell 
+    def record_shared_formula(self, formula_str, ref, in_cell_or_name, in_sheet):
+        self.record_formula(formula_str, in_cell_or_name, in_sheet)
+        scope = in_sheet if in_sheet is not None else "$$$GLOBAL$$$"
+        self.formula_ranges[(scope, in_cell_or_name)] = ref
+
+
+    def get_formula_range(self, scope, name):
+        return self.formula_ranges.get((scope, name))
+
+
     def record_const(self, s, in_cell_or_name, in_sheet):
         
         if in_sheet is not None:
@@ -48,20 +84,48 @@ class ExcelScanResults:
             self.const["$$$GLOBAL$$$"][in_cell_or_name] = s
             
 
-    def assign_formula_indexes(self):
-        _id = 1
+    # adds everything from another (partial) scan, keeping its order 
+    def merge(self, other):
+        for scope in other.formulas:
+            for nm in other.formulas[scope]:
+                self.record_formula(other.formulas[scope][nm], nm, None if scope == "$$$GLOBAL$$$" else scope)
+        self.formula_ranges.update(other.formula_ranges)
+        for scope in other.const:
+            for nm in other.const[scope]:
+                self.record_const(other.const[scope][nm], nm, None if scope == "$$$GLOBAL$$$" else scope)
+
+
+    # previous is an earlier ExcelScanResults of the same workbook. Cells 
+    # that were in it keep their ids and new cells get ids after the highest 
+    # one ever given out, so ids stay stable from one run to the next 
+    def assign_formula_indexes(self, previous=None):
+        self.assigned_indexes = dict()
+        self.const_indexes = dict()
+
+        if previous is not None:
+            self.next_formula_id = previous.next_formula_id
+            self.next_const_id = previous.next_const_id
+        else:
+            self.next_formula_id = 1
+            self.next_const_id = 1
+
         for scope in self.formulas:
             for nm in self.formulas[scope]:
                 t = (scope, nm)
-                self.assigned_indexes[t] = _id 
-                _id = _id + 1 
+                if previous is not None and t in previous.assigned_indexes:
+                    self.assigned_indexes[t] = previous.assigned_indexes[t]
+                else:
+                    self.assigned_indexes[t] = self.next_formula_id 
+                    self.next_formula_id = self.next_formula_id + 1 
         
-        _id = 1
         for scope in self.const:
             for nm in self.const[scope]:
                 t = (scope, nm)
-                self.const_indexes[t] = _id 
-                _id = _id + 1 
+                if previous is not None and t in previous.const_indexes:
+                    self.const_indexes[t] = previous.const_indexes[t]
+                else:
+                    self.const_indexes[t] = self.next_const_id 
+                    self.next_const_id = self.next_const_id + 1 
         
 
 
@@ -69,26 +133,50 @@ class ExcelScanResults:
 
 def is_excel_formula(cell_value):
     return str(cell_value).startswith("=")
+
+
+
+# records one of the ("formula" / "shared" / "const", value, coordinate, sheet) 
+# tuples the cell iterators yield. For "shared" the value is (formula, ref) 
+def record_cell(scan_r, kind, value, coordinate, sheet_name):
+    if kind == "formula":
+        scan_r.record_formula(value, coordinate, sheet_name)
+    elif kind == "shared":
+        scan_r.record_shared_formula(value[0], value[1], coordinate, sheet_name)
+    else:
+        scan_r.record_const(value, coordinate, sheet_name)
         
 
 
-def scan_excel(input_excel):
+# backend is "openpyxl" (the default) or "xml", which reads the sheet
+# xml out of the zip directly and skips building openpyxl cells.
+# workers > 1 scans the sheets in a process pool, see scan_excel_parallel.
+# The xml backend keeps shared formulas as one formula plus its range 
+# (see ExcelScanResults.record_shared_formula) unless expand_shared is set, 
+# openpyxl always expands them to one formula per cell 
+def scan_excel(input_excel, streaming=False, report_every=100000, backend="openpyxl", workers=None, expand_shared=False):
+
+    if workers is not None and workers > 1:
+        return scan_excel_parallel(input_excel, workers, report_every=report_every, backend=backend, expand_shared=expand_shared)
+
+    if backend == "xml":
+        return scan_excel_xml(input_excel, report_every=report_every, expand_shared=expand_shared)
+    elif backend != "openpyxl":
+        raise Exception("Unknown scan backend " + str(backend))
+
+    if streaming:
+        return scan_excel_streaming(input_excel, report_every=report_every)
     
     scan_r = ExcelScanResults()
     
     # thanks https://stackoverflow.com/questions/13377793/is-it-possible-to-get-an-excel-documents-row-count-without-loading-the-entire-d
-    wb = openpyxl.load_workbook(input_excel)
-    print("scanning " + input_excel)
+    with profiling.phase("scan.load_workbook"):
+        wb = load_workbook(input_excel)
+    diagnostics.info("scanning " + input_excel)
     sheets = wb.sheetnames 
 
-    sheet_idx = 1
-
-    sheet_idx_to_sheet_name = dict()
-
     for sheet_name in sheets:
         
-        # print("" + str(sheet_idx) + " " + sheet_name)
-        sheet_idx_to_sheet_name[sheet_idx] = sheet_name
         sht = wb[sheet_name]
         
         for row in sht.iter_rows(min_row=1, max_col=sht.max_column, max_row=sht.max_row):
@@ -98,42 +186,213 @@ def scan_excel(input_excel):
                         scan_r.record_formula(cell.value, cell.coordinate, sheet_name)
                     else:
                         if cell.value != "":
-                            scan_r.record_const(cell.value, cell.coordinate, sheet_name)
-        
-        sheet_idx = sheet_idx + 1
+                            scan_r.record_const(constant_value(wb, cell.value), cell.coordinate, sheet_name)
 
+    record_defined_names(scan_r, wb.sheetnames, iter_defined_names(wb))
 
-    # print("sheet index to sheet name")
-    # for idx in sheet_idx_to_sheet_name:
-    #     print(str(idx) + " = " + str(sheet_idx_to_sheet_name[idx]))
+    diagnostics.info("Done scanning ")
 
-    # print("defined names at the workbook level ")
-    for dn in wb.defined_names.definedName:
-        if dn.localSheetId is not None:
-            sheet_scope = sheet_idx_to_sheet_name[dn.localSheetId]
-        else:
-            sheet_scope = None 
+    scan_r.assign_formula_indexes()  # ensures formulas are unique 
 
-        scan_r.record_formula(dn.attr_text, dn.name, sheet_scope)
+    return scan_r
 
-    print("Done scanning ")
 
-    scan_r.assign_formula_indexes()  # ensures formulas are unique 
+
+# same results as scan_excel, but the workbook is opened in read only 
+# mode and the cells are streamed from the sheet xml one row at a time, 
+# so memory stays flat no matter how big the used range is 
+def scan_excel_streaming(input_excel, report_every=100000):
+
+    scan_r = ExcelScanResults()
+
+    wb = load_workbook(input_excel, read_only=True)
+    diagnostics.info("scanning (streaming) " + input_excel)
+
+    try:
+        for kind, value, coordinate, sheet_name in iter_excel_cells(wb, report_every=report_every):
+            record_cell(scan_r, kind, value, coordinate, sheet_name)
+
+        record_defined_names(scan_r, wb.sheetnames, iter_defined_names(wb))
+    finally:
+        wb.close()  # read only workbooks keep the file handle open 
+
+    diagnostics.info("Done scanning ")
+
+    scan_r.assign_formula_indexes()
 
     return scan_r
-            
+
+
+
+# same results as scan_excel, read with xlsx_reader instead of openpyxl
+def scan_excel_xml(input_excel, report_every=100000, expand_shared=False):
+
+    scan_r = ExcelScanResults()
+
+    wb = XlsxWorkbook(input_excel)
+    diagnostics.info("scanning (xml) " + input_excel)
+
+    try:
+        for sheet_name in wb.sheetnames:
+            for kind, value, coordinate, sheet_name in wb.iter_cells(sheet_name, report_every=report_every, expand_shared=expand_shared):
+                record_cell(scan_r, kind, value, coordinate, sheet_name)
+
+        record_defined_names(scan_r, wb.sheetnames, wb.defined_names)
+    finally:
+        wb.close()
+
+    diagnostics.info("Done scanning ")
+
+    scan_r.assign_formula_indexes()
+
+    return scan_r
+
+
+
+# the sheets don't depend on each other while scanning, so each worker 
+# process scans whole sheets into its own ExcelScanResults. The partial 
+# results are merged back in workbook sheet order (then the defined 
+# names), which is the same order a serial scan records things in, so 
+# assign_formula_indexes gives the same ids 
+def scan_excel_parallel(input_excel, workers, report_every=100000, backend="openpyxl", expand_shared=False):
+
+    if backend == "xml":
+        wb = XlsxWorkbook(input_excel)
+        sheetnames = list(wb.sheetnames)
+        defined_names = list(wb.defined_names)
+        wb.close()
+    elif backend == "openpyxl":
+        wb = load_workbook(input_excel, read_only=True)
+        sheetnames = list(wb.sheetnames)
+        defined_names = list(iter_defined_names(wb))
+        wb.close()
+    else:
+        raise Exception("Unknown scan backend " + str(backend))
+
+    diagnostics.info("scanning (" + str(workers) + " workers) " + input_excel)
+
+    scan_r = ExcelScanResults()
+
+    import concurrent.futures  # only scans with workers need it 
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=open_worker_workbook, initargs=(input_excel, backend, diagnostics.get_level())) as pool:
+        partials = pool.map(scan_sheet, sheetnames, [report_every] * len(sheetnames), [expand_shared] * len(sheetnames))
+        for partial in partials:
+            scan_r.merge(partial)
+
+    record_defined_names(scan_r, sheetnames, defined_names)
+
+    diagnostics.info("Done scanning ")
+
+    scan_r.assign_formula_indexes()
+
+    return scan_r
+
+
+
+# each worker process opens the workbook once and reuses it for every 
+# sheet it is handed 
+worker_workbook = None
+worker_backend = None
+
+
+def open_worker_workbook(input_excel, backend, diagnostics_level=diagnostics.ERROR):
+    global worker_workbook, worker_backend
+    diagnostics.set_level(diagnostics_level)  # not inherited when processes are spawned 
+    if backend == "xml":
+        worker_workbook = XlsxWorkbook(input_excel)
+    else:
+        worker_workbook = load_workbook(input_excel, read_only=True)
+    worker_backend = backend
+
+
+
+def scan_sheet(sheet_name, report_every=100000, expand_shared=False):
+    
+    partial = ExcelScanResults()
+
+    if worker_backend == "xml":
+        cells = worker_workbook.iter_cells(sheet_name, report_every=report_every, expand_shared=expand_shared)
+    else:
+        cells = iter_sheet_cells(worker_workbook, sheet_name, report_every=report_every)
+
+    for kind, value, coordinate, sheet_name in cells:
+        record_cell(partial, kind, value, coordinate, sheet_name)
+
+    return partial
+
+
+
+# yields ("formula" or "const", value, coordinate, sheet name) for each 
+# non empty cell of a read only workbook, one cell at a time. 
+# Prints the rows/sec every report_every rows (0 to turn it off) 
+def iter_excel_cells(wb, report_every=100000):
+
+    for sheet_name in wb.sheetnames:
+        yield from iter_sheet_cells(wb, sheet_name, report_every=report_every)
+
+
+
+def iter_sheet_cells(wb, sheet_name, report_every=100000):
+
+    sht = wb[sheet_name]
+    start = time.perf_counter()
+    nrows = 0
+
+    for row in sht.iter_rows():
+        nrows = nrows + 1
+        for cell in row:
+            value = cell.value
+            if value is None or value == "":
+                continue  # EmptyCell in read only mode has no coordinate 
+            if is_excel_formula(value):
+                yield "formula", value, cell.coordinate, sheet_name
+            else:
+                yield "const", constant_value(wb, value), cell.coordinate, sheet_name
+
+        if report_every and nrows % report_every == 0 and diagnostics.info_enabled:
+            diagnostics.info("  " + sheet_name + ": " + str(nrows) + " rows, " + rows_per_sec(nrows, start) + " rows/sec")
+
+    if report_every and diagnostics.info_enabled:
+        diagnostics.info("  " + sheet_name + ": " + str(nrows) + " rows total, " + rows_per_sec(nrows, start) + " rows/sec")
+
+
+
+# (name, localSheetId, text) for the defined names of an openpyxl workbook 
+def iter_defined_names(wb):
+    for dn in wb.defined_names.definedName:
+        yield dn.name, dn.localSheetId, dn.attr_text
+
+
+
+# defined names at the workbook level, these are recorded as formulas
+# in their sheet scope (or the global scope). localSheetId is the 0 based
+# position of the sheet in the workbook. The xlsx keeps the text without 
+# the = (Sheet1!$A$1), it is put on so the name parses like any formula 
+def record_defined_names(scan_r, sheetnames, defined_names):
+
+    for name, local_sheet_id, text in defined_names:
+        if local_sheet_id is not None:
+            sheet_scope = sheetnames[local_sheet_id]
+        else:
+            sheet_scope = None 
+
+        if text and not text.startswith("="):
+            text = "=" + text
+        scan_r.record_formula(text, name, sheet_scope)
+
 
 
 def dump_scanned_formulas(scan_r, folder):   # input ScanResults to this one 
     formulas_file = dump_scanned_formulas_path(folder)
     with open(formulas_file, "w", newline="") as fp:
         wr = csv.writer(fp)
-        wr.writerow(["formula_id", "sheet", "cell_or_name", "formula"])
+        wr.writerow(["formula_id", "sheet", "cell_or_name", "formula", "ref"])
         for scope in scan_r.formulas:
             for nm in scan_r.formulas[scope]:
                 t = (scope, nm)
                 _id = scan_r.assigned_indexes[t]
-                wr.writerow([_id, scope, nm, scan_r.formulas[scope][nm]])
+                ref = scan_r.formula_ranges.get(t, "")  # empty unless it's a shared formula 
+                wr.writerow([_id, scope, nm, scan_r.formulas[scope][nm], ref])
 
 
 
@@ -160,3 +419,23 @@ def dump_scanned_constants_path(folder):
     return os.path.join(folder, "excel_constants.csv")
 
 
+
+# binary, memory mappable versions of the two dumps above, see intermediate.py. 
+# The csv dumps are still there for looking at 
+def dump_scanned_formulas_bin(scan_r, folder):
+    intermediate.write_formulas(scan_r, dump_scanned_formulas_bin_path(folder))
+
+
+
+def dump_scanned_constants_bin(scan_r, folder):
+    intermediate.write_constants(scan_r, dump_scanned_constants_bin_path(folder))
+
+
+
+def dump_scanned_formulas_bin_path(folder):
+    return os.path.join(folder, "excel_formulas.bin")
+
+
+
+def dump_scanned_constants_bin_path(folder):
+    return os.path.join(folder, "excel_constants.bin")
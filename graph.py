@@ -0,0 +1,470 @@
+
+# the graph of which cells read which. Built from the parsed formulas
+# (the IRVariable / IRVariableRange nodes and their sheet scopes) and the
+# constants in ProgramInfo.
+#
+#   graph = build_dependency_graph(formulas_parsed, program_info)
+#   order, blocked = graph.topological_order()   # precedents first
+#   cycles = graph.find_cycles()                 # circular references
+#   inputs = graph.get_inputs()                  # constants formulas read
+#
+# Every cell, defined name and range is a node numbered from 0, and an
+# edge goes from a node to each node it reads (its precedents). A range
+# is a node of its own, kept as a rectangle in a range_index.RangeIndex
+# instead of as edges to every cell in it: its precedents (the cells in
+# it) and the ranges a cell is in are looked up in the index when asked
+# for, so SUM($A$1:$A$100000) filled down costs one node, not 100k edges
+# per formula. Shared formulas are expanded to one node per cell, their references are
+# taken out of the master AST once and moved with integer arithmetic.
+# Building is linear in the formulas and their references. Ordering and
+# finding cycles are linear in nodes + edges + cells read through ranges,
+# nothing recurses so long chains of cells are fine.
+
+from .parse import walk
+from .range_index import RangeIndex
+from .refs import parse_cell_ref, split_coordinate, parse_range, format_cell_ref, column_to_index, COLUMN_OR_ROW_RE, MAX_COL, MAX_ROW
+
+
+GLOBAL_SCOPE = "$$$GLOBAL$$$"
+
+# node kinds
+FORMULA = "formula"
+NAME = "name"  # a defined name, which is a formula too
+CONSTANT = "constant"
+EMPTY = "empty"  # a cell that is read but has nothing in it
+RANGE = "range"
+
+
+
+class DependencyGraph:
+
+    def __init__(self):
+        self.keys = []  # node -> (sheet, cell / name / "A1:B2")
+        self.kinds = []  # node -> FORMULA, NAME, CONSTANT, EMPTY or RANGE
+        self.formulas = []  # node -> formula_obj it comes from, None if not a formula
+        self.precedents = []  # node -> list of the nodes it reads, not counting through ranges
+        self.coords = []  # node -> (col, row) for cells, None otherwise
+        self.rects = dict()  # range node -> (c1, r1, c2, r2)
+        self.index = dict()  # (sheet, name) -> node
+        self.range_index = RangeIndex()  # cells and ranges of each sheet
+        self.formula_index = RangeIndex()  # only the formula cells, see topological_order
+        self.dependents = None  # reverse of precedents, made when first needed
+        self.unresolved = []  # (node, reference text) for names that aren't defined
+        self.nedges = 0
+
+
+    # col / row are given for cells, which puts them in the range index
+    def add_node(self, sheet, name, kind, formula_obj=None, col=None, row=None):
+        key = (sheet, name)
+        node = self.index.get(key)
+        if node is not None:
+            if kind != EMPTY and self.kinds[node] == EMPTY:
+                # read before it was seen, it has something in it after all
+                self.kinds[node] = kind
+                self.formulas[node] = formula_obj
+                if kind == FORMULA and self.coords[node] is not None:
+                    self.formula_index.add_point(sheet, self.coords[node][0], self.coords[node][1], node)
+            return node
+        node = len(self.keys)
+        self.index[key] = node
+        self.keys.append(key)
+        self.kinds.append(kind)
+        self.formulas.append(formula_obj)
+        self.precedents.append([])
+        self.dependents = None
+        if col is not None:
+            self.coords.append((col, row))
+            self.range_index.add_point(sheet, col, row, node)
+            if kind == FORMULA:
+                self.formula_index.add_point(sheet, col, row, node)
+        else:
+            self.coords.append(None)
+        return node
+
+
+    # a range reference as a node, one per distinct rectangle
+    def add_range(self, sheet, c1, r1, c2, r2):
+        name = format_cell_ref(c1, r1) + ":" + format_cell_ref(c2, r2)
+        node = self.index.get((sheet, name))
+        if node is not None:
+            return node
+        node = self.add_node(sheet, name, RANGE)
+        self.rects[node] = (c1, r1, c2, r2)
+        self.range_index.add_rect(sheet, c1, r1, c2, r2, node)
+        return node
+
+
+    def add_edge(self, node, precedent):
+        self.precedents[node].append(precedent)
+        self.nedges = self.nedges + 1
+        self.dependents = None
+
+
+    def get_node(self, sheet, name):
+        return self.index.get((sheet, name))
+
+    def get_key(self, node):
+        return self.keys[node]
+
+    def get_kind(self, node):
+        return self.kinds[node]
+
+    def get_formula(self, node):
+        return self.formulas[node]
+
+    def get_coords(self, node):
+        return self.coords[node]
+
+    def get_rect(self, node):
+        return self.rects.get(node)
+
+    # for a range, the cells in it
+    def get_precedents(self, node):
+        rect = self.rects.get(node)
+        if rect is not None:
+            return self.range_index.points_in(self.keys[node][0], *rect)
+        return self.precedents[node]
+
+    def count_precedents(self, node):
+        rect = self.rects.get(node)
+        if rect is not None:
+            return self.range_index.count_in(self.keys[node][0], *rect)
+        return len(self.precedents[node])
+
+    # for a cell, this includes the ranges it is in
+    def get_dependents(self, node):
+        if self.dependents is None:
+            self.build_dependents()
+        coords = self.coords[node]
+        if coords is None:
+            return self.dependents[node]
+        in_ranges = self.range_index.rects_containing(self.keys[node][0], coords[0], coords[1])
+        if len(in_ranges) == 0:
+            return self.dependents[node]
+        return self.dependents[node] + in_ranges
+
+    def node_count(self):
+        return len(self.keys)
+
+    # edges to cells in ranges are not counted, they aren't stored
+    def edge_count(self):
+        return self.nedges
+
+
+    # the dependents that are stored as edges, the ranges a cell is in are
+    # added by get_dependents
+    def build_dependents(self):
+        dependents = [[] for i in range(0, len(self.keys))]
+        for node in range(0, len(self.keys)):
+            for p in self.precedents[node]:
+                dependents[p].append(node)
+        self.dependents = dependents
+
+
+    # nodes that don't read anything: constants, empty cells, and formulas
+    # like =1+2
+    def get_leaves(self):
+        return [node for node in range(0, len(self.keys)) if self.count_precedents(node) == 0]
+
+    # the constants and empty cells the formulas read, the values a model
+    # takes as its inputs
+    def get_inputs(self):
+        if self.dependents is None:
+            self.build_dependents()
+        return [node for node in range(0, len(self.keys))
+                if (self.kinds[node] == CONSTANT or self.kinds[node] == EMPTY) and len(self.get_dependents(node)) > 0]
+
+    # formulas nothing else reads, the results of the model
+    def get_outputs(self):
+        if self.dependents is None:
+            self.build_dependents()
+        return [node for node in range(0, len(self.keys))
+                if (self.kinds[node] == FORMULA or self.kinds[node] == NAME) and len(self.get_dependents(node)) == 0]
+
+
+    # the precedents that can have precedents themselves. Constants and
+    # empty cells in a range are left out, they are ready from the start,
+    # so SUM($A$1:A1) filled down over inputs isn't a quadratic amount of work
+    def formula_precedents(self, node):
+        rect = self.rects.get(node)
+        if rect is not None:
+            return self.formula_index.points_in(self.keys[node][0], *rect)
+        return self.precedents[node]
+
+
+    # Kahn's algorithm. Returns (order, blocked): order has every node after
+    # all of its precedents, blocked has the nodes that can't be ordered
+    # because they are on a circular reference or read something that is.
+    # Ranges wait only for the formula cells in them
+    def topological_order(self):
+        if self.dependents is None:
+            self.build_dependents()
+        n = len(self.keys)
+        waiting = [len(self.precedents[node]) for node in range(0, n)]
+        for node in self.rects:
+            waiting[node] = self.formula_index.count_in(self.keys[node][0], *self.rects[node])
+        order = [node for node in range(0, n) if waiting[node] == 0]
+        i = 0
+        while i < len(order):
+            node = order[i]
+            coords = self.coords[node]
+            if self.kinds[node] == FORMULA and coords is not None:
+                dependents = self.get_dependents(node)
+            else:
+                dependents = self.dependents[node]
+            for d in dependents:
+                waiting[d] = waiting[d] - 1
+                if waiting[d] == 0:
+                    order.append(d)
+            i = i + 1
+        blocked = [node for node in range(0, n) if waiting[node] > 0]
+        return order, blocked
+
+
+    # Tarjan's algorithm with its own stack. Returns the strongly connected
+    # components, each a list of nodes, with every component after the ones
+    # it reads from. So this is an evaluation order that also works when
+    # there are cycles: a component of more than one node (or a node that
+    # reads itself) has to be iterated as a group. Constants and empty
+    # cells come first, then ranges only have to go over their formula cells
+    def strongly_connected_components(self):
+        n = len(self.keys)
+        index = [-1] * n
+        lowlink = [0] * n
+        on_stack = [False] * n
+        stack = []
+        components = []
+        next_index = 0
+
+        for node in range(0, n):
+            if self.kinds[node] == CONSTANT or self.kinds[node] == EMPTY:
+                index[node] = lowlink[node] = next_index
+                next_index = next_index + 1
+                components.append([node])
+
+        for root in range(0, n):
+            if index[root] != -1:
+                continue
+            index[root] = lowlink[root] = next_index
+            next_index = next_index + 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, 0, self.formula_precedents(root))]  # (node, position in its precedents, precedents)
+
+            while len(work) > 0:
+                node, pos, precedents = work[-1]
+                if pos < len(precedents):
+                    work[-1] = (node, pos + 1, precedents)
+                    p = precedents[pos]
+                    if index[p] == -1:
+                        index[p] = lowlink[p] = next_index
+                        next_index = next_index + 1
+                        stack.append(p)
+                        on_stack[p] = True
+                        work.append((p, 0, self.formula_precedents(p)))
+                    elif on_stack[p] and index[p] < lowlink[node]:
+                        lowlink[node] = index[p]
+                    continue
+
+                work.pop()
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    if lowlink[node] < lowlink[parent]:
+                        lowlink[parent] = lowlink[node]
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        m = stack.pop()
+                        on_stack[m] = False
+                        component.append(m)
+                        if m == node:
+                            break
+                    components.append(component)
+
+        return components
+
+
+    # the circular references, as lists of nodes
+    def find_cycles(self):
+        cycles = []
+        for component in self.strongly_connected_components():
+            if len(component) > 1 or component[0] in self.get_precedents(component[0]):
+                cycles.append(component)
+        return cycles
+
+
+    # "Sheet1!A1" style text for messages
+    def describe(self, node):
+        sheet, name = self.keys[node]
+        if sheet == GLOBAL_SCOPE:
+            return name
+        if not sheet.replace("_", "").isalnum():
+            sheet = "'" + sheet.replace("'", "''") + "'"
+        return sheet + "!" + name
+
+
+    def print_summary(self, limit=10):
+        counts = dict()
+        for kind in self.kinds:
+            counts[kind] = counts.get(kind, 0) + 1
+        print(str(self.node_count()) + " nodes " + str(counts) + ", " + str(self.edge_count()) + " edges")
+        cycles = self.find_cycles()
+        print(str(len(cycles)) + " circular references")
+        for cycle in cycles[:limit]:
+            print("  " + " -> ".join(self.describe(node) for node in cycle))
+        if len(self.unresolved) > 0:
+            print(str(len(self.unresolved)) + " references to undefined names")
+            for node, ref in self.unresolved[:limit]:
+                print("  " + self.describe(node) + " reads " + ref)
+
+
+
+# the references in a formula AST, each as one of
+#   ("cell", sheet, col, row, col_abs, row_abs)
+#   ("range", sheet, col1, row1, col2, row2, abs flags (c1, r1, c2, r2))
+#   ("name", sheet, name)
+# Whole columns are ranges over every row and whole rows over every column
+def formula_references(formula_ast):
+    found = []
+    for node in walk(formula_ast):
+        t = node.nodetype()
+        if t == "variable":
+            sheet = node.get_sheet_scope()
+            parsed = parse_cell_ref(node.get_varname())
+            if parsed is not None:
+                found.append(("cell", sheet) + parsed)
+            else:
+                found.append(("name", sheet, node.get_varname()))
+        elif t == "variablerange":
+            sheet = node.get_sheet_scope()
+            first = range_side(node.get_varname1())
+            last = range_side(node.get_varname2())
+            if first is None or last is None:
+                # something like name1:name2, read both
+                for side in (node.get_varname1(), node.get_varname2()):
+                    if parse_cell_ref(side) is not None:
+                        found.append(("cell", sheet) + parse_cell_ref(side))
+                    elif COLUMN_OR_ROW_RE.match(side) is None:
+                        found.append(("name", sheet, side))
+                continue
+            found.append(("range", sheet, first[0], first[1], last[0], last[1], (first[2], first[3], last[2], last[3])))
+    return found
+
+
+
+# one end of a range as (col, row, col_abs, row_abs). The side of a whole
+# column reference has its row at 1 or MAX_ROW filled in later by
+# range_rect, so here row is None (and col is None for whole rows)
+def range_side(ref):
+    parsed = parse_cell_ref(ref)
+    if parsed is not None:
+        return parsed
+    if COLUMN_OR_ROW_RE.match(ref) is None:
+        return None
+    anchored = ref.startswith("$")
+    part = ref.lstrip("$")
+    if part.isdigit():
+        return None, int(part), True, anchored
+    return column_to_index(part), None, anchored, True
+
+
+
+# the rectangle (min col, min row, max col, max row) of a range reference
+# moved by drow / dcol, None if it went off the sheet
+def range_rect(col1, row1, col2, row2, flags, drow, dcol):
+    c1 = 1 if col1 is None else (col1 if flags[0] else col1 + dcol)
+    r1 = 1 if row1 is None else (row1 if flags[1] else row1 + drow)
+    c2 = MAX_COL if col2 is None else (col2 if flags[2] else col2 + dcol)
+    r2 = MAX_ROW if row2 is None else (row2 if flags[3] else row2 + drow)
+    if min(c1, c2) < 1 or max(c1, c2) > MAX_COL or min(r1, r2) < 1 or max(r1, r2) > MAX_ROW:
+        return None
+    return min(c1, c2), min(r1, r2), max(c1, c2), max(r1, r2)
+
+
+
+
+# formulas_parsed is what parse.parse_formulas_csv / parse_formulas_bin
+# return, program_info (optional) gives the constant cells. Formulas that
+# didn't parse ("parsed" None) become nodes with no precedents
+def build_dependency_graph(formulas_parsed, program_info=None):
+
+    graph = DependencyGraph()
+    names = dict()  # (scope, NAME) -> node, names are not case sensitive
+
+    def add_cell(sheet, cell, kind, formula_obj, col=None, row=None):
+        if col is None:
+            col, row = split_coordinate(cell)
+        return graph.add_node(sheet, cell, kind, formula_obj, col, row)
+
+    # first every node that has something in it, so the names can be resolved
+    if program_info is not None:
+        for sheet, name in program_info.program_constants:
+            if sheet != GLOBAL_SCOPE and parse_cell_ref(name) is not None:
+                add_cell(sheet, name, CONSTANT, None)
+            else:
+                names[(sheet, name.upper())] = graph.add_node(sheet, name, CONSTANT)
+
+    formula_cells = []  # (formula_obj, list of (node, drow, dcol))
+    for formula_obj in formulas_parsed:
+        sheet = formula_obj["sheet"]
+        name = formula_obj["name"]
+        if sheet == GLOBAL_SCOPE or parse_cell_ref(name) is None:
+            node = graph.add_node(sheet, name, NAME, formula_obj)
+            names[(sheet, name.upper())] = node
+            formula_cells.append((formula_obj, [(node, 0, 0)]))
+            continue
+
+        ref = formula_obj.get("ref")
+        if ref is None:
+            formula_cells.append((formula_obj, [(add_cell(sheet, name, FORMULA, formula_obj), 0, 0)]))
+            continue
+
+        mcol, mrow = split_coordinate(name)
+        c1, r1, c2, r2 = parse_range(ref)
+        targets = []
+        for row in range(r1, r2 + 1):
+            for col in range(c1, c2 + 1):
+                targets.append((add_cell(sheet, format_cell_ref(col, row), FORMULA, formula_obj, col, row), row - mrow, col - mcol))
+        formula_cells.append((formula_obj, targets))
+
+    def resolve_name(scope, name):
+        upper = name.upper()
+        node = names.get((scope, upper))
+        if node is None and scope != GLOBAL_SCOPE:
+            node = names.get((GLOBAL_SCOPE, upper))
+        return node
+
+    # then the edges
+    for formula_obj, targets in formula_cells:
+        if formula_obj["parsed"] is None:
+            continue
+        found = formula_references(formula_obj["parsed"])
+        for node, drow, dcol in targets:
+            for r in found:
+                kind = r[0]
+                if kind == "cell":
+                    sheet, col, row, col_abs, row_abs = r[1:]
+                    if not col_abs:
+                        col = col + dcol
+                    if not row_abs:
+                        row = row + drow
+                    if col < 1 or col > MAX_COL or row < 1 or row > MAX_ROW:
+                        continue  # moved off the sheet, it's #REF!
+                    cell = format_cell_ref(col, row)
+                    p = graph.get_node(sheet, cell)
+                    if p is None:
+                        p = graph.add_node(sheet, cell, EMPTY, None, col, row)
+                    graph.add_edge(node, p)
+                elif kind == "range":
+                    rect = range_rect(r[2], r[3], r[4], r[5], r[6], drow, dcol)
+                    if rect is not None:
+                        graph.add_edge(node, graph.add_range(r[1], *rect))
+                else:
+                    p = resolve_name(r[1], r[2])
+                    if p is None:
+                        graph.unresolved.append((node, r[2]))
+                    else:
+                        graph.add_edge(node, p)
+
+    return graph
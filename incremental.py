@@ -0,0 +1,237 @@
+
+# rebuilding a workbook after a small edit. A cache folder keeps, for
+# each sheet, the scanned cells keyed by a hash of the sheet xml, and the
+# parsed formulas keyed by a hash of the formulas in that sheet scope.
+# The generated code of a scope is keyed by that hash and by what the
+# code looks up elsewhere (ast_to_python.formula_reads): whether the
+# cells it reads are formulas, the names and the circular references.
+# Only sheets whose content changed are scanned and parsed again, and
+# only scopes that changed or read something that changed are generated
+# again. The ids of the last run are kept too so formula ids don't move
+# around when cells are added or removed. pipeline.build(incremental=...)
+# does the whole run this way.
+#
+#   build = IncrementalBuild("workspace/cache")
+#   scan_r = build.scan("model.xlsx")
+#   formulas_nodes = build.parse(scan_r)
+#   code = build.generate_code(formulas_nodes, program_info)  # module source
+
+import hashlib
+import os
+import pickle
+import re
+
+from .gen import ExcelScanResults, record_cell, record_defined_names
+from .xlsx_reader import XlsxWorkbook
+from .parse import parse_formula_rows, PARSER_VERSION
+from .ast_to_python import formula_to_python_function, formula_reads, prepare_program, module_source, CODEGEN_VERSION
+
+
+# bump when what is stored in the cache changes
+CACHE_VERSION = 5
+
+RANGE_CALL = re.compile(r"\b(range_\w+)\(")
+
+
+
+class IncrementalBuild:
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        for sub in ["sheets", "parsed", "reads", "code"]:
+            os.makedirs(os.path.join(cache_dir, sub), exist_ok=True)
+        self.scope_keys = dict()  # scope -> hash of its formulas, set by parse
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        self.stats = {
+            "sheets_reused" : 0,
+            "sheets_scanned" : 0,
+            "scopes_reused" : 0,
+            "scopes_parsed" : 0,
+            "formulas_parsed" : 0,
+            "code_reused" : 0,
+            "code_generated" : 0,
+        }
+
+
+    def _path(self, sub, key):
+        return os.path.join(self.cache_dir, sub, key + ".pickle")
+
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as fp:
+                return pickle.load(fp)
+        except Exception:
+            return None  # half written or from an old version, just redo it
+
+
+    # written under a temporary name and moved into place so an interrupted
+    # run never leaves a broken entry behind
+    def _store(self, path, obj):
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+    # same results as gen.scan_excel(backend="xml"), except that sheets
+    # whose xml didn't change come out of the cache, and ids are kept
+    # stable with the previous run
+    def scan(self, input_excel, report_every=0):
+
+        scan_r = ExcelScanResults()
+        wb = XlsxWorkbook(input_excel)
+
+        try:
+            # shared strings can change a sheet's values without changing its xml
+            strings_digest = wb.part_digest(wb.shared_strings_path)
+
+            for sheet_name in wb.sheetnames:
+                key = digest([CACHE_VERSION, sheet_name, wb.part_digest(wb.sheet_paths[sheet_name]), strings_digest])
+                path = self._path("sheets", key)
+
+                partial = self._load(path)
+                if partial is not None:
+                    self.stats["sheets_reused"] = self.stats["sheets_reused"] + 1
+                else:
+                    partial = ExcelScanResults()
+                    for kind, value, coordinate, sheet_name in wb.iter_cells(sheet_name, report_every=report_every, expand_shared=False):
+                        record_cell(partial, kind, value, coordinate, sheet_name)
+                    self._store(path, partial)
+                    self.stats["sheets_scanned"] = self.stats["sheets_scanned"] + 1
+
+                scan_r.merge(partial)
+
+            record_defined_names(scan_r, wb.sheetnames, wb.defined_names)
+        finally:
+            wb.close()
+
+        ids_path = os.path.join(self.cache_dir, "ids.pickle")
+        previous = self._load(ids_path)
+        scan_r.assign_formula_indexes(previous=previous)
+
+        ids = ExcelScanResults()
+        ids.assigned_indexes = scan_r.assigned_indexes
+        ids.const_indexes = scan_r.const_indexes
+        ids.next_formula_id = scan_r.next_formula_id
+        ids.next_const_id = scan_r.next_const_id
+        ids.formulas = dict()
+        ids.const = dict()
+        if previous is not None:
+            # cells that went away keep their id in case they come back
+            for t in previous.assigned_indexes:
+                ids.assigned_indexes.setdefault(t, previous.assigned_indexes[t])
+            for t in previous.const_indexes:
+                ids.const_indexes.setdefault(t, previous.const_indexes[t])
+        self._store(ids_path, ids)
+
+        return scan_r
+
+
+    # parsed formulas in the same form as parse.parse_formulas_csv, one
+    # sheet scope at a time. A scope whose formulas (and ids) hash the
+    # same as a previous run is not parsed again. Defined names are part
+    # of the scope they are defined in. The scopes that are parsed go
+    # through cache, a parse_cache.FormulaParseCache, when one is given
+    def parse(self, scan_r, cache=None):
+
+        formulas_parsed = []
+        self.scope_keys = dict()
+
+        for scope in scan_r.formulas:
+            rows = formula_rows(scan_r, scope)
+            key = digest([CACHE_VERSION, PARSER_VERSION, scope, [(r["formula_id"], r["cell_or_name"], r["formula"], r["ref"]) for r in rows]])
+            self.scope_keys[scope] = key
+            path = self._path("parsed", key)
+
+            parsed = self._load(path)
+            if parsed is not None:
+                self.stats["scopes_reused"] = self.stats["scopes_reused"] + 1
+            else:
+                parsed = parse_formula_rows(rows, cache=cache)
+                self._store(path, parsed)
+                self.stats["scopes_parsed"] = self.stats["scopes_parsed"] + 1
+                self.stats["formulas_parsed"] = self.stats["formulas_parsed"] + len(rows)
+
+            formulas_parsed.extend(parsed)
+
+        return formulas_parsed
+
+
+    # the module source from ast_to_python, with the code of the formulas
+    # of a sheet scope coming out of the cache when neither the scope nor
+    # what its code looks up changed. What a scope looks up only depends
+    # on its formulas, so that is kept too. Needs parse to have been
+    # called first for the scope keys
+    def generate_code(self, formulas_parsed, program_info, graph=None):
+
+        prepare_program(formulas_parsed, program_info, graph)
+
+        by_scope = dict()
+        for formula_obj in formulas_parsed:
+            if formula_obj["sheet"] not in by_scope:
+                by_scope[formula_obj["sheet"]] = []
+            by_scope[formula_obj["sheet"]].append(formula_obj)
+
+        chunks = []
+        for scope in by_scope:
+            reads_path = self._path("reads", digest([CACHE_VERSION, CODEGEN_VERSION, self.scope_keys[scope]]))
+            reads = self._load(reads_path)
+            if reads is None:
+                reads = []
+                for formula_obj in by_scope[scope]:
+                    reads.extend(formula_reads(formula_obj))
+                self._store(reads_path, reads)
+
+            key = digest([CACHE_VERSION, CODEGEN_VERSION, self.scope_keys[scope], program_info.lookups(reads)])
+            path = self._path("code", key)
+
+            # (code, ranges the code calls), the ranges get registered again
+            # so their functions are generated
+            cached = self._load(path)
+            if cached is not None:
+                code, ranges = cached
+                program_info.ranges_used.update(ranges)
+                self.stats["code_reused"] = self.stats["code_reused"] + 1
+            else:
+                parts = []
+                for formula_obj in by_scope[scope]:
+                    parts.append(formula_to_python_function(formula_obj, program_info))
+                    parts.append("\n")
+                code = "".join(parts)
+                ranges = dict()
+                for func_name in set(RANGE_CALL.findall(code)):
+                    if func_name in program_info.ranges_used:  # not just text in a string
+                        ranges[func_name] = program_info.ranges_used[func_name]
+                self._store(path, (code, ranges))
+                self.stats["code_generated"] = self.stats["code_generated"] + 1
+
+            chunks.append(code)
+
+        return module_source(program_info, "".join(chunks))
+
+
+
+# rows like the ones in excel_formulas.csv for one scope of a scan
+def formula_rows(scan_r, scope):
+    rows = []
+    for nm in scan_r.formulas[scope]:
+        t = (scope, nm)
+        rows.append({
+            "formula_id" : scan_r.assigned_indexes[t],
+            "sheet" : scope,
+            "cell_or_name" : nm,
+            "formula" : scan_r.formulas[scope][nm],
+            "ref" : scan_r.formula_ranges.get(t),
+        })
+    return rows
+
+
+
+def digest(obj):
+    return hashlib.sha256(repr(obj).encode("utf-8")).hexdigest()
@@ -0,0 +1,427 @@
+
+# binary version of the intermediate files (excel_formulas.csv and
+# excel_constants.csv). The file is memory mapped when read, and any
+# formula_id / const_id can be looked up without reading the rest.
+#
+# layout, all little endian, every section starts 8 byte aligned:
+#
+#   header      magic, version, kind, counts and section offsets
+#   strings     interned sheet names: u64 offsets[nstrings + 1], then utf-8
+#   columns     one array per column, count entries each
+#                 ids u32, sheet u32 (string index), name off u64 / len u32
+#               formulas:  formula off u64 / len u32, ref off u64 / len u32
+#               constants: type u8, int i64, float f64, text off u64 / len u32
+#   id table    u32[max_id + 1], id -> row, EMPTY_SLOT where there is no row
+#   blob        utf-8 text the off/len columns point into
+
+import array
+import csv
+import datetime
+import itertools
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+
+MAGIC = b"TTINTER1"
+VERSION = 1
+
+FORMULAS_KIND = 1
+CONSTANTS_KIND = 2
+
+EMPTY_SLOT = 0xFFFFFFFF
+
+# constant type tags
+CONST_INT = 1
+CONST_FLOAT = 2
+CONST_BOOL = 3
+CONST_TEXT = 4
+CONST_DATETIME = 5
+CONST_DATE = 6
+CONST_TIME = 7
+
+HEADER = struct.Struct("<8sHHIIIQQQQQ")
+
+INT64_MIN = -(2 ** 63)
+INT64_MAX = 2 ** 63 - 1
+
+
+
+# utf-8 text for the off/len columns. Strings are added a column at a
+# time, which is a lot quicker than one at a time
+class TextBlob:
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    # appends the strings and fills in their offset and length columns
+    def add_column(self, strs, off_col, len_col):
+        encoded = list(map(str.encode, strs))
+        lengths = array.array("I", map(len, encoded))
+        offsets = array.array("Q", itertools.accumulate(lengths, initial=self.size))
+        offsets.pop()
+        self.size = self.size + sum(lengths)
+        self.parts.append(b"".join(encoded))
+        off_col.extend(offsets)
+        len_col.extend(lengths)
+
+    def tobytes(self):
+        return b"".join(self.parts)
+
+
+
+class StringTable:
+
+    def __init__(self):
+        self.index = dict()
+        self.strings = []
+
+    def intern(self, s):
+        idx = self.index.get(s)
+        if idx is None:
+            idx = len(self.strings)
+            self.index[s] = idx
+            self.strings.append(s)
+        return idx
+
+    def tobytes(self):
+        offsets = array.array("Q")
+        blob = []
+        off = 0
+        for s in self.strings:
+            offsets.append(off)
+            data = s.encode("utf-8")
+            blob.append(data)
+            off = off + len(data)
+        offsets.append(off)
+        return array_bytes(offsets) + b"".join(blob)
+
+
+
+def array_bytes(arr):
+    if sys.byteorder != "little":
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+
+def pad8(n):
+    return (8 - n % 8) % 8
+
+
+
+def write_sections(path, kind, count, max_id, strings, columns, id_table, blob):
+
+    sections = [strings.tobytes()]
+    for col in columns:
+        sections.append(array_bytes(col))
+    sections.append(array_bytes(id_table))
+    sections.append(blob.tobytes())
+
+    offsets = []
+    pos = HEADER.size + pad8(HEADER.size)
+    for data in sections:
+        offsets.append(pos)
+        pos = pos + len(data) + pad8(len(data))
+
+    strings_off = offsets[0]
+    columns_off = offsets[1]
+    id_table_off = offsets[-2]
+    blob_off = offsets[-1]
+
+    # write to a temporary name and move it into place, so a reader never
+    # sees half a file. The name is made unique, two writers of the same
+    # path would write over each other's temporary file otherwise
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + "." + str(os.getpid()) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION, kind, count, max_id, len(strings.strings),
+                                 strings_off, columns_off, id_table_off, blob_off, len(sections[-1])))
+            fp.write(b"\0" * pad8(HEADER.size))
+            for data in sections:
+                fp.write(data)
+                fp.write(b"\0" * pad8(len(data)))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+
+def build_id_table(ids):
+    max_id = max(ids) if len(ids) > 0 else 0
+    id_table = array.array("I", [EMPTY_SLOT]) * (max_id + 1)
+    for row, _id in enumerate(ids):
+        id_table[_id] = row
+    return max_id, id_table
+
+
+
+def write_formulas(scan_r, path):
+    strings = StringTable()
+    blob = TextBlob()
+
+    ids = array.array("I")
+    sheets = array.array("I")
+    name_off = array.array("Q")
+    name_len = array.array("I")
+    formula_off = array.array("Q")
+    formula_len = array.array("I")
+    ref_off = array.array("Q")
+    ref_len = array.array("I")
+
+    for scope in scan_r.formulas:
+        formulas = scan_r.formulas[scope]
+        if len(formulas) == 0:
+            continue
+        names = list(formulas)
+        keys = [(scope, nm) for nm in names]
+        ids.extend(map(scan_r.assigned_indexes.__getitem__, keys))
+        sheets.extend([strings.intern(scope)] * len(names))
+        blob.add_column(names, name_off, name_len)
+        blob.add_column(list(map(str, formulas.values())), formula_off, formula_len)
+        if len(scan_r.formula_ranges) > 0:
+            blob.add_column([scan_r.formula_ranges.get(t, "") for t in keys], ref_off, ref_len)
+        else:
+            ref_off.extend([0] * len(names))
+            ref_len.extend([0] * len(names))
+
+    max_id, id_table = build_id_table(ids)
+    columns = [ids, sheets, name_off, name_len, formula_off, formula_len, ref_off, ref_len]
+    write_sections(path, FORMULAS_KIND, len(ids), max_id, strings, columns, id_table, blob)
+
+
+
+def write_constants(scan_r, path):
+    strings = StringTable()
+    blob = TextBlob()
+
+    ids = array.array("I")
+    sheets = array.array("I")
+    name_off = array.array("Q")
+    name_len = array.array("I")
+    types = array.array("B")
+    ints = array.array("q")
+    floats = array.array("d")
+    text_off = array.array("Q")
+    text_len = array.array("I")
+
+    for scope in scan_r.const:
+        consts = scan_r.const[scope]
+        if len(consts) == 0:
+            continue
+        names = list(consts)
+        ids.extend(scan_r.const_indexes[(scope, nm)] for nm in names)
+        sheets.extend([strings.intern(scope)] * len(names))
+        blob.add_column(names, name_off, name_len)
+
+        texts = []
+        for nm in names:
+            tag, i, f, s = encode_const(consts[nm])
+            types.append(tag)
+            ints.append(i)
+            floats.append(f)
+            texts.append(s)
+        blob.add_column(texts, text_off, text_len)
+
+    max_id, id_table = build_id_table(ids)
+    columns = [ids, sheets, name_off, name_len, types, ints, floats, text_off, text_len]
+    write_sections(path, CONSTANTS_KIND, len(ids), max_id, strings, columns, id_table, blob)
+
+
+
+# (type tag, int column, float column, text column) for a constant
+def encode_const(value):
+    if isinstance(value, bool):
+        return CONST_BOOL, int(value), 0.0, ""
+    elif isinstance(value, int):
+        if INT64_MIN <= value <= INT64_MAX:
+            return CONST_INT, value, 0.0, ""
+        return CONST_FLOAT, 0, float(value), ""
+    elif isinstance(value, float):
+        return CONST_FLOAT, 0, value, ""
+    elif isinstance(value, datetime.datetime):
+        return CONST_DATETIME, 0, 0.0, value.isoformat()
+    elif isinstance(value, datetime.date):
+        return CONST_DATE, 0, 0.0, value.isoformat()
+    elif isinstance(value, datetime.time):
+        return CONST_TIME, 0, 0.0, value.isoformat()
+    else:
+        return CONST_TEXT, 0, 0.0, str(value)
+
+
+
+def decode_const(tag, i, f, s):
+    if tag == CONST_INT:
+        return i
+    elif tag == CONST_FLOAT:
+        return f
+    elif tag == CONST_BOOL:
+        return bool(i)
+    elif tag == CONST_DATETIME:
+        return datetime.datetime.fromisoformat(s)
+    elif tag == CONST_DATE:
+        return datetime.date.fromisoformat(s)
+    elif tag == CONST_TIME:
+        return datetime.time.fromisoformat(s)
+    else:
+        return s
+
+
+
+# memory mapped reader for either kind of file. Rows come back as dicts
+# with the same keys as the csv version of the file, but with typed
+# values (ids are ints, constants keep their type)
+class IntermediateFile:
+
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise Exception("Reading intermediate files on a big endian machine is not supported")
+
+        self.path = path
+        self.fp = open(path, "rb")
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+
+        (magic, version, kind, count, max_id, nstrings,
+         strings_off, columns_off, id_table_off, blob_off, blob_size) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise Exception("Not an intermediate file (or a different version) " + str(path))
+
+        self.kind = kind
+        self.count = count
+        self.max_id = max_id
+
+        # sheet names are few, decode them all up front
+        offsets = self.view[strings_off:strings_off + 8 * (nstrings + 1)].cast("Q")
+        base = strings_off + 8 * (nstrings + 1)
+        self.strings = [bytes(self.view[base + offsets[k]:base + offsets[k + 1]]).decode("utf-8") for k in range(nstrings)]
+        offsets.release()
+
+        if kind == FORMULAS_KIND:
+            layout = ["I", "I", "Q", "I", "Q", "I", "Q", "I"]
+        else:
+            layout = ["I", "I", "Q", "I", "B", "q", "d", "Q", "I"]
+
+        self.columns = []
+        pos = columns_off
+        for typecode in layout:
+            size = struct.calcsize(typecode) * count
+            self.columns.append(self.view[pos:pos + size].cast(typecode))
+            pos = pos + size + pad8(size)
+
+        self.id_table = self.view[id_table_off:id_table_off + 4 * (max_id + 1)].cast("I")
+        self.blob_off = blob_off
+
+
+    def close(self):
+        if getattr(self, "columns", None) is not None:
+            for col in self.columns:
+                col.release()
+            self.id_table.release()
+            self.columns = None
+        if getattr(self, "view", None) is not None:
+            self.view.release()
+            self.view = None
+        if getattr(self, "mm", None) is not None:
+            self.mm.close()
+            self.mm = None
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+
+    def text(self, off, n):
+        start = self.blob_off + off
+        return str(self.view[start:start + n], "utf-8")
+
+
+    def row_for_id(self, _id):
+        if _id < 0 or _id > self.max_id or self.id_table[_id] == EMPTY_SLOT:
+            return None
+        return self.id_table[_id]
+
+
+    def row(self, k):
+        cols = self.columns
+        sheet = self.strings[cols[1][k]]
+        name = self.text(cols[2][k], cols[3][k])
+        if self.kind == FORMULAS_KIND:
+            ref = self.text(cols[6][k], cols[7][k])
+            return {
+                "formula_id" : cols[0][k],
+                "sheet" : sheet,
+                "cell_or_name" : name,
+                "formula" : self.text(cols[4][k], cols[5][k]),
+                "ref" : ref if ref != "" else None,
+            }
+        else:
+            return {
+                "const_id" : cols[0][k],
+                "sheet" : sheet,
+                "cell_or_name" : name,
+                "value" : decode_const(cols[4][k], cols[5][k], cols[6][k], self.text(cols[7][k], cols[8][k])),
+            }
+
+
+    # random access by formula_id / const_id, None if there is no such id
+    def get(self, _id):
+        k = self.row_for_id(_id)
+        if k is None:
+            return None
+        return self.row(k)
+
+
+    def __iter__(self):
+        if self.kind != FORMULAS_KIND:
+            for k in range(self.count):
+                yield self.row(k)
+            return
+
+        # the common case of reading every formula, kept tight
+        mm = self.mm
+        base = self.blob_off
+        strings = self.strings
+        ids, sheets, name_off, name_len, formula_off, formula_len, ref_off, ref_len = self.columns
+        for k in range(self.count):
+            a = base + name_off[k]
+            b = base + formula_off[k]
+            ref = None
+            if ref_len[k] > 0:
+                c = base + ref_off[k]
+                ref = mm[c:c + ref_len[k]].decode("utf-8")
+            yield {
+                "formula_id" : ids[k],
+                "sheet" : strings[sheets[k]],
+                "cell_or_name" : mm[a:a + name_len[k]].decode("utf-8"),
+                "formula" : mm[b:b + formula_len[k]].decode("utf-8"),
+                "ref" : ref,
+            }
+
+
+    # the csv version of the file, for looking at while debugging
+    def to_csv(self, csv_path):
+        with open(csv_path, "w", newline="") as fp:
+            wr = csv.writer(fp)
+            if self.kind == FORMULAS_KIND:
+                wr.writerow(["formula_id", "sheet", "cell_or_name", "formula", "ref"])
+                for r in self:
+                    wr.writerow([r["formula_id"], r["sheet"], r["cell_or_name"], r["formula"], r["ref"] or ""])
+            else:
+                wr.writerow(["const_id", "sheet", "cell_or_name", "value"])
+                for r in self:
+                    wr.writerow([r["const_id"], r["sheet"], r["cell_or_name"], r["value"]])
@@ -0,0 +1,180 @@
+
+# works out the formulas by walking their ASTs, with the same runtime.py
+# semantics as the generated code. Slower than the generated module (it
+# looks at every node each time), but needs no code generation, so it is
+# what the generated code is checked against and compared with.
+#
+#   interp = FormulaInterpreter(formulas_parsed, program_info)
+#   results = interp.calculate()   # (sheet, cell or name) -> value
+
+from .ast_to_python import prepare_program, formula_cells
+from .graph import range_side, range_rect
+from .parse import IRError, shift_ast
+from .refs import parse_cell_ref, format_cell_ref, split_coordinate
+from .runtime import BINARY_OPERATORS, UNARY_OPERATORS, FUNCTIONS, CellRange, ExcelError, condition, function_key, takes_arguments, error, NA_ERROR, NAME_ERROR, VALUE_ERROR
+
+
+
+class FormulaInterpreter:
+
+    # program_info has the constants, prepare_program is run on it here
+    def __init__(self, formulas_parsed, program_info, graph=None):
+        self.program_info = program_info
+        self.inputs = dict(program_info.program_constants)
+        self.values = dict()
+        self.asts = dict()  # function name -> (sheet, AST)
+        self.keys = dict()  # function name -> (sheet, cell or name)
+        self.cycle = None  # circular reference of the formula being worked out
+        prepare_program(formulas_parsed, program_info, graph)
+
+        for formula_obj in formulas_parsed:
+            sheet = formula_obj["sheet"]
+            master = formula_obj["name"]
+            nodes = formula_obj["parsed"]
+            shared = formula_obj.get("ref") is not None and parse_cell_ref(master) is not None
+            if shared:
+                mcol, mrow = split_coordinate(master)
+            for cell in formula_cells(formula_obj):
+                func_name = program_info.get_func_name_for(sheet, cell)
+                if nodes is not None and shared and cell != master:
+                    col, row = split_coordinate(cell)
+                    self.asts[func_name] = (sheet, shift_ast(nodes, row - mrow, col - mcol))
+                else:
+                    self.asts[func_name] = (sheet, nodes)
+                self.keys[func_name] = (sheet, cell)
+
+
+    def set_input(self, sheet, cell, value):
+        self.inputs[(sheet, cell)] = value
+        self.values.clear()
+
+
+    def get_value(self, sheet, cell):
+        func_name = self.program_info.find_func_name_for(sheet, cell)
+        if func_name is None:
+            return self.inputs.get((sheet, cell))
+        return self.formula_value(func_name)
+
+
+    # same as the calculate() of the generated module
+    def calculate(self):
+        self.values.clear()
+        for func_name in self.program_info.order:
+            self.formula_value(func_name)
+        return dict((self.keys[func_name], self.formula_value(func_name)) for func_name in self.keys)
+
+
+    def formula_value(self, func_name):
+        if func_name in self.values:
+            return self.values[func_name]
+        outer = self.cycle
+        self.cycle = self.program_info.cyclic.get(func_name)
+        if self.cycle is not None:
+            self.values[func_name] = 0
+        sheet, nodes = self.asts[func_name]
+        v = None if nodes is None else self.evaluate(nodes)
+        self.values[func_name] = v
+        self.cycle = outer
+        return v
+
+
+    # the same as ExpressionGenerator.on_cycle, these read 0
+    def on_cycle(self, func_name):
+        return self.cycle is not None and self.program_info.cyclic.get(func_name) == self.cycle
+
+
+    def evaluate(self, node):
+        t = node.nodetype()
+
+        if t == "constant":
+            if isinstance(node, IRError):
+                return error(node.get_value())
+            return node.get_value()
+
+        elif t == "variable":
+            sheet = node.get_sheet_scope()
+            if parse_cell_ref(node.get_varname()) is None:
+                func_name = self.program_info.resolve_name(sheet, node.get_varname())
+                if func_name is None:
+                    return NAME_ERROR
+                if self.on_cycle(func_name):
+                    return 0
+                return self.formula_value(func_name)
+            cell = node.get_varname().replace("$", "").upper()
+            if self.on_cycle(self.program_info.find_func_name_for(sheet, cell)):
+                return 0
+            return self.get_value(sheet, cell)
+
+        elif t == "variablerange":
+            return self.range_value(node)
+
+        elif t == "unary":
+            return UNARY_OPERATORS[node.get_operator()](self.evaluate(node.get_node()))
+
+        elif t == "binary":
+            return self.binary_chain(node)
+
+        elif t == "function":
+            return self.call(node)
+
+        raise Exception("dont have the code to evaluate the type " + str(t))
+
+
+    # a chain like A1+A2+...+A1000 is a binary node whose left side is the
+    # rest of the chain, so it is gone down in a loop instead of recursing
+    def binary_chain(self, node):
+        chain = []
+        while node.nodetype() == "binary":
+            chain.append(node)
+            node = node.get_left()
+        v = self.evaluate(node)
+        for binary in reversed(chain):
+            v = BINARY_OPERATORS[binary.get_operator()](v, self.evaluate(binary.get_right()))
+        return v
+
+
+    def range_value(self, node):
+        sheet = node.get_sheet_scope()
+        first = range_side(node.get_varname1())
+        last = range_side(node.get_varname2())
+        if first is None or last is None:
+            return VALUE_ERROR
+        rect = range_rect(first[0], first[1], last[0], last[1], (first[2], first[3], last[2], last[3]), 0, 0)
+        if rect is None:
+            return error("#REF!")
+        key = ("range", sheet, rect)
+        if key in self.values:
+            return self.values[key]
+        c1, r1, c2, r2 = rect
+        cells = []
+        for row, col, cell in self.program_info.cells_in(sheet, c1, r1, c2, r2):
+            cells.append((row - r1, col - c1, self.get_value(sheet, cell)))
+        v = CellRange(r2 - r1 + 1, c2 - c1 + 1, cells)
+        self.values[key] = v
+        return v
+
+
+    def call(self, node):
+        name = function_key(node.get_func_name())
+        params = node.get_params()
+
+        # the lazy ones, like the conditional expressions of the generated code
+        if name == "IF" and 1 <= len(params) <= 3:
+            c = condition(self.evaluate(params[0]))
+            if c is True:
+                return self.evaluate(params[1]) if len(params) > 1 else True
+            if c is False:
+                return self.evaluate(params[2]) if len(params) > 2 else False
+            return c
+        if name == "IFERROR" and len(params) == 2:
+            v = self.evaluate(params[0])
+            return self.evaluate(params[1]) if type(v) is ExcelError else v
+        if name == "IFNA" and len(params) == 2:
+            v = self.evaluate(params[0])
+            return self.evaluate(params[1]) if v == NA_ERROR else v
+
+        if name is None:
+            return NAME_ERROR
+        if not takes_arguments(name, len(params)):
+            return VALUE_ERROR
+        return FUNCTIONS[name](*[self.evaluate(p) for p in params])
@@ -0,0 +1,369 @@
+
+# hand written lexer for excel formulas. It goes over the text once,
+# picking what to do from the first character, instead of trying every
+# rule's regex at every position like the lexit based ExcelFormulaLexer.
+#
+# There are two modes:
+#
+# lex_compat(text) gives the exact same tokens as ExcelFormulaLexer.lex,
+#   strings and quoted sheet names come out a piece at a time
+#
+# tokenize(text) gives finished tokens for the parser. Whitespace is
+#   dropped and these come out as a single token each:
+#     STRING     "a ""b"""  -> value a "b"
+#     SHEET      'my sheet'! or Sheet1!  -> value is the sheet name
+#     CELLNAME   $A$1
+#     RANGE      A1:B2, A:C, 1:3
+#     NUMBER     1.5e3, without a sign, - is always SUB
+#     BOOL       TRUE / FALSE (not when called like a function)
+#     ERROR      #REF!, #DIV/0!, #N/A, ...
+#     PERCENT    %
+#   the operators and brackets keep the type names ExcelFormulaLexer uses
+
+import re
+from collections import namedtuple
+
+from .refs import column_to_index, MAX_COL, MAX_ROW
+
+
+# same fields as lexit's Token so they compare equal
+Token = namedtuple("Token", ["type", "value", "line", "column"])
+
+
+
+class FormulaLexError(Exception):
+
+    def __init__(self, message, text, line, column):
+        super().__init__(message + " in line " + str(line) + " column " + str(column) + " of " + str(text))
+        self.message = message
+        self.text = text
+        self.line = line
+        self.column = column
+
+
+
+# the regexes of ExcelFormulaLexer that can match more than one character
+COMPAT_NUMBER_RE = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?')
+COMPAT_CELLNAME_RE = re.compile(r'\$?[A-Za-z]+\$?[0-9]+')
+COMPAT_NAME_RE = re.compile(r'[A-Za-z_][A-Za-z_0-9]*')
+WHITESPACE_RE = re.compile(r'\s+')
+
+COMPAT_SINGLE = {
+    "'" : "SINGLE_QUOTE",
+    '"' : "DBL_QUOTE",
+    "{" : "L_BRACE",
+    "}" : "R_BRACE",
+    "[" : "L_BRACKET",
+    "]" : "R_BRACKET",
+    "(" : "LPAREN",
+    ")" : "RPAREN",
+    "," : "COMMA",
+    ":" : "COLON",
+    "+" : "ADD",
+    "*" : "MUL",
+    "/" : "DIV",
+    "=" : "EQUALS_SIGN",
+    "^" : "CARROT",
+    "&" : "AMPERSAND",
+}
+
+IDENT_START = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_$")
+DIGITS = set("0123456789")
+
+
+
+# token for token the same as list(ExcelFormulaLexer.lex(text)). lexit
+# takes the longest match of all its rules and the earlier rule on a tie,
+# which is why TRUE lexes as NAME and LOG10 as CELLNAME
+def lex_compat(text):
+    tokens = []
+    append = tokens.append
+    n = len(text)
+    idx = 0
+    line = 1
+    line_start = 0
+
+    while idx < n:
+        ch = text[idx]
+        column = idx - line_start + 1
+
+        t = COMPAT_SINGLE.get(ch)
+        if t is not None:
+            append(Token(t, ch, line, column))
+            idx = idx + 1
+
+        elif ch in IDENT_START:
+            cm = COMPAT_CELLNAME_RE.match(text, idx)
+            nm = COMPAT_NAME_RE.match(text, idx) if ch != "$" else None
+            if cm is not None and (nm is None or cm.end() >= nm.end()):
+                append(Token("CELLNAME", cm.group(), line, column))
+                idx = cm.end()
+            elif nm is not None:
+                append(Token("NAME", nm.group(), line, column))
+                idx = nm.end()
+            else:
+                append(Token("DOLLAR_SIGN", ch, line, column))
+                idx = idx + 1
+
+        elif ch in DIGITS or ch == "-":
+            m = COMPAT_NUMBER_RE.match(text, idx)
+            if m is not None:
+                append(Token("NUMBER", m.group(), line, column))
+                idx = m.end()
+            else:
+                append(Token("SUB", ch, line, column))
+                idx = idx + 1
+
+        elif ch == "<":
+            nxt = text[idx + 1:idx + 2]
+            if nxt == ">":
+                append(Token("NOT_EQUALS_SIGN", "<>", line, column))
+                idx = idx + 2
+            elif nxt == "=":
+                append(Token("LESS_THAN_EQUAL", "<=", line, column))
+                idx = idx + 2
+            else:
+                append(Token("LESS_THAN", ch, line, column))
+                idx = idx + 1
+
+        elif ch == ">":
+            if text[idx + 1:idx + 2] == "=":
+                append(Token("GREATER_THAN_EQUAL", ">=", line, column))
+                idx = idx + 2
+            else:
+                append(Token("GREATER_THAN", ch, line, column))
+                idx = idx + 1
+
+        elif ch == "!":
+            if text.startswith("!#REF!", idx):
+                append(Token("REF", "!#REF!", line, column))
+                idx = idx + 6
+            else:
+                append(Token("EXCLAIMATION_POINT", ch, line, column))
+                idx = idx + 1
+
+        else:
+            m = WHITESPACE_RE.match(text, idx)
+            if m is None:
+                raise FormulaLexError("No match for character " + repr(ch), text, line, column)
+            value = m.group()
+            append(Token("WHITESPACE", value, line, column))
+            idx = m.end()
+            if "\n" in value:
+                line = line + value.count("\n")
+                line_start = idx - (len(value) - value.rfind("\n") - 1)
+
+    return tokens
+
+
+
+NUMBER_RE = re.compile(r'(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?')
+IDENT_RE = re.compile(r'[A-Za-z_\\][A-Za-z0-9_.\\]*')
+SHEET_NAME_RE = re.compile(r'[A-Za-z0-9_.\\]+')
+ERROR_RE = re.compile(r'#(?:NULL!|DIV/0!|VALUE!|REF!|NAME\?|NUM!|N/A|GETTING_DATA|SPILL!|CALC!)')
+
+# a reference can't run straight into more name characters, and isn't one
+# when it is called like a function (LOG10( )
+REF_END = r'(?![A-Za-z0-9_.(\\])'
+CELL_RE = re.compile(r'\$?([A-Za-z]{1,3})\$?([0-9]+)' + REF_END)
+CELL_RANGE_RE = re.compile(r'\$?([A-Za-z]{1,3})\$?([0-9]+):\$?([A-Za-z]{1,3})\$?([0-9]+)' + REF_END)
+COLUMN_RANGE_RE = re.compile(r'\$?([A-Za-z]{1,3}):\$?([A-Za-z]{1,3})' + REF_END)
+ROW_RANGE_RE = re.compile(r'\$?([0-9]+):\$?([0-9]+)' + REF_END)
+
+SINGLE = {
+    "{" : "L_BRACE",
+    "}" : "R_BRACE",
+    "[" : "L_BRACKET",
+    "]" : "R_BRACKET",
+    "(" : "LPAREN",
+    ")" : "RPAREN",
+    "," : "COMMA",
+    ";" : "SEMICOLON",
+    ":" : "COLON",
+    "+" : "ADD",
+    "-" : "SUB",
+    "*" : "MUL",
+    "/" : "DIV",
+    "=" : "EQUALS_SIGN",
+    "^" : "CARROT",
+    "&" : "AMPERSAND",
+    "%" : "PERCENT",
+    "!" : "EXCLAIMATION_POINT",
+}
+
+SPACES = set(" \t\r\n")
+
+
+def valid_column(letters):
+    return column_to_index(letters) <= MAX_COL
+
+
+def valid_row(digits):
+    return 1 <= int(digits) <= MAX_ROW
+
+
+
+# finished tokens for the parser, see the top of the file
+def tokenize(text):
+    tokens = []
+    append = tokens.append
+    n = len(text)
+    idx = 0
+    line = 1
+    line_start = 0
+
+    while idx < n:
+        ch = text[idx]
+        column = idx - line_start + 1
+
+        if ch in SPACES:
+            if ch == "\n":
+                line = line + 1
+                line_start = idx + 1
+            idx = idx + 1
+            continue
+
+        if ch in IDENT_START or ch == "\\":
+            if ch != "$":
+                m = IDENT_RE.match(text, idx)
+                end = m.end()
+                if end < n and text[end] == "!":
+                    append(Token("SHEET", m.group(), line, column))
+                    idx = end + 1
+                    continue
+
+            m = CELL_RANGE_RE.match(text, idx)
+            if m is not None and valid_column(m.group(1)) and valid_row(m.group(2)) and valid_column(m.group(3)) and valid_row(m.group(4)):
+                append(Token("RANGE", m.group(), line, column))
+                idx = m.end()
+                continue
+
+            m = COLUMN_RANGE_RE.match(text, idx)
+            if m is not None and valid_column(m.group(1)) and valid_column(m.group(2)):
+                append(Token("RANGE", m.group(), line, column))
+                idx = m.end()
+                continue
+
+            m = CELL_RE.match(text, idx)
+            if m is not None and valid_column(m.group(1)) and valid_row(m.group(2)):
+                append(Token("CELLNAME", m.group(), line, column))
+                idx = m.end()
+                continue
+
+            if ch == "$":
+                m = ROW_RANGE_RE.match(text, idx)
+                if m is not None and valid_row(m.group(1)) and valid_row(m.group(2)):
+                    append(Token("RANGE", m.group(), line, column))
+                    idx = m.end()
+                    continue
+                raise FormulaLexError("$ not part of a reference", text, line, column)
+
+            m = IDENT_RE.match(text, idx)
+            value = m.group()
+            idx = m.end()
+            upper = value.upper()
+            if (upper == "TRUE" or upper == "FALSE") and next_char(text, idx) != "(":
+                append(Token("BOOL", upper, line, column))
+            else:
+                append(Token("NAME", value, line, column))
+            continue
+
+        if ch in DIGITS or ch == ".":
+            m = ROW_RANGE_RE.match(text, idx)
+            if m is not None and valid_row(m.group(1)) and valid_row(m.group(2)):
+                append(Token("RANGE", m.group(), line, column))
+                idx = m.end()
+                continue
+
+            m = NUMBER_RE.match(text, idx)
+            if m is None:
+                raise FormulaLexError("No match for character " + repr(ch), text, line, column)
+            append(Token("NUMBER", m.group(), line, column))
+            idx = m.end()
+            continue
+
+        if ch == '"':
+            value, end = read_quoted(text, idx, '"')
+            if end < 0:
+                raise FormulaLexError("Unterminated string", text, line, column)
+            append(Token("STRING", value, line, column))
+            if "\n" in text[idx:end]:
+                line = line + text.count("\n", idx, end)
+                line_start = text.rfind("\n", idx, end) + 1
+            idx = end
+            continue
+
+        if ch == "'":
+            value, end = read_quoted(text, idx, "'")
+            if end < 0:
+                raise FormulaLexError("Unterminated sheet name", text, line, column)
+            if end >= n or text[end] != "!":
+                raise FormulaLexError("Quoted sheet name without !", text, line, column)
+            append(Token("SHEET", value, line, column))
+            idx = end + 1
+            continue
+
+        if ch == "<":
+            nxt = text[idx + 1:idx + 2]
+            if nxt == ">":
+                append(Token("NOT_EQUALS_SIGN", "<>", line, column))
+                idx = idx + 2
+            elif nxt == "=":
+                append(Token("LESS_THAN_EQUAL", "<=", line, column))
+                idx = idx + 2
+            else:
+                append(Token("LESS_THAN", ch, line, column))
+                idx = idx + 1
+            continue
+
+        if ch == ">":
+            if text[idx + 1:idx + 2] == "=":
+                append(Token("GREATER_THAN_EQUAL", ">=", line, column))
+                idx = idx + 2
+            else:
+                append(Token("GREATER_THAN", ch, line, column))
+                idx = idx + 1
+            continue
+
+        if ch == "#":
+            m = ERROR_RE.match(text, idx)
+            if m is None:
+                raise FormulaLexError("Unknown error value", text, line, column)
+            append(Token("ERROR", m.group(), line, column))
+            idx = m.end()
+            continue
+
+        t = SINGLE.get(ch)
+        if t is None:
+            raise FormulaLexError("No match for character " + repr(ch), text, line, column)
+        append(Token(t, ch, line, column))
+        idx = idx + 1
+
+    return tokens
+
+
+
+# text between the quote at start and its closing quote, with doubled
+# quotes collapsed. Returns (value, index after the closing quote), the
+# index is -1 when the quote is never closed
+def read_quoted(text, start, quote):
+    parts = []
+    i = start + 1
+    while True:
+        j = text.find(quote, i)
+        if j < 0:
+            return None, -1
+        parts.append(text[i:j])
+        if text[j + 1:j + 2] == quote:
+            parts.append(quote)
+            i = j + 2
+        else:
+            return "".join(parts), j + 1
+
+
+
+def next_char(text, idx):
+    n = len(text)
+    while idx < n and text[idx] in SPACES:
+        idx = idx + 1
+    return text[idx] if idx < n else ""
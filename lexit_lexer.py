@@ -0,0 +1,48 @@
+
+# the lexit based lexer the parser was first written with. parse.py uses 
+# lexer.tokenize now, this is kept to check lexer.py gives the same tokens 
+# (test/bench_lexer.py). Only imported when asked for, so parsing doesn't 
+# need lexit installed 
+
+from lexit import Lexer
+
+
+# this is not the most correct way to do this, but I referred to these repos while making this:
+# - https://github.com/spreadsheetlab/XLParser
+# - 
+    
+
+# need to post process the tokens for handling strings, 
+# prob not setup the best 
+class ExcelFormulaLexer(Lexer):
+    NUMBER = r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?'
+    SINGLE_QUOTE = '\''
+    DBL_QUOTE = '\"'
+    CELLNAME = r'(\$?)[A-Za-z]([A-Za-z])*(\$?)([0-9])+'  # this just ends with numbers instead 
+    NAME = r'[A-Za-z_]([A-Za-z_0-9])*'   # this can have letters and numbers intermixed 
+    WHITESPACE = r'\s+'
+    L_BRACE = r'{'
+    R_BRACE = r'}'
+    L_BRACKET = r'\['
+    R_BRACKET = r'\]'
+    TRUE = r'TRUE'
+    FALSE = r'FALSE'
+    LPAREN = '\('
+    RPAREN = '\)'
+    EXCLAIMATION_POINT = '\!'
+    COMMA = r','
+    COLON = r':'
+    ADD = '\+'
+    SUB = '-'
+    MUL = '\*'
+    DIV = '/'
+    EQUALS_SIGN = '='
+    NOT_EQUALS_SIGN = '<>'
+    LESS_THAN_EQUAL = '<='
+    LESS_THAN = '<'
+    GREATER_THAN_EQUAL = '>='
+    GREATER_THAN = '>'
+    CARROT = '\^'
+    AMPERSAND = '\&'
+    REF= "!#REF!"
+    DOLLAR_SIGN = '\$'
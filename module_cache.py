@@ -0,0 +1,196 @@
+
+# compiled models kept on disk so a process that needs one doesn't scan,
+# parse and generate the workbook again. An entry is a folder named by a
+# hash of the workbook bytes, the generator version, the python bytecode
+# version and the build options, holding
+#   code.py          the generated source
+#   code.bin         its compiled bytecode (marshal)
+#   constants.pickle the constant pool, program_info.program_constants
+# An entry is written in a temporary folder and renamed into place, so
+# workers sharing the folder see a whole entry or none. Two workers that
+# build the same entry at once both rename, the second finds it there and
+# throws its own away
+#
+#   cache = ModuleCache("workspace/module_cache")
+#   module = cache.load_or_build("model.xlsx", "workspace", outputs=[("Sheet1", "B2")])
+#   module.calculate()
+
+import hashlib
+import importlib.util
+import marshal
+import os
+import pickle
+import shutil
+import tempfile
+import types
+
+from .ast_to_python import CODEGEN_VERSION
+
+
+# bump when what is stored in an entry changes
+CACHE_VERSION = 1
+
+# the build options that change the generated code, the others (backend,
+# workers, report_every, ...) only change how it is worked out
+CODE_OPTIONS = ["straight_line", "optimize", "inputs", "outputs"]
+
+SOURCE_FILE = "code.py"
+BYTECODE_FILE = "code.bin"
+CONSTANTS_FILE = "constants.pickle"
+
+# the generated code imports the runtime by the package name
+PACKAGE = __name__.rsplit(".", 1)[0]
+
+
+
+class ModuleCache:
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        self.stats = {
+            "hits" : 0,
+            "misses" : 0,
+            "stored" : 0,
+            "lost_races" : 0,
+        }
+
+
+    # the entry of a workbook built with these options
+    def key(self, input_excel, **build_options):
+        options = [(name, build_options.get(name)) for name in CODE_OPTIONS]
+        return digest_parts([
+            repr([CACHE_VERSION, CODEGEN_VERSION, PACKAGE, options]).encode("utf-8"),
+            importlib.util.MAGIC_NUMBER,
+            file_digest(input_excel).encode("ascii"),
+        ])
+
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self.entry_path(key), BYTECODE_FILE))
+
+
+    # the module of an entry run from its bytecode, None if there is no
+    # entry (or it can't be read, it gets built again then)
+    def load(self, key):
+        module = self._run(key)
+        if module is None:
+            self.stats["misses"] = self.stats["misses"] + 1
+        else:
+            self.stats["hits"] = self.stats["hits"] + 1
+        return module
+
+    def _run(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(os.path.join(path, BYTECODE_FILE), "rb") as fp:
+                code = marshal.loads(fp.read())  # marshal.load reads a file a few bytes at a time
+        except Exception:
+            return None
+
+        module = types.ModuleType("cached_model_" + key[:16])
+        module.__file__ = os.path.join(path, SOURCE_FILE)
+        exec(code, module.__dict__)
+        return module
+
+
+    def load_constants(self, key):
+        with open(os.path.join(self.entry_path(key), CONSTANTS_FILE), "rb") as fp:
+            return pickle.load(fp)
+
+
+    # compiles the source and publishes the entry. Returns False when
+    # another worker stored the same entry first, which is just as good
+    def store(self, key, source, program_constants):
+        path = self.entry_path(key)
+        if self.has(key):
+            self.stats["lost_races"] = self.stats["lost_races"] + 1
+            return False
+
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        try:
+            code = compile(source, os.path.join(path, SOURCE_FILE), "exec")
+            with open(os.path.join(tmp_path, SOURCE_FILE), "w") as fp:
+                fp.write(source)
+            with open(os.path.join(tmp_path, BYTECODE_FILE), "wb") as fp:
+                marshal.dump(code, fp)
+            with open(os.path.join(tmp_path, CONSTANTS_FILE), "wb") as fp:
+                pickle.dump(program_constants, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                if not self.has(key):
+                    raise
+                self.stats["lost_races"] = self.stats["lost_races"] + 1
+                return False
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        self.stats["stored"] = self.stats["stored"] + 1
+        return True
+
+
+    # the module for a workbook, built with pipeline.build (options passed
+    # through) and stored when it isn't in the cache yet. Workers that miss
+    # at once can share a workspace, each builds in a folder of its own in
+    # it that is removed afterwards (the source is kept in the entry)
+    def load_or_build(self, input_excel, workspace, **build_options):
+        key = self.key(input_excel, **build_options)
+        module = self.load(key)
+        if module is not None:
+            return module
+
+        from . import pipeline  # the scanner and parser are only needed on a miss
+
+        os.makedirs(workspace, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix="build." + str(os.getpid()) + ".", dir=workspace)
+        try:
+            build = pipeline.build(input_excel, build_dir, **build_options)
+            with open(build["code_path"]) as fp:
+                source = fp.read()
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        self.store(key, source, build["program_info"].program_constants)
+
+        module = self._run(key)
+        if module is None:
+            raise Exception("Could not load the cached module " + key + " from " + self.cache_dir)
+        return module
+
+
+    # removes the entries that aren't in keep, and the temporary folders
+    # of workers that died while storing, so not while any worker can be
+    # storing
+    def prune(self, keep):
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if name not in keep:
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+                removed = removed + 1
+        return removed
+
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def digest_parts(parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
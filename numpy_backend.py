@@ -0,0 +1,547 @@
+
+# a runtime for evaluating a workbook over many scenarios at once. It has
+# the same names as runtime.py, so the straight line code generator
+# (straight_line.py) can generate a module on top of it, but any value can
+# also be a numpy array with one entry per scenario. An input cell given
+# an array makes the formulas that depend on it arrays, each operator or
+# function is then one numpy operation over all the scenarios, and
+# IF / IFERROR / IFNA are np.where. Formulas that don't depend on an
+# array stay python values and go through runtime.py like before, so they
+# are worked out once and not once per scenario.
+#
+#   code = generate_numpy_module(formulas_parsed, program_info)
+#   ... import it as model
+#   model.set_input("Sheet1", "B2", np.random.normal(0.05, 0.01, 1000000))
+#   results = model.calculate()   # (sheet, cell) -> value or array
+#
+# Arrays are always float64. An error in a scenario is NaN (which error
+# it was is lost, so IFNA catches every error there), and TRUE / FALSE
+# in a scenario are 1 / 0. Text can't change between scenarios, a text
+# function of an array raises an exception instead of working it out
+# one scenario at a time.
+
+import math
+import operator
+
+import numpy as np
+
+from . import runtime
+from .runtime import CellRange, ExcelError, condition, error, function_key, NA_ERROR, NAME_ERROR, VALUE_ERROR
+from .ast_to_python import RUNTIME_IMPORTS
+from .straight_line import SlotExpressionGenerator, generate_straight_module, CHUNK_SIZE
+
+
+# what the generated module imports from here, the runtime.py names and
+# the vectorized IF / IFERROR / IFNA
+NUMPY_IMPORTS = sorted(RUNTIME_IMPORTS + ["where_if", "where_iferror", "where_ifna"])
+
+ndarray = np.ndarray
+nan = math.nan
+
+
+
+# a value as a float64 array or a float, errors (and text that isn't a
+# number) are NaN
+def numbers(v):
+    if type(v) is ndarray:
+        return v if v.dtype == np.float64 else v.astype(np.float64)
+    n = runtime.to_number(v)
+    if type(n) is ExcelError:
+        return nan
+    return float(n)
+
+
+# 1.0 / 0.0 for TRUE / FALSE, NaN stays NaN
+def truth(a):
+    return np.where(np.isnan(a), nan, (a != 0).astype(np.float64))
+
+
+# numbers that aren't finite are errors, like runtime.checked
+def finite(a):
+    return np.where(np.isfinite(a), a, nan)
+
+
+def has_array(args):
+    for a in args:
+        if type(a) is ndarray:
+            return True
+        if type(a) is CellRange:
+            for c in a.cells:
+                if type(c[2]) is ndarray:
+                    return True
+    return False
+
+
+# the arguments without their arrays (ranges keep their other cells) and
+# the arrays, for functions that combine both
+def split_arrays(args):
+    scalars = []
+    arrays = []
+    for a in args:
+        if type(a) is ndarray:
+            arrays.append(numbers(a))
+        elif type(a) is CellRange:
+            cells = []
+            for c in a.cells:
+                if type(c[2]) is ndarray:
+                    arrays.append(numbers(c[2]))
+                else:
+                    cells.append(c)
+            scalars.append(CellRange(a.nrows, a.ncols, cells))
+        else:
+            scalars.append(a)
+    return scalars, arrays
+
+
+
+# operators
+
+# what overflows is #NUM! the same as in runtime.py
+def add(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.add(a, b)
+    with np.errstate(over="ignore", invalid="ignore"):
+        return finite(numbers(a) + numbers(b))
+
+
+def sub(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.sub(a, b)
+    with np.errstate(over="ignore", invalid="ignore"):
+        return finite(numbers(a) - numbers(b))
+
+
+def mul(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.mul(a, b)
+    with np.errstate(over="ignore", invalid="ignore"):
+        return finite(numbers(a) * numbers(b))
+
+
+def div(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.div(a, b)
+    a = numbers(a)
+    b = numbers(b)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(b == 0, nan, a / b)
+
+
+def power(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.power(a, b)
+    a = numbers(a)
+    b = numbers(b)
+    with np.errstate(all="ignore"):
+        # 0^0 is #NUM!, the rest (0^-1, (-8)^0.5, overflow) comes out
+        # of numpy as inf or NaN
+        return finite(np.where((a == 0) & (b == 0), nan, np.power(a, b)))
+
+
+def neg(a):
+    if type(a) is not ndarray:
+        return runtime.neg(a)
+    return -numbers(a)
+
+
+def pos(a):
+    if type(a) is not ndarray:
+        return runtime.pos(a)
+    return a
+
+
+def percent(a):
+    if type(a) is not ndarray:
+        return runtime.percent(a)
+    return numbers(a) / 100
+
+
+def concat(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.concat(a, b)
+    raise Exception("the numpy backend can't make text (&) out of values that change between scenarios")
+
+
+# numbers < text < booleans like runtime.compare. Both sides can't be
+# text here, the array side is numbers (booleans from a comparison are 1
+# / 0, so they compare as numbers)
+def compare_arrays(op, a, b):
+    for v in (a, b):
+        if type(v) is ExcelError:
+            return v
+        if type(v) is CellRange:
+            return VALUE_ERROR
+    ranks = []
+    for v in (a, b):
+        if type(v) is str:
+            ranks.append(1)
+        elif type(v) is bool:
+            ranks.append(2)
+        else:
+            ranks.append(0)
+    a = numbers(a) if ranks[0] != 1 else 0.0
+    b = numbers(b) if ranks[1] != 1 else 0.0
+    if ranks[0] != ranks[1]:
+        result = np.full(np.shape(a if type(a) is ndarray else b), float(op(ranks[0], ranks[1])))
+    else:
+        result = op(a, b).astype(np.float64)
+    return np.where(np.isnan(a) | np.isnan(b), nan, result)
+
+
+def eq(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.eq(a, b)
+    return compare_arrays(operator.eq, a, b)
+
+
+def ne(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.ne(a, b)
+    return compare_arrays(operator.ne, a, b)
+
+
+def lt(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.lt(a, b)
+    return compare_arrays(operator.lt, a, b)
+
+
+def le(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.le(a, b)
+    return compare_arrays(operator.le, a, b)
+
+
+def gt(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.gt(a, b)
+    return compare_arrays(operator.gt, a, b)
+
+
+def ge(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.ge(a, b)
+    return compare_arrays(operator.ge, a, b)
+
+
+
+# IF / IFERROR / IFNA, the branches are passed as functions that work
+# them out. A condition that is the same for every scenario just picks a
+# branch and only that one is worked out, like in runtime.py. With an
+# array both are, and np.where picks for each scenario
+
+def where_if(cond, if_true, if_false):
+    if type(cond) is not ndarray:
+        c = condition(cond)
+        if type(c) is ExcelError:
+            return c
+        return if_true() if c else if_false()
+    cond = numbers(cond)
+    result = np.where(cond != 0, branch(if_true()), branch(if_false()))
+    return np.where(np.isnan(cond), nan, result)
+
+
+def where_iferror(v, alt):
+    if type(v) is not ndarray:
+        return alt() if type(v) is ExcelError else v
+    errors = np.isnan(v)
+    if not errors.any():
+        return v
+    return np.where(errors, branch(alt()), v)
+
+
+def where_ifna(v, alt):
+    if type(v) is not ndarray:
+        return alt() if v == NA_ERROR else v
+    errors = np.isnan(v)
+    if not errors.any():
+        return v
+    return np.where(errors, branch(alt()), v)
+
+
+# what a branch taken in some scenarios and not others can be
+def branch(v):
+    if type(v) is str:
+        raise Exception("the numpy backend can't have text in an IF that changes between scenarios")
+    return numbers(v)
+
+
+
+# worksheet functions, the runtime.py ones with the ones below swapped in.
+# The others work the same as before unless an argument is an array
+
+FUNCTIONS = dict()
+
+
+def vector_function(name):
+    def register(fn):
+        FUNCTIONS[name] = fn
+        return fn
+    return register
+
+
+def scalar_only(name, fn):
+    def call(*args):
+        if has_array(args):
+            raise Exception("the numpy backend can't do " + name + " on values that change between scenarios")
+        return fn(*args)
+    return call
+
+
+# element by element functions of one number
+def unary_function(name, fn):
+    scalar = runtime.FUNCTIONS[name]
+    def call(x):
+        if type(x) is not ndarray:
+            return scalar(x)
+        with np.errstate(all="ignore"):
+            return finite(fn(numbers(x)))
+    FUNCTIONS[name] = call
+
+
+unary_function("ABS", np.abs)
+unary_function("SIGN", np.sign)
+unary_function("INT", np.floor)
+unary_function("SQRT", np.sqrt)
+unary_function("EXP", np.exp)
+unary_function("LN", lambda x: np.where(x > 0, np.log(x), nan))
+unary_function("LOG10", lambda x: np.where(x > 0, np.log10(x), nan))
+
+
+@vector_function("SUM")
+def fn_sum(*args):
+    if not has_array(args):
+        return runtime.fn_sum(*args)
+    scalars, arrays = split_arrays(args)
+    total = runtime.fn_sum(*scalars)
+    if type(total) is ExcelError:
+        return total
+    for a in arrays:
+        total = total + a
+    return total
+
+
+@vector_function("PRODUCT")
+def fn_product(*args):
+    if not has_array(args):
+        return runtime.fn_product(*args)
+    scalars, arrays = split_arrays(args)
+    result = runtime.fn_product(*scalars)
+    if type(result) is ExcelError:
+        return result
+    for a in arrays:
+        result = result * a
+    return result
+
+
+@vector_function("AVERAGE")
+def fn_average(*args):
+    if not has_array(args):
+        return runtime.fn_average(*args)
+    scalars, arrays = split_arrays(args)
+    numbers_in = runtime.collect_numbers(scalars)
+    if type(numbers_in) is ExcelError:
+        return numbers_in
+    total = sum(numbers_in)
+    for a in arrays:
+        total = total + a
+    return total / (len(numbers_in) + len(arrays))
+
+
+@vector_function("MIN")
+def fn_min(*args):
+    if not has_array(args):
+        return runtime.fn_min(*args)
+    scalars, arrays = split_arrays(args)
+    numbers_in = runtime.collect_numbers(scalars)
+    if type(numbers_in) is ExcelError:
+        return numbers_in
+    result = np.minimum.reduce(arrays)
+    return np.minimum(result, min(numbers_in)) if len(numbers_in) > 0 else result
+
+
+@vector_function("MAX")
+def fn_max(*args):
+    if not has_array(args):
+        return runtime.fn_max(*args)
+    scalars, arrays = split_arrays(args)
+    numbers_in = runtime.collect_numbers(scalars)
+    if type(numbers_in) is ExcelError:
+        return numbers_in
+    result = np.maximum.reduce(arrays)
+    return np.maximum(result, max(numbers_in)) if len(numbers_in) > 0 else result
+
+
+# an error in a scenario isn't a number, so it isn't counted there
+@vector_function("COUNT")
+def fn_count(*args):
+    if not has_array(args):
+        return runtime.fn_count(*args)
+    scalars, arrays = split_arrays(args)
+    n = runtime.fn_count(*scalars)
+    for a in arrays:
+        n = n + (~np.isnan(a)).astype(np.float64)
+    return n
+
+
+# Excel's half away from zero. The scaled number is rounded to 9
+# decimals first so 1.005 rounds like the 1.005 it is shown as, the way
+# runtime.round_with rounds the repr
+def rounding_function(name, fn):
+    scalar = runtime.FUNCTIONS[name]
+    def call(x, digits=0):
+        if type(x) is not ndarray and type(digits) is not ndarray:
+            return scalar(x, digits)
+        x = numbers(x)
+        scale = np.power(10.0, np.trunc(numbers(digits)))
+        return np.sign(x) * fn(np.round(np.abs(x) * scale, 9)) / scale
+    FUNCTIONS[name] = call
+
+
+rounding_function("ROUND", lambda t: np.floor(t + 0.5))
+rounding_function("ROUNDUP", np.ceil)
+rounding_function("ROUNDDOWN", np.floor)
+rounding_function("TRUNC", np.floor)
+
+
+@vector_function("MOD")
+def fn_mod(a, b):
+    if type(a) is not ndarray and type(b) is not ndarray:
+        return runtime.fn_mod(a, b)
+    a = numbers(a)
+    b = numbers(b)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(b == 0, nan, a - b * np.floor(a / b))
+
+
+@vector_function("POWER")
+def fn_power(a, b):
+    return power(a, b)
+
+
+# logical_values from runtime.py with arrays: numbers and booleans
+# count, text and empty cells in ranges are skipped. Gives 1.0 / 0.0 or
+# arrays of them
+def logical_arrays(args):
+    scalars, arrays = split_arrays(args)
+    values = [truth(a) for a in arrays]
+    for a in scalars:
+        if type(a) is CellRange:
+            for v in a.values():
+                t = type(v)
+                if t is bool or t is int or t is float:
+                    values.append(1.0 if v else 0.0)
+                elif t is ExcelError:
+                    return v
+        else:
+            b = runtime.to_bool(a)
+            if type(b) is ExcelError:
+                return b
+            values.append(1.0 if b else 0.0)
+    return values
+
+
+@vector_function("AND")
+def fn_and(*args):
+    if not has_array(args):
+        return runtime.fn_and(*args)
+    values = logical_arrays(args)
+    if type(values) is ExcelError:
+        return values
+    result = 1.0
+    for v in values:
+        result = result * v
+    return result
+
+
+@vector_function("OR")
+def fn_or(*args):
+    if not has_array(args):
+        return runtime.fn_or(*args)
+    values = logical_arrays(args)
+    if type(values) is ExcelError:
+        return values
+    result = 0.0
+    for v in values:
+        result = np.maximum(result, v)
+    return result
+
+
+@vector_function("NOT")
+def fn_not(x):
+    if type(x) is not ndarray:
+        return runtime.fn_not(x)
+    return 1.0 - truth(numbers(x))
+
+
+# the branches are already worked out here
+@vector_function("IF")
+def fn_if(cond, if_true=True, if_false=False):
+    return where_if(cond, lambda: if_true, lambda: if_false)
+
+
+@vector_function("IFERROR")
+def fn_iferror(v, alt):
+    return where_iferror(v, lambda: alt)
+
+
+@vector_function("IFNA")
+def fn_ifna(v, alt):
+    return where_ifna(v, lambda: alt)
+
+
+@vector_function("ISERROR")
+def fn_iserror(v):
+    if type(v) is not ndarray:
+        return runtime.fn_iserror(v)
+    return np.isnan(v).astype(np.float64)
+
+
+@vector_function("ISNUMBER")
+def fn_isnumber(v):
+    if type(v) is not ndarray:
+        return runtime.fn_isnumber(v)
+    return (~np.isnan(v)).astype(np.float64)
+
+
+for name in runtime.FUNCTIONS:
+    if name not in FUNCTIONS:
+        FUNCTIONS[name] = scalar_only(name, runtime.FUNCTIONS[name])
+
+
+
+# IF / IFERROR / IFNA as calls, with the branches as lambdas so
+# where_if and the others only work out the ones they need
+class NumpyExpressionGenerator(SlotExpressionGenerator):
+
+    def function(self, node, params):
+        name = function_key(node.get_func_name())
+
+        if name == "IF" and 1 <= len(params) <= 3:
+            if_true = params[1] if len(params) > 1 else "True"
+            if_false = params[2] if len(params) > 2 else "False"
+            return "where_if(" + params[0] + ", lambda: " + if_true + ", lambda: " + if_false + ")"
+
+        if name == "IFERROR" and len(params) == 2:
+            return "where_iferror(" + params[0] + ", lambda: " + params[1] + ")"
+
+        if name == "IFNA" and len(params) == 2:
+            return "where_ifna(" + params[0] + ", lambda: " + params[1] + ")"
+
+        return SlotExpressionGenerator.function(self, node, params)
+
+
+
+# a straight line module (see straight_line.py) on this runtime
+def generate_numpy_module(formulas_parsed, program_info, graph=None, chunk_size=CHUNK_SIZE):
+    return generate_straight_module(formulas_parsed, program_info, graph, chunk_size,
+                                    NumpyExpressionGenerator, "numpy_backend", NUMPY_IMPORTS)
+
+
+
+# a result as an array with a value for each of n scenarios, for the
+# ones that came out the same in all of them
+def as_array(v, n):
+    if type(v) is ndarray:
+        return v
+    return np.full(n, numbers(v))
@@ -0,0 +1,704 @@
+
+# optimization passes over the formula ASTs, between parsing and code
+# generation, so the generated code evaluates fewer nodes. Every pass
+# gives back new formula objects, the ASTs are never changed in place
+# (the parse cache can share them between formulas). Like graph.py,
+# nothing here recurses, the passes go through the ASTs with their own
+# stacks (parse.rebuild_ast and the like) so a long chain is fine:
+#
+#   fold       parts of a formula that are all constants are worked out
+#              with runtime.py, IF / IFERROR / IFNA with a constant
+#              condition keep just the branch taken. A formula that folds
+#              to a constant is folded into the formulas that read it, and
+#              with inputs given, so are the constant cells that aren't
+#              inputs
+#   simplify   x+0, 0+x, x-0, x*1, 1*x, --x and +x become x and 0-x
+#              becomes -x, where x always gives a number (or an error)
+#   cse        a part that is in more than one formula, or in a shared
+#              formula without relative references ($B$1*$B$2 filled down
+#              a column), is worked out once in a new defined name _CSE<n>
+#              and read from there
+#
+#   formulas_parsed, report = optimize_program(formulas_parsed, program_info, inputs=[("Sheet1", "B2")])
+#   print_report(report)
+#
+# inputs are the (sheet, cell) that may be set later (set_input, scenario
+# runs). None means any constant cell may be, then only formulas are
+# folded. The report says for each pass how many nodes the generated
+# code evaluates before and after it, a shared formula counting once for
+# every cell it is in.
+
+import time
+
+from .ast_to_python import GLOBAL_SCOPE, formula_cells, function_name
+from .graph import build_dependency_graph, range_side, range_rect, FORMULA, NAME
+from .parse import IRConstant, IRError, IRVariable, UnaryOperationNode, BinaryOperationNode, FunctionCallNode, child_nodes, walk, with_children, rebuild_ast
+from .refs import parse_cell_ref, format_cell_ref
+from .runtime import BINARY_OPERATORS, UNARY_OPERATORS, FUNCTIONS, CellRange, ExcelError, NA_ERROR, VALUE_ERROR, condition, error, function_key, takes_arguments
+
+
+PASSES = ["fold", "simplify", "cse"]
+
+CSE_PREFIX = "_CSE"
+
+# functions that give a number or an error whatever their arguments
+NUMBER_FUNCTIONS = set([
+    "SUM", "PRODUCT", "AVERAGE", "MIN", "MAX", "COUNT", "COUNTA", "COUNTBLANK", "SUMPRODUCT",
+    "ABS", "SIGN", "ROUND", "ROUNDUP", "ROUNDDOWN", "INT", "TRUNC", "MOD", "POWER", "SQRT",
+    "EXP", "LN", "LOG", "LOG10", "PI", "LEN", "VALUE", "SUMIF", "COUNTIF", "AVERAGEIF",
+    "MATCH", "NPV", "PMT",
+])
+
+MISSING = object()  # a value that isn't known until the workbook is calculated
+
+
+
+# the formulas after the passes (names in PASSES) and the report, a dict
+# for each pass
+def optimize_program(formulas_parsed, program_info, inputs=None, passes=PASSES):
+    optimizer = Optimizer(formulas_parsed, program_info, inputs)
+    report = []
+    for name in passes:
+        before = program_work(optimizer.formulas)
+        start = time.perf_counter()
+        stats = getattr(optimizer, name + "_pass")()
+        after = program_work(optimizer.formulas)
+        stats["pass"] = name
+        stats["nodes_before"] = before
+        stats["nodes_after"] = after
+        stats["removed"] = before - after
+        stats["seconds"] = time.perf_counter() - start
+        report.append(stats)
+    return optimizer.formulas, report
+
+
+
+def print_report(report):
+    for stats in report:
+        line = "%-8s %10d nodes -> %10d  (%d removed, %d formulas changed" % (
+            stats["pass"], stats["nodes_before"], stats["nodes_after"], stats["removed"], stats["changed"])
+        if "names_added" in stats:
+            line = line + ", " + str(stats["names_added"]) + " names added"
+        print(line + ")")
+
+
+
+# nodes the generated code evaluates for all the formulas
+def program_work(formulas_parsed):
+    total = 0
+    for formula_obj in formulas_parsed:
+        if formula_obj["parsed"] is not None:
+            total = total + count_nodes(formula_obj["parsed"]) * len(formula_cells(formula_obj))
+    return total
+
+
+def count_nodes(node):
+    n = 0
+    for _ in walk(node):
+        n = n + 1
+    return n
+
+
+def is_shared(formula_obj):
+    return formula_obj.get("ref") is not None and parse_cell_ref(formula_obj["name"]) is not None
+
+
+
+# the Excel text of an AST, for the formula of a name the cse pass adds.
+# Built bottom up from the text of the children, a long chain is fine
+def formula_text(formula_ast):
+    return rebuild_ast(formula_ast, node_text)
+
+
+def node_text(node, children):
+    t = node.nodetype()
+    if t == "constant":
+        v = node.get_value()
+        if isinstance(node, IRError):
+            return str(v)
+        if v is True or v is False:
+            return "TRUE" if v else "FALSE"
+        if v is None:
+            return ""
+        if isinstance(v, str):
+            return '"' + v.replace('"', '""') + '"'
+        return repr(v)
+    elif t == "variable":
+        return sheet_prefix(node.get_sheet_scope()) + node.get_varname()
+    elif t == "variablerange":
+        return sheet_prefix(node.get_sheet_scope()) + node.get_varname1() + ":" + node.get_varname2()
+    elif t == "unary":
+        if node.get_operator() == "%":
+            return children[0] + "%"
+        return node.get_operator() + children[0]
+    elif t == "binary":
+        return "(" + children[0] + node.get_operator() + children[1] + ")"
+    elif t == "function":
+        return node.get_func_name() + "(" + ",".join(children) + ")"
+    raise Exception("dont know how to write the type " + str(t))
+
+
+def sheet_prefix(sheet):
+    if sheet == GLOBAL_SCOPE:
+        return ""
+    return "'" + sheet.replace("'", "''") + "'!"
+
+
+
+# a value as a constant node, None when it can't be one (a CellRange)
+def constant_node(v):
+    if type(v) is ExcelError:
+        return IRError(v.code)
+    if v is None or type(v) in (int, float, str, bool):
+        return IRConstant(v)
+    return None
+
+
+def constant_value(node):
+    if isinstance(node, IRError):
+        return error(node.get_value())
+    return node.get_value()
+
+
+def is_constant(node):
+    return node.nodetype() == "constant"
+
+
+# IF / IFERROR / IFNA the way the code generators do them, only the
+# branch taken is evaluated
+def lazy_function(name, params):
+    return (name == "IF" and 1 <= len(params) <= 3) or ((name == "IFERROR" or name == "IFNA") and len(params) == 2)
+
+
+
+class Optimizer:
+
+    def __init__(self, formulas_parsed, program_info, inputs=None):
+        self.formulas = list(formulas_parsed)
+        self.program_info = program_info
+        self.inputs = set(inputs) if inputs is not None else None
+        for formula_obj in self.formulas:
+            program_info.define_formula(formula_obj)
+
+        self.graph = build_dependency_graph(self.formulas, program_info)
+        self.cyclic = set()  # function names of the cells and names on a circular reference
+        for cycle in self.graph.find_cycles():
+            for node in cycle:
+                kind = self.graph.get_kind(node)
+                if kind == FORMULA or kind == NAME:
+                    self.cyclic.add(program_info.get_func_name_for(*self.graph.get_key(node)))
+
+        self.values = dict()  # function name -> value, for the formulas that folded to a constant
+        self.ranges = dict()  # (sheet, rect) -> CellRange or MISSING
+
+
+    # formula objects in evaluation order, so what a formula reads is
+    # folded before it. Formulas that aren't in the graph (added by a
+    # pass) come at the end
+    def formulas_in_order(self):
+        graph = self.graph
+        seen = set()
+        ordered = []
+        for component in graph.strongly_connected_components():
+            for node in component:
+                kind = graph.get_kind(node)
+                if kind == FORMULA or kind == NAME:
+                    formula_obj = graph.get_formula(node)
+                    if id(formula_obj) not in seen:
+                        seen.add(id(formula_obj))
+                        ordered.append(formula_obj)
+        for formula_obj in self.formulas:
+            if id(formula_obj) not in seen:
+                seen.add(id(formula_obj))
+                ordered.append(formula_obj)
+        return ordered
+
+
+    # replaces each formula's AST with rewrite(formula_obj), keeps the
+    # order of the formulas. Returns the number that changed
+    def rewrite_formulas(self, formulas, rewrite):
+        replaced = dict()
+        for formula_obj in formulas:
+            if formula_obj["parsed"] is None:
+                continue
+            nodes = rewrite(formula_obj)
+            if nodes is not formula_obj["parsed"]:
+                replaced[id(formula_obj)] = dict(formula_obj, parsed=nodes)
+        self.formulas = [replaced.get(id(formula_obj), formula_obj) for formula_obj in self.formulas]
+        return len(replaced)
+
+
+
+    # constant folding
+
+    def fold_pass(self):
+        folded = [0]
+
+        def rewrite(formula_obj):
+            nodes = self.fold(formula_obj["parsed"], is_shared(formula_obj))
+            if is_constant(nodes):
+                folded[0] = folded[0] + 1
+                for cell in formula_cells(formula_obj):
+                    fnc = function_name(formula_obj, cell)
+                    if fnc not in self.cyclic:
+                        self.values[fnc] = constant_value(nodes)
+            return nodes
+
+        changed = self.rewrite_formulas(self.formulas_in_order(), rewrite)
+        return {"changed" : changed, "folded_to_constant" : folded[0]}
+
+
+    # shared is set for a shared formula, whose relative references are
+    # different cells in each of its cells and so are never folded. Folds
+    # bottom up, each node from its folded children, so a long chain
+    # doesn't recurse. Both branches of an IF are folded, the one that
+    # isn't taken is just dropped
+    def fold(self, formula_ast, shared):
+        return rebuild_ast(formula_ast, lambda node, children: self.fold_node(node, children, shared))
+
+
+    def fold_node(self, node, children, shared):
+        t = node.nodetype()
+        if t == "constant" or t == "variablerange":
+            return node
+        elif t == "variable":
+            return self.fold_variable(node, shared)
+        elif t == "function":
+            return self.fold_function(node, children, shared)
+
+        if all(is_constant(c) for c in children):
+            if t == "unary":
+                op = UNARY_OPERATORS.get(node.get_operator())
+            else:
+                op = BINARY_OPERATORS.get(node.get_operator())
+            if op is not None:
+                folded = constant_node(op(*[constant_value(c) for c in children]))
+                if folded is not None:
+                    return folded
+        return with_children(node, children)
+
+
+    def fold_variable(self, node, shared):
+        sheet = node.get_sheet_scope()
+        parsed = parse_cell_ref(node.get_varname())
+        if parsed is None:
+            fnc = self.program_info.resolve_name(sheet, node.get_varname())
+            value = self.values.get(fnc, MISSING)
+        else:
+            col, row, col_abs, row_abs = parsed
+            if shared and not (col_abs and row_abs):
+                return node
+            value = self.cell_value(sheet, format_cell_ref(col, row))
+        if value is MISSING:
+            return node
+        folded = constant_node(value)
+        return folded if folded is not None else node
+
+
+    # folded are the params already folded
+    def fold_function(self, node, folded, shared):
+        name = function_key(node.get_func_name())
+
+        if lazy_function(name, folded):
+            first = folded[0]
+            if is_constant(first):
+                v = constant_value(first)
+                if name == "IF":
+                    c = condition(v)
+                    if c is True:
+                        return folded[1] if len(folded) > 1 else IRConstant(True)
+                    elif c is False:
+                        return folded[2] if len(folded) > 2 else IRConstant(False)
+                    return constant_node(c)
+                elif name == "IFERROR":
+                    return folded[1] if type(v) is ExcelError else first
+                else:
+                    return folded[1] if v == NA_ERROR else first
+            return with_children(node, folded)
+
+        if name is not None and not takes_arguments(name, len(folded)):
+            return constant_node(VALUE_ERROR)
+        if name is not None:
+            args = []
+            for p in folded:
+                if is_constant(p):
+                    args.append(constant_value(p))
+                elif p.nodetype() == "variablerange":
+                    args.append(self.range_value(p, shared))
+                else:
+                    args.append(MISSING)
+                if args[-1] is MISSING:
+                    break
+            else:
+                try:
+                    value = constant_node(FUNCTIONS[name](*args))
+                except Exception:
+                    value = None  # left for the generated code to raise
+                if value is not None:
+                    return value
+        return with_children(node, folded)
+
+
+    # the value of a cell that is known before calculating: a formula that
+    # folded, or a constant cell (None for an empty one) that isn't an input
+    def cell_value(self, sheet, cell):
+        fnc = self.program_info.find_func_name_for(sheet, cell)
+        if fnc is not None:
+            return self.values.get(fnc, MISSING)
+        if self.inputs is None or (sheet, cell) in self.inputs:
+            return MISSING
+        return self.program_info.program_constants.get((sheet, cell))
+
+
+    # a CellRange when every cell in the range is known, like the range
+    # functions of the generated code
+    def range_value(self, node, shared):
+        sheet = node.get_sheet_scope()
+        first = range_side(node.get_varname1())
+        last = range_side(node.get_varname2())
+        if first is None or last is None:
+            return MISSING
+        flags = (first[2], first[3], last[2], last[3])
+        if shared and not all(flags):
+            return MISSING
+        rect = range_rect(first[0], first[1], last[0], last[1], flags, 0, 0)
+        if rect is None:
+            return MISSING
+
+        key = (sheet, rect)
+        if key not in self.ranges:
+            c1, r1, c2, r2 = rect
+            cells = []
+            for row, col, cell in self.program_info.cells_in(sheet, c1, r1, c2, r2):
+                v = self.cell_value(sheet, cell)
+                if v is MISSING:
+                    cells = MISSING
+                    break
+                cells.append((row - r1, col - c1, v))
+            self.ranges[key] = CellRange(r2 - r1 + 1, c2 - c1 + 1, cells) if cells is not MISSING else MISSING
+        return self.ranges[key]
+
+
+
+    # algebraic simplification
+
+    def simplify_pass(self):
+        changed = self.rewrite_formulas(self.formulas, lambda formula_obj: simplify(formula_obj["parsed"]))
+        return {"changed" : changed}
+
+
+
+    # common subexpressions
+
+    def cse_pass(self):
+        self.subtrees = dict()  # id(node) -> (key, size, movable, acyclic)
+        self.keys = dict()  # the shape of a subtree -> its key
+        self.sizes = dict()  # key -> size
+        counts = dict()  # key -> how many times it is evaluated
+        usable = []
+        for formula_obj in self.formulas:
+            if formula_obj["parsed"] is None:
+                continue
+            sheet = formula_obj["sheet"]
+            if any(self.program_info.get_func_name_for(sheet, cell) in self.cyclic for cell in formula_cells(formula_obj)):
+                continue
+            usable.append(formula_obj)
+            self.count_subtrees(formula_obj["parsed"], len(formula_cells(formula_obj)), is_shared(formula_obj), True, counts)
+
+        self.common = set()
+        for key in counts:
+            if (counts[key] - 1) * (self.sizes[key] - 1) > 1:
+                self.common.add(key)
+
+        taken = set(key[1].upper() for key in self.program_info.program_constants)
+        for formula_obj in self.formulas:
+            taken.add(formula_obj["name"].upper())
+        self.taken = taken
+        self.hoisted = dict()  # key -> name
+        self.bodies = dict()  # name -> AST
+
+        changed = self.rewrite_formulas(usable, lambda formula_obj: self.replace_common(formula_obj["parsed"], is_shared(formula_obj)))
+        self.inline_single_use()
+
+        next_id = max([formula_obj["formula_id"] for formula_obj in self.formulas] + [0]) + 1
+        for name in sorted(self.bodies, key=lambda name: int(name[len(CSE_PREFIX):])):
+            self.formulas.append({
+                "formula_id" : next_id,
+                "sheet" : GLOBAL_SCOPE,
+                "name" : name,
+                "formula" : "=" + formula_text(self.bodies[name]),
+                "parsed" : self.bodies[name],
+                "ref" : None,
+            })
+            next_id = next_id + 1
+
+        names_added = len(self.bodies)
+        self.subtrees = None
+        self.keys = None
+        self.sizes = None
+        self.common = None
+        return {"changed" : changed, "names_added" : names_added, "usable_formulas" : len(usable)}
+
+
+    # (key, size, movable, acyclic) of a subtree: a key that is the same
+    # for the same expression wherever it is, its number of nodes, no
+    # relative references in it, and nothing on a circular reference.
+    # The first call works out every subtree under node, bottom up. The
+    # key is a number given to each distinct shape, a shape being the
+    # node with the keys of its children, so keys of a long chain aren't
+    # tuples nested as deep as the chain (hashing those recurses)
+    def subtree(self, node):
+        found = self.subtrees.get(id(node))
+        if found is not None:
+            return found
+        return rebuild_ast(node, self.subtree_of)
+
+
+    def subtree_of(self, node, children):
+        t = node.nodetype()
+        if t == "constant":
+            v = node.get_value()
+            found = (("error" if isinstance(node, IRError) else type(v).__name__, v), 1, True, True)
+        elif t == "variable":
+            sheet = node.get_sheet_scope()
+            parsed = parse_cell_ref(node.get_varname())
+            if parsed is None:
+                fnc = self.program_info.resolve_name(sheet, node.get_varname())
+                found = (("name", sheet, node.get_varname().upper()), 1, True, fnc not in self.cyclic)
+            else:
+                cell = format_cell_ref(parsed[0], parsed[1])
+                fnc = self.program_info.find_func_name_for(sheet, cell)
+                found = (("cell", sheet, cell), 1, parsed[2] and parsed[3], fnc not in self.cyclic)
+        elif t == "variablerange":
+            found = self.range_subtree(node)
+        else:
+            if t == "unary" or t == "binary":
+                op = node.get_operator()
+            else:
+                op = function_key(node.get_func_name()) or node.get_func_name().upper()
+            found = ((t, op) + tuple(c[0] for c in children), 1 + sum(c[1] for c in children),
+                     all(c[2] for c in children), all(c[3] for c in children))
+        key = self.keys.get(found[0])
+        if key is None:
+            key = len(self.keys)
+            self.keys[found[0]] = key
+        found = (key,) + found[1:]
+        self.subtrees[id(node)] = found
+        self.sizes[found[0]] = found[1]
+        return found
+
+
+    def range_subtree(self, node):
+        sheet = node.get_sheet_scope()
+        v1 = node.get_varname1()
+        v2 = node.get_varname2()
+        key = ("range", sheet, v1.replace("$", "").upper(), v2.replace("$", "").upper())
+        first = range_side(v1)
+        last = range_side(v2)
+        if first is None or last is None:
+            return (key, 1, False, False)
+        flags = (first[2], first[3], last[2], last[3])
+        acyclic = True
+        rect = range_rect(first[0], first[1], last[0], last[1], flags, 0, 0)
+        if len(self.cyclic) > 0 and rect is not None:
+            for row, col, cell in self.program_info.cells_in(sheet, *rect):
+                if self.program_info.find_func_name_for(sheet, cell) in self.cyclic:
+                    acyclic = False
+                    break
+        return (key, 1, all(flags), acyclic)
+
+
+    def can_hoist(self, node, shared):
+        if node.nodetype() not in ("unary", "binary", "function"):
+            return False
+        key, size, movable, acyclic = self.subtree(node)
+        return acyclic and (movable or not shared)
+
+
+    # counts the subtrees that are evaluated whatever the inputs, weight
+    # times (the cells of a shared formula). The branches of IF / IFERROR /
+    # IFNA aren't always evaluated so what is only in them isn't counted
+    def count_subtrees(self, formula_ast, weight, shared, evaluated, counts):
+        stack = [(formula_ast, evaluated)]
+        while len(stack) > 0:
+            node, evaluated = stack.pop()
+            if evaluated and self.can_hoist(node, shared):
+                key = self.subtree(node)[0]
+                counts[key] = counts.get(key, 0) + weight
+            children = child_nodes(node)
+            lazy = node.nodetype() == "function" and lazy_function(function_key(node.get_func_name()), children)
+            for i, c in enumerate(children):
+                stack.append((c, evaluated and (not lazy or i == 0)))
+
+
+    # the AST with the common parts replaced by the names they are hoisted
+    # into. Goes down the tree with its own stack, deciding for each node
+    # whether it is hoisted (names are given out parents first), and
+    # builds the new nodes on the way back up. What is in a hoisted part
+    # goes into its body, which isn't a shared formula any more
+    def replace_common(self, formula_ast, shared):
+        stack = [(formula_ast, shared, None, None)]
+        done = []
+        while len(stack) > 0:
+            node, shared, children, name = stack.pop()
+            if children is not None:
+                n = len(children)
+                rebuilt = with_children(node, done[-n:]) if n > 0 else node
+                del done[len(done) - n:]
+                if name is None:
+                    done.append(rebuilt)
+                else:
+                    self.bodies[name] = rebuilt
+                    done.append(name_variable(name))
+                continue
+
+            if self.can_hoist(node, shared):
+                key = self.subtree(node)[0]
+                if key in self.common:
+                    name = self.hoisted.get(key)
+                    if name is not None:
+                        done.append(name_variable(name))
+                        continue
+                    name = self.new_name()
+                    self.hoisted[key] = name
+                    shared = False
+            children = child_nodes(node)
+            stack.append((node, shared, children, name))
+            for i in range(len(children) - 1, -1, -1):
+                stack.append((children[i], shared, None, None))
+        return done[0]
+
+
+    def new_name(self):
+        n = len(self.hoisted) + 1
+        while (CSE_PREFIX + str(n)).upper() in self.taken:
+            n = n + 1
+        self.taken.add((CSE_PREFIX + str(n)).upper())
+        return CSE_PREFIX + str(n)
+
+
+    # a part only worth a name when it is read often enough: a name read
+    # r times instead of a part of s nodes saves (r - 1) * (s - 1) - 1
+    # nodes. A part inside another hoisted part was counted with it, so
+    # this puts those back where they were
+    def inline_single_use(self):
+        while True:
+            reads = dict((name, 0) for name in self.bodies)
+            for formula_obj in self.formulas:
+                if formula_obj["parsed"] is not None:
+                    self.count_reads(formula_obj["parsed"], len(formula_cells(formula_obj)), reads)
+            for name in self.bodies:
+                self.count_reads(self.bodies[name], 1, reads)
+            inline = set(name for name in reads if (reads[name] - 1) * (count_nodes(self.bodies[name]) - 1) <= 1)
+            if len(inline) == 0:
+                return
+
+            def rewrite(formula_ast):
+                return inline_names(formula_ast, self.bodies, inline)
+
+            bodies = dict()
+            for name in self.bodies:
+                if name not in inline:
+                    bodies[name] = rewrite(self.bodies[name])
+            self.bodies = bodies
+            self.rewrite_formulas(self.formulas, lambda formula_obj: rewrite(formula_obj["parsed"]))
+
+
+    def count_reads(self, node, weight, reads):
+        for n in walk(node):
+            if n.nodetype() == "variable" and n.get_sheet_scope() == GLOBAL_SCOPE and n.get_varname() in reads:
+                reads[n.get_varname()] = reads[n.get_varname()] + weight
+
+
+
+# the AST with the names in inline replaced by their bodies (which have
+# their inlined names replaced too), with its own stack like
+# Optimizer.replace_common
+def inline_names(formula_ast, bodies, inline):
+    stack = [(formula_ast, None)]
+    done = []
+    while len(stack) > 0:
+        node, children = stack.pop()
+        if children is not None:
+            n = len(children)
+            new_children = done[-n:]
+            del done[-n:]
+            done.append(with_children(node, new_children))
+            continue
+        while node.nodetype() == "variable" and node.get_sheet_scope() == GLOBAL_SCOPE and node.get_varname() in inline:
+            node = bodies[node.get_varname()]
+        children = child_nodes(node)
+        if len(children) == 0:
+            done.append(node)
+            continue
+        stack.append((node, children))
+        for i in range(len(children) - 1, -1, -1):
+            stack.append((children[i], None))
+    return done[0]
+
+
+
+def name_variable(name):
+    node = IRVariable(name)
+    node.set_sheet_scope(GLOBAL_SCOPE)
+    return node
+
+
+
+# always a number or an error, whatever the cells it reads have in them
+def is_number_node(node):
+    t = node.nodetype()
+    if t == "constant":
+        return type(node.get_value()) in (int, float)
+    elif t == "unary":
+        return node.get_operator() in ("-", "%")
+    elif t == "binary":
+        return node.get_operator() in ("+", "-", "*", "/", "^")
+    elif t == "function":
+        return function_key(node.get_func_name()) in NUMBER_FUNCTIONS
+    return False
+
+
+# 0 and 1 typed in a formula, 0.0 would turn an int result into a float
+def is_int_constant(node, n):
+    return node.nodetype() == "constant" and type(node.get_value()) is int and node.get_value() == n
+
+
+# bottom up, so each node is looked at with its children simplified
+def simplify(formula_ast):
+    return rebuild_ast(formula_ast, simplify_node)
+
+
+def simplify_node(node, children):
+    t = node.nodetype()
+    if t not in ("unary", "binary", "function"):
+        return node
+
+    if t == "unary":
+        op = node.get_operator()
+        inner = children[0]
+        if op == "+" and (is_number_node(inner) or is_constant(inner)):
+            return inner
+        if op == "-" and inner.nodetype() == "unary" and inner.get_operator() == "-" and is_number_node(inner.get_node()):
+            return inner.get_node()
+
+    elif t == "binary":
+        op = node.get_operator()
+        left, right = children
+        if op == "+":
+            if is_int_constant(right, 0) and is_number_node(left):
+                return left
+            if is_int_constant(left, 0) and is_number_node(right):
+                return right
+        elif op == "-":
+            if is_int_constant(right, 0) and is_number_node(left):
+                return left
+            if is_int_constant(left, 0) and is_number_node(right):
+                return UnaryOperationNode("-", right)
+        elif op == "*":
+            if is_int_constant(right, 1) and is_number_node(left):
+                return left
+            if is_int_constant(left, 1) and is_number_node(right):
+                return right
+
+    return with_children(node, children)
@@ -3,11 +3,21 @@ import os
 import sys 
 import csv 
 import traceback 
+import time 
 
-from .gen import ExcelScanResults 
+from .intermediate import IntermediateFile
+from .refs import split_coordinate, parse_range, format_cell_ref, shift_ref
+
+from .lexer import tokenize
+from .runtime import function_key
+from . import diagnostics
+from . import profiling
+
+
+# bump when the ASTs excel_formula_to_IR makes change, so parsed formulas
+# that were cached are not reused
+PARSER_VERSION = 2
 
-from typing import Iterable
-from lexit import Lexer, Token
 
 
 # the lexical analyzer will be separate from this
@@ -22,21 +32,12 @@ from lexit import Lexer, Token
 # shrinking memory according to how many
 # free cells there are. 
 
+# nodes have __slots__ and no parent/children links, a workbook can have 
+# tens of millions of them. Use child_nodes, walk or IRVisitor to go over 
+# a tree 
 class IRNode:
+    __slots__ = ()
 
-    def __init__(self):
-        self.parent = None
-        self.children = [] # this isn't actually used
-
-    def get_parent(self):
-        return self.parent 
-    
-    def add_child(self, c):
-        self.children.append(c)
-
-    def children(self):
-        return self.children 
-    
     def nodetype(self):
         return "node" 
     
@@ -46,9 +47,9 @@ class IRNode:
 
 
 class IRConstant(IRNode):
+    __slots__ = ("value",)
 
     def __init__(self, value):
-        super()
         self.value = value
         
 
@@ -61,13 +62,23 @@ class IRConstant(IRNode):
     def nodetype(self):
         return "constant"
 
+
+
+# an error value typed into a formula (#N/A, Sheet1!#REF!). A constant like 
+# any other, but kept apart from the text "#N/A" 
+class IRError(IRConstant):
+    __slots__ = ()
+
+    def __str__(self):
+        return "IRError<" + str(self.value) + ">"
+
     
     
 # might need to resolve inclusion of $ and have non $ still refer to the same cell 
 class IRVariable(IRNode):
+    __slots__ = ("varname", "sheet_scope")
 
     def __init__(self, symbol):
-        super()
         self.varname = symbol 
         self.sheet_scope = "$$$GLOBAL$$$"
     
@@ -90,9 +101,9 @@ class IRVariable(IRNode):
 
 # might need to resolve inclusion of $ and have non $ still refer to the same cell 
 class IRVariableRange(IRNode):
+    __slots__ = ("varname1", "varname2", "sheet_scope")
     
     def __init__(self, symbol1, symbol2):
-        super()
         self.varname1 = symbol1
         self.varname2 = symbol2
         self.sheet_scope = "$$$GLOBAL$$$"
@@ -117,26 +128,10 @@ class IRVariableRange(IRNode):
 
 
 
-class SymbolNode(IRNode):
-
-    def __init__(self, symbol):
-        super()
-        self.symbol = symbol
-
-    def get_symbol(self):
-        return self.symbol
-    
-    def __str__(self):
-        return "SymbolNode<" + str(self.symbol) + ">"
-
-    def nodetype(self):
-        return "symbol"
-
-
 class UnaryOperationNode(IRNode):
+    __slots__ = ("op", "node")
 
     def __init__(self, op, node):
-        super()
         self.op = op 
         self.node = node 
 
@@ -158,9 +153,9 @@ class UnaryOperationNode(IRNode):
 
 
 class BinaryOperationNode(IRNode):
+    __slots__ = ("left", "op", "right")
 
     def __init__(self, l, op, r):
-        super()
         self.left = l 
         self.op = op 
         self.right = r
@@ -183,9 +178,9 @@ class BinaryOperationNode(IRNode):
 
 
 class FunctionCallNode(IRNode):
+    __slots__ = ("func_name", "params")
 
     def __init__(self, func_name, params):
-        super()
         self.func_name = func_name 
         self.params = params 
 
@@ -196,39 +191,121 @@ class FunctionCallNode(IRNode):
         return self.params
     
     def __str__(self):
-        return "FunctionCallNode<" + str(self.func_name) + "(" + ", ".join(self.params) + ")>"
+        return "FunctionCallNode<" + str(self.func_name) + "(" + ", ".join(str(p) for p in self.params) + ")>"
 
     def nodetype(self):
         return "function"
 
 
 
-def print_ast_nodes(formula_ast):
-    print_ast_nodes_r(formula_ast, 0)
+# the nodes directly under node, in order 
+def child_nodes(node):
+    t = node.nodetype()
+    if t == "binary":
+        return [node.get_left(), node.get_right()]
+    elif t == "unary":
+        return [node.get_node()]
+    elif t == "function":
+        return node.get_params()
+    return []
+
+
+
+# every node of the tree, parents before their children. Uses its own 
+# stack so very deep trees (long operator chains) are fine 
+def walk(formula_ast):
+    stack = [formula_ast]
+    while len(stack) > 0:
+        node = stack.pop()
+        yield node 
+        children = child_nodes(node)
+        for i in range(len(children) - 1, -1, -1):
+            stack.append(children[i])
+
+
+
+# node with its children replaced, node itself when they are the same ones 
+def with_children(node, children):
+    if all(a is b for a, b in zip(children, child_nodes(node))):
+        return node
+    t = node.nodetype()
+    if t == "unary":
+        return UnaryOperationNode(node.get_operator(), children[0])
+    elif t == "binary":
+        return BinaryOperationNode(children[0], node.get_operator(), children[1])
+    elif t == "function":
+        return FunctionCallNode(node.get_func_name(), children)
+    return node
 
 
-def print_ast_nodes_r(node, lvl):
+
+# a new tree built bottom up, fn(node, children) gives the node to use 
+# for node once its children have been through fn (the new children, in 
+# order). fn can give back something else than nodes too, the code 
+# generators build their code this way. Keeps its own stack like walk 
+def rebuild_ast(formula_ast, fn):
+    stack = [(formula_ast, None)]
+    done = []
+    while len(stack) > 0:
+        node, children = stack.pop()
+        if children is None:
+            children = child_nodes(node)
+            if len(children) == 0:
+                done.append(fn(node, children))
+                continue
+            stack.append((node, children))
+            for i in range(len(children) - 1, -1, -1):
+                stack.append((children[i], None))
+            continue
+        n = len(children)
+        new_children = done[-n:]
+        del done[-n:]
+        done.append(fn(node, new_children))
+    return done[0]
+
+
+
+# subclass and add visit_<nodetype> methods (visit_constant, visit_variable, 
+# visit_variablerange, visit_unary, visit_binary, visit_function). Types 
+# without a method go to generic_visit, which visits the children 
+class IRVisitor:
+
+    def visit(self, node):
+        method = getattr(self, "visit_" + node.nodetype(), None)
+        if method is None:
+            return self.generic_visit(node)
+        return method(node)
+
+    def generic_visit(self, node):
+        for child in child_nodes(node):
+            self.visit(child)
+
+
+
+# out is called with each line, diagnostics.trace for example 
+def print_ast_nodes(formula_ast, out=print):
+    print_ast_nodes_r(formula_ast, 0, out)
+
+
+def print_ast_nodes_r(node, lvl, out=print):
     
-    tab = ""
-    for i in range(0, lvl):
-        tab = tab + "  "
+    tab = "  " * lvl
     
     if node.nodetype() == "constant" \
-        or node.nodetype() == "symbol" \
         or node.nodetype() == "variable" \
         or node.nodetype() == "variablerange":
-        print(tab + str(node))
+        out(tab + str(node))
     elif node.nodetype() == "binary":
-        print_ast_nodes_r(node.get_left(), lvl+1)
-        print(tab + str(node.get_operator()))
-        print_ast_nodes_r(node.get_right(), lvl+1)
+        print_ast_nodes_r(node.get_left(), lvl+1, out)
+        out(tab + str(node.get_operator()))
+        print_ast_nodes_r(node.get_right(), lvl+1, out)
     elif node.nodetype() == "unary":
-        print(tab + str(node.get_operator()))
-        print_ast_nodes_r(node.get_node(), lvl+1)
+        out(tab + str(node.get_operator()))
+        print_ast_nodes_r(node.get_node(), lvl+1, out)
     elif node.nodetype() == "function":
-        print(tab + str(node.get_func_name()))
+        out(tab + str(node.get_func_name()))
         for p in node.get_params():
-            print_ast_nodes_r(p, lvl+1)
+            print_ast_nodes_r(p, lvl+1, out)
     else:
         raise Exception("dont have the code to print the type " + str(node.nodetype()))
     
@@ -236,45 +313,14 @@ def print_ast_nodes_r(node, lvl):
 
 
 
-# this is not the most correct way to do this, but I referred to these repos while making this:
-# - https://github.com/spreadsheetlab/XLParser
-# - 
-    
-
-# need to post process the tokens for handling strings, 
-# prob not setup the best 
-class ExcelFormulaLexer(Lexer):
-    NUMBER = r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?'
-    SINGLE_QUOTE = '\''
-    DBL_QUOTE = '\"'
-    CELLNAME = r'(\$?)[A-Za-z]([A-Za-z])*(\$?)([0-9])+'  # this just ends with numbers instead 
-    NAME = r'[A-Za-z_]([A-Za-z_0-9])*'   # this can have letters and numbers intermixed 
-    WHITESPACE = r'\s+'
-    L_BRACE = r'{'
-    R_BRACE = r'}'
-    L_BRACKET = r'\['
-    R_BRACKET = r'\]'
-    TRUE = r'TRUE'
-    FALSE = r'FALSE'
-    LPAREN = '\('
-    RPAREN = '\)'
-    EXCLAIMATION_POINT = '\!'
-    COMMA = r','
-    COLON = r':'
-    ADD = '\+'
-    SUB = '-'
-    MUL = '\*'
-    DIV = '/'
-    EQUALS_SIGN = '='
-    NOT_EQUALS_SIGN = '<>'
-    LESS_THAN_EQUAL = '<='
-    LESS_THAN = '<'
-    GREATER_THAN_EQUAL = '>='
-    GREATER_THAN = '>'
-    CARROT = '\^'
-    AMPERSAND = '\&'
-    REF= "!#REF!"
-    DOLLAR_SIGN = '\$'
+# the lexit based lexer the parser used before lexer.py, still around to 
+# check lexer.py against. It lives in lexit_lexer.py so importing this 
+# module doesn't import lexit 
+def __getattr__(name):
+    if name == "ExcelFormulaLexer":
+        from .lexit_lexer import ExcelFormulaLexer
+        return ExcelFormulaLexer
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
 
 
@@ -285,651 +331,452 @@ def serialize_IR_node():
     pass
 
 
-class Stack:
-    def __init__(self):
-        self.stk = []
-        self.ptr = -1
-    
-    def push(self, obj):
-        self.stk.append(obj)
-        self.ptr = self.ptr + 1
-
-    def pop(self):
-        if self.ptr >= 0:
-            ret = self.stk[self.ptr]
-            del self.stk[self.ptr]
-            self.ptr = self.ptr - 1
-            return ret
-        else:
-            return None
+# binary operators with their precedence, higher binds tighter. All of 
+# them are left associative in Excel, including ^ (2^3^2 is 64) 
+BINARY_OPERATORS = {
+    "EQUALS_SIGN" : ("=", 1),
+    "NOT_EQUALS_SIGN" : ("<>", 1),
+    "LESS_THAN" : ("<", 1),
+    "LESS_THAN_EQUAL" : ("<=", 1),
+    "GREATER_THAN" : (">", 1),
+    "GREATER_THAN_EQUAL" : (">=", 1),
+    "AMPERSAND" : ("&", 2),
+    "ADD" : ("+", 3),
+    "SUB" : ("-", 3),
+    "MUL" : ("*", 4),
+    "DIV" : ("/", 4),
+    "CARROT" : ("^", 5),
+}
+
+# negation binds tighter than ^ in Excel (-2^2 is 4), and % tighter still 
+PREFIX_PRECEDENCE = 6
+PERCENT_PRECEDENCE = 7
 
-    def peek(self):
-        if self.ptr >= 0:
-            return self.stk[self.ptr]
-        else:
-            return None 
-        
-    def size(self):
-        return len(self.stk)
 
 
 def excel_formula_to_IR(excel_formula, in_sheet="$$$GLOBAL$$$"):
     # print(excel_formula)
     
-    tokens_iter = list(ExcelFormulaLexer.lex(excel_formula))
-    # print(*tokens_iter, sep="\n")
-
-    # post process the tokens
-
-    if tokens_iter[0].type == "EQUALS_SIGN":
-        print('formula   ' + excel_formula)
-
-        node_stack = Stack()
-        token_string_processing_stk = Stack()
-
-        # counters+trackers, this is probably a bad way to do this kind of thing 
-        # cur_string = ""
-        # within_string_dbl_quote_counter = 0
-
-        ntokens = len(tokens_iter)
-        itr = 1
-        while itr < ntokens:
-            token = tokens_iter[itr]
-            if token is not None:
-                t = token.type 
-                v = token.value 
-                
-                # print(str(v) + " : " + str(t))
-
-                is_within_string = False 
-                is_within_single_quote_cell_ref = False
-
-                if token_string_processing_stk.size() > 0 and token_string_processing_stk.stk[0].type == "DBL_QUOTE":  # currently processing a string 
-                    is_within_string = True
-
-                if token_string_processing_stk.size() > 0 and token_string_processing_stk.stk[0].type == "SINGLE_QUOTE":  # currently processing a cell reference 
-                    is_within_single_quote_cell_ref = True
-
-                if is_within_string:
-
-                    def unravel_string():
-                        unraveled = ""
-                        unpopped = []
-                        ending_dbl_quote = token_string_processing_stk.pop()
-                        while token_string_processing_stk.size() > 1:
-                            next_token = token_string_processing_stk.pop()
-                            unpopped.append(next_token)
-                        starting_dbl_quote = token_string_processing_stk.pop()
-
-                        assert(ending_dbl_quote.type == "DBL_QUOTE" and starting_dbl_quote.type == "DBL_QUOTE")
-                        assert(token_string_processing_stk.size() == 0)
-                        # reverse order from the stack to rebuild the string correctly
-                        unpopped.reverse()
-                        for tok in unpopped:
-                            unraveled = unraveled + tok.value
-                        
-                        return unraveled
-
-                    # if a double quote and the next token is not a double quote, then end the string, 
-                    # unravel it, and construct a constant node out of it, 
-                    # which you can add to the stack 
-
-                    if t == 'DBL_QUOTE':
-
-                        if itr >= ntokens-1:
-                            # end of the formula? - end string (assumes all formulas have valid syntax)
-                            token_string_processing_stk.push(token)
-                            the_string = unravel_string()
-                            str_node = IRConstant(the_string)
-                            node_stack.push(str_node)
-
-                        elif tokens_iter[itr+1].type == 'DBL_QUOTE':
-                            # is the next one a double quote? - collapse to a single one, do not end the string 
-
-                            itr = itr + 1 # ignore the next double quote
-                            token_string_processing_stk.push(token) # don't end the string 
-                        else:
-                            # the next token after this double quote is not also a double quote, end the string
-                            token_string_processing_stk.push(token) 
-                            the_string = unravel_string()
-                            str_node = IRConstant(the_string)
-                            node_stack.push(str_node)
-
-                    else:
-                        # still in the string, so just add it to process like normal  
-                        token_string_processing_stk.push(token)
-                
-                elif is_within_single_quote_cell_ref:
-
-                    # this is going to be similar to the double quote case, only you don't have to handle double single quotes 
-                    if t == "SINGLE_QUOTE":
-                        # assuming valid syntax, so end this name and unravel the string 
-                        token_string_processing_stk.push(token)
-                        
-                        unraveled = ""
-                        unpopped = []
-                        ending_single_quote = token_string_processing_stk.pop()
-                        while token_string_processing_stk.size() > 1:
-                            next_token = token_string_processing_stk.pop()
-                            unpopped.append(next_token)
-                        starting_single_quote = token_string_processing_stk.pop()
-
-                        assert(ending_single_quote.type == "SINGLE_QUOTE" and starting_single_quote.type == "SINGLE_QUOTE")
-                        assert(token_string_processing_stk.size() == 0)
-                        # reverse order from the stack to rebuild the string correctly
-                        unpopped.reverse()
-                        for tok in unpopped:
-                            unraveled = unraveled + tok.value
-
-                        str_node = IRConstant(unraveled)
-                        node_stack.push(str_node)
-                    else:
-                        # still in the name, so just add it to process like normal  
-                        token_string_processing_stk.push(token)
-
-                else:
-                    if t == 'NUMBER':
-                        number_node = IRConstant(v)
-                        node_stack.push(number_node)
-                    elif t == 'SINGLE_QUOTE':  
-                        # single quotes outside of strings in Excel formulas mean:
-                        # - if it's the first token before =, then it's not a formula, but this case is already handled
-                        # - used to treat a cell reference as a single entity (i.e.  'another, sheet'!A5 to mean cell A5 in sheet "another, sheet")
-                        
-                        # the right strategy is probably to do something like you did for double strings, and collapse them into a single node
-                        if not is_within_single_quote_cell_ref: # redundant, but for readability
-                            token_string_processing_stk.push(token)
-                        else:
-                            raise Exception("Error processing string")
-
-                    elif t == 'DBL_QUOTE':
-                        
-                        if not is_within_string: # redundant, but for readability
-                            token_string_processing_stk.push(token)
-                        else:
-                            raise Exception("Error processing string")
-
-                    elif t == 'CELLNAME':
-                        cellname_node = IRVariable(v)
-                        node_stack.push(cellname_node)
-                    elif t == 'NAME':
-                        name_node = IRVariable(v)
-                        node_stack.push(name_node)
-                    elif t == 'WHITESPACE':
-                        pass # ignore whitespace outside of strings
-                    elif t == 'L_BRACE':
-                        lbrace_node = SymbolNode(v)
-                        node_stack.push(lbrace_node)
-                    elif t == 'R_BRACE':
-                        rbrace_node = SymbolNode(v)
-                        node_stack.push(rbrace_node)
-                    elif t == 'L_BRACKET':
-                        lbracket_node = SymbolNode(v)
-                        node_stack.push(lbracket_node)
-                    elif t == 'R_BRACKET':
-                        rbracket_node = SymbolNode(v)
-                        node_stack.push(rbracket_node)
-                    elif t == 'TRUE':
-                        true_node = IRConstant(True)
-                        node_stack.push(true_node)
-                    elif t == 'FALSE':
-                        false_node = IRConstant(False)
-                        node_stack.push(false_node)
-                    elif t == 'LPAREN':
-                        lparen_node = SymbolNode(v)
-                        node_stack.push(lparen_node)
-                    elif t == 'RPAREN':
-                        rparen_node = SymbolNode(v)
-                        node_stack.push(rparen_node)
-                    elif t == 'EXCLAIMATION_POINT':
-                        exclaimation_pt_node = SymbolNode(v)
-                        node_stack.push(exclaimation_pt_node)
-                    elif t == 'COMMA':
-                        comma_node = SymbolNode(v)
-                        node_stack.push(comma_node)
-                    elif t == 'COLON':
-                        colon_node = SymbolNode(v)
-                        node_stack.push(colon_node)
-                    elif t == 'ADD':
-                        add_node = SymbolNode(v)
-                        node_stack.push(add_node)
-                    elif t == 'SUB':
-                        sub_node = SymbolNode(v)
-                        node_stack.push(sub_node)
-                    elif t == 'MUL':
-                        mul_node = SymbolNode(v)
-                        node_stack.push(mul_node)
-                    elif t == 'DIV':
-                        div_node = SymbolNode(v)
-                        node_stack.push(div_node)
-                    elif t == 'EQUALS_SIGN':
-                        eq_node = SymbolNode(v)
-                        node_stack.push(eq_node)
-                    elif t == 'NOT_EQUALS_SIGN':
-                        eq_node = SymbolNode(v)
-                        node_stack.push(eq_node)
-                    elif t == 'LESS_THAN_EQUAL':
-                        less_than_eq_node = SymbolNode(v)
-                        node_stack.push(less_than_eq_node)
-                    elif t == 'LESS_THAN':
-                        less_than_node = SymbolNode(v)
-                        node_stack.push(less_than_node)
-                    elif t == 'GREATER_THAN_EQUAL':
-                        greater_than_eq_node = SymbolNode(v)
-                        node_stack.push(greater_than_eq_node)
-                    elif t == 'GREATER_THAN':
-                        greater_than_node = SymbolNode(v)
-                        node_stack.push(greater_than_node)
-                    elif t == 'CARROT':
-                        carrot_node = SymbolNode(v)
-                        node_stack.push(carrot_node)
-                    elif t == 'AMPERSAND':
-                        ampersand_node = SymbolNode(v)
-                        node_stack.push(ampersand_node)
-                    elif t == 'REF':
-                        ref_node = IRConstant(v)
-                        node_stack.push(ref_node)
-                    elif t == 'DOLLAR_SIGN':
-                        dollar_node = IRConstant(v)
-                        node_stack.push(dollar_node)
-                    else:
-                        raise Exception("Invalid token type " + str(t))
-                        
-            
-            itr = itr + 1
-
-        # construct syntax tree from the node stack 
-        nodes_ordered = list(node_stack.stk)
-        # nodes_ordered.reverse()
-
-        # for node in nodes_ordered:
-        #     print(node)
-
-        formula_ast = tokens_to_ast_Formula(nodes_ordered, in_sheet=in_sheet)
-
-        if formula_ast is not None:
-
-            print("parsed  ")
-
-            print_ast_nodes(formula_ast)
-
-            print(" ")
-            return formula_ast
-        else:
-            print("Failed to parse formula " + str(excel_formula))
-            return None 
-
-    else:
-        # this will probably never be seen 
-        print('constant')
-        print(tokens_iter[1:])
+    profile = profiling.active 
+    if profile is not None:
+        start = time.perf_counter()
     
+    tokens = tokenize(excel_formula)
+    # print(*tokens, sep="\n")
 
-    
-def tokens_to_ast_Formula(tokens, in_sheet=None):
-    ptr = 0
+    if profile is not None:
+        lexed = time.perf_counter()
+        profile.add_time("parse.lex", lexed - start)
+        profile.count("tokens_lexed", len(tokens))
 
-    parsed_node, ptr = tokens_to_ast_Expr(tokens, ptr, in_sheet=in_sheet)
-    if parsed_node is not None:
-        return parsed_node 
+    if len(tokens) > 0 and tokens[0].type == "EQUALS_SIGN":
+        if diagnostics.tracing:
+            diagnostics.trace('formula   ' + excel_formula)
 
-    # nothing matched, what happened?    
-    return None 
+        formula_ast, ptr = parse_expr(tokens, 1, 0, in_sheet)
+        if profile is not None:
+            profile.add_time("parse.ast", time.perf_counter() - lexed)
+        if ptr < len(tokens):
+            raise Exception("Unexpected " + str(tokens[ptr].value) + " at column " + str(tokens[ptr].column) + " in formula " + str(excel_formula))
 
+        if diagnostics.tracing:
+            diagnostics.trace("parsed  ")
+            print_ast_nodes(formula_ast, out=diagnostics.trace)
+            diagnostics.trace(" ")
 
+        return formula_ast 
 
-def tokens_to_ast_Function(tokens, ptr, in_sheet=None):
+    else:
+        # this will probably never be seen 
+        if diagnostics.debug_enabled:
+            diagnostics.debug('constant')
+            diagnostics.debug(tokens[1:])
 
-    # print("checking if its a function, ptr = " + str(ptr) + ", token = " + str(tokens[ptr]) )
 
-    func_name = None 
-    params = []
-    inc_ptr = ptr 
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "variable":
-        # match function name 
-        func_name = tokens[inc_ptr].get_varname()
-        inc_ptr = inc_ptr + 1
-    else:
-        return None, ptr 
-    
-    # print("got function name, is the next symbol a (" )
 
-    # match (
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-        if tokens[inc_ptr].get_symbol() == '(':
-            inc_ptr = inc_ptr + 1
-            # print("yeah next symbol is (" )
-        else:
-            # print("no next symbol is actually " + str(tokens[inc_ptr].get_symbol()) )
-            return None, ptr
-    else:
-        # print("next node is not a symbol at all")
-        return None, ptr
-    
+# precedence climbing over the lexer tokens. Parses the longest expression 
+# starting at ptr whose operators bind at least as tight as min_prec, and 
+# returns (AST, index of the first token after it). Operator chains are 
+# handled by the loop, only parentheses and right operands recurse 
+def parse_expr(tokens, ptr, min_prec, in_sheet):
 
-    # match 0 or more params 
+    left, ptr = parse_prefix(tokens, ptr, in_sheet)
 
-    func_ended = False 
-    param_num = 1
+    ntokens = len(tokens)
+    while ptr < ntokens:
+        t = tokens[ptr].type 
 
-    while not func_ended:
+        if t == "PERCENT":
+            if PERCENT_PRECEDENCE < min_prec:
+                break 
+            left = UnaryOperationNode("%", left)
+            ptr = ptr + 1
+            continue 
 
-        param_node = None 
+        op = BINARY_OPERATORS.get(t)
+        if op is None or op[1] < min_prec:
+            break 
 
-        # print("parsing parameter # " + str(param_num))
+        right, ptr = parse_expr(tokens, ptr + 1, op[1] + 1, in_sheet)
+        left = BinaryOperationNode(left, op[0], right)
 
-        if param_node is None:
-            param_node, inc_ptr = tokens_to_ast_Expr(tokens, inc_ptr, in_sheet=in_sheet)
+    return left, ptr 
 
-        if param_node is not None:
-            params.append(param_node)
-        else:
-            # syntax error 
-            print("Cannot match param for a function")
-            return None, ptr 
-
-        # match comma or not
-        matched_comma = False 
-        if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-            if tokens[inc_ptr].get_symbol() == ',':
-                matched_comma = True  
-                inc_ptr = inc_ptr + 1
-
-        # if did not match a comma, need ) 
-
-        # match )
-        if not matched_comma:
-            # print("Didn't match a comma, is it gonna match ) to end the function?")
-            if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-                if tokens[inc_ptr].get_symbol() == ')':
-                    func_ended = True  
-                    inc_ptr = inc_ptr + 1
-                    # print("I ended the function, it matched )")
 
-        
-        
-        param_num = param_num + 1
 
-        if not matched_comma and not func_ended:
-            print("badly formed function call. Need to check the parser or your syntax")
-            return None, ptr 
+# an operand: constant, reference, function call, parenthesized 
+# expression, or one of those with a sign in front 
+def parse_prefix(tokens, ptr, in_sheet):
 
-    # print("got params")
-    # for p in params:
-    #     print(p)
+    if ptr >= len(tokens):
+        raise Exception("Formula ended where a value was expected")
 
+    token = tokens[ptr]
+    t = token.type 
+    v = token.value 
 
-    # matched, construct function node and return 
-    func_node = FunctionCallNode(func_name, params)
+    if t == "SUB" or t == "ADD":
+        operand, ptr = parse_expr(tokens, ptr + 1, PREFIX_PRECEDENCE, in_sheet)
+        return UnaryOperationNode(v, operand), ptr 
 
-    return func_node, inc_ptr
+    elif t == "NUMBER":
+        if "." in v or "e" in v or "E" in v:
+            return IRConstant(float(v)), ptr + 1
+        return IRConstant(int(v)), ptr + 1
 
+    elif t == "STRING":
+        return IRConstant(v), ptr + 1
 
-# taking from https://en.wikipedia.org/wiki/Recursive_descent_parser
+    elif t == "BOOL":
+        return IRConstant(v == "TRUE"), ptr + 1
 
-# thing that is collapsed to add/subtract/multiply/divide/other non-function operators
-# + or - a bunch of terms
-def tokens_to_ast_Expr(tokens, ptr, in_sheet=None):
-    lnode = None 
-    rnode = None 
-    bin_op = None 
-    unary_op = None
-    inc_ptr = ptr 
+    elif t == "ERROR":
+        return IRError(v), ptr + 1
 
-    # print("expr, ptr = " + str(inc_ptr) + ", " + str(tokens[inc_ptr]))
-    
-    # first - or + for negative or positive, unary operator 
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-        if tokens[inc_ptr].get_symbol() == '+':
-            inc_ptr = inc_ptr + 1
-            unary_op = tokens[inc_ptr].symbol()
-        elif tokens[inc_ptr].get_symbol() == '-':
-            inc_ptr = inc_ptr + 1
-            unary_op = tokens[inc_ptr].symbol()
-    
-    lnode, inc_ptr = tokens_to_ast_Term(tokens, inc_ptr, in_sheet=in_sheet)
-
-    # there is an issue where the factor is not keeping the previous term, skips and doesn't return
-
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-        valid_ops = [
-            '&', '+', '-', '<', '>',
-            '=', '<>', '<=', '>='
-        ]
-        if inc_ptr < len(tokens) and tokens[inc_ptr].get_symbol() in valid_ops:
-            bin_op = tokens[inc_ptr].get_symbol()
-            inc_ptr = inc_ptr + 1
-            rnode, inc_ptr = tokens_to_ast_Term(tokens, inc_ptr, in_sheet=in_sheet)
-            
-        else:
-            pass # print("invalid binary operator in Expr " + str(tokens[inc_ptr].get_symbol()))
-        
-    ret_node = None
-    if lnode is not None and unary_op is None and rnode is None and bin_op is None:
-        # single term only 
-        ret_node = lnode
-    if lnode is not None and unary_op is not None and rnode is None and bin_op is None:
-        # unary only 
-        ret_node = UnaryOperationNode(unary_op, lnode)
-    elif lnode is not None and unary_op is None and rnode is not None and bin_op is not None:
-        # binary op only
-        ret_node = BinaryOperationNode(lnode, bin_op, rnode)
-    elif lnode is not None and unary_op is not None and rnode is not None and bin_op is not None:
-        # binary and unary operations on both ends (i.e. -A1+B2  )
-        bin_node = BinaryOperationNode(lnode, bin_op, rnode)
-        ret_node = UnaryOperationNode(unary_op, bin_node)
-
-    # print("returning this from expr: " + str(ret_node))
-    
-    return ret_node, inc_ptr 
+    elif t == "LPAREN":
+        node, ptr = parse_expr(tokens, ptr + 1, 0, in_sheet)
+        ptr = expect(tokens, ptr, "RPAREN")
+        return node, ptr 
 
+    elif t == "NAME" and ptr + 1 < len(tokens) and tokens[ptr + 1].type == "LPAREN":
+        return parse_function_call(tokens, ptr, in_sheet)
 
+    elif t == "SHEET" or t == "CELLNAME" or t == "RANGE" or t == "NAME":
+        return parse_reference(tokens, ptr, in_sheet)
 
-# *, / etc
-def tokens_to_ast_Term(tokens, ptr, in_sheet=None):
-    inc_ptr = ptr 
-    
-    lfactor = None 
-    rfactor = None 
-    op = None 
-
-    # print("term, ptr = " + str(inc_ptr) + ", " + str(tokens[inc_ptr]))
-
-    lfactor, inc_ptr = tokens_to_ast_Factor(tokens, inc_ptr, in_sheet=in_sheet)
-
-    # there is an issue where the factor is not keeping the previous term, skips and doesn't return
-
-    # match operator, if it exists 
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-        # is it a valid symbol?
-        valid_ops = [
-            '*', '/', '^'
-        ]
-        if inc_ptr < len(tokens) and tokens[inc_ptr].get_symbol() in valid_ops:
-            op = tokens[inc_ptr].get_symbol()
-            inc_ptr = inc_ptr + 1
-            rfactor, inc_ptr = tokens_to_ast_Factor(tokens, inc_ptr, in_sheet=in_sheet)
-        else:
-            pass # not an operator for term
-        
-    else:
-        # no operator, might just be a factor by itself 
-        pass 
-
-    ret_node = None
-    if lfactor is not None and op is None and rfactor is None:
-        ret_node = lfactor
-    elif lfactor is not None and op is not None and rfactor is not None:
-        ret_node = BinaryOperationNode(lfactor, op, rfactor)
     else:
-        raise Exception("Did not assemble term properly, vars are \nlfactor = "+str(lfactor)+"\nop = "+str(op)+"\nrfactor = "+str(rfactor))
-        
-    # print("returning this from term: " + str(ret_node))
-    
-    return ret_node, inc_ptr
+        raise Exception("Unexpected " + str(v) + " at column " + str(token.column))
 
-    
 
-# factors are reduced to cell references, expressions, constants or function calls
-def tokens_to_ast_Factor(tokens, ptr, in_sheet=None):
-    inc_ptr = ptr 
 
-    # print("factor, ptr = " + str(inc_ptr) + ", " + str(tokens[inc_ptr]))
+# NAME ( expr , expr ... ). An empty argument (SUM(1,,2)) is kept as a 
+# None constant so the positions of the others don't move. An empty 
+# branch of IF / IFERROR / IFNA is 0, that is what Excel gives for 
+# IF(A1,,2) when A1 is TRUE 
+def parse_function_call(tokens, ptr, in_sheet):
 
-    factor_node = None 
-        
-    if factor_node is None:
-        # print("checking if its a function")
-        factor_node, inc_ptr = tokens_to_ast_Function(tokens, inc_ptr)     
-    
-    if factor_node is None:
-        # print("checking if its a cell reference")
-        factor_node, inc_ptr = tokens_to_ast_CellRef(tokens, inc_ptr, in_sheet)
-    
-    if factor_node is None:
-        # print("checking if its a constant")
-        factor_node, inc_ptr = tokens_to_ast_Constant(tokens, inc_ptr)
-
-    # if factor_node is None:
-    #     factor_node, inc_ptr = tokens_to_ast_Expr(tokens, inc_ptr) # infinite recursion if I leave this
-
-    # match (
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-        # print("checking if its another expression")
-        if tokens[inc_ptr].get_symbol() == '(':
-            inc_ptr = inc_ptr + 1
-
-            if factor_node is None:
-                factor_node, inc_ptr = tokens_to_ast_Expr(tokens, inc_ptr, in_sheet=in_sheet)
-            
-            
-            if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-                if tokens[inc_ptr].get_symbol() == ')':
-                    inc_ptr = inc_ptr + 1
-                else:
-                    return None, ptr 
-    
-    # print("factor_node is " + str(factor_node))
+    func_name = tokens[ptr].value 
+    ptr = ptr + 2 
+    branches = function_key(func_name) in ("IF", "IFERROR", "IFNA")
+
+    params = []
+    if ptr < len(tokens) and tokens[ptr].type == "RPAREN":
+        return FunctionCallNode(func_name, params), ptr + 1
 
-    # not a factor?
-    return factor_node, inc_ptr 
+    while True:
+        if ptr < len(tokens) and (tokens[ptr].type == "COMMA" or tokens[ptr].type == "RPAREN"):
+            params.append(IRConstant(0) if branches and len(params) > 0 else IRConstant(None))
+        else:
+            param_node, ptr = parse_expr(tokens, ptr, 0, in_sheet)
+            params.append(param_node)
 
+        if ptr < len(tokens) and tokens[ptr].type == "COMMA":
+            ptr = ptr + 1
+        else:
+            ptr = expect(tokens, ptr, "RPAREN")
+            return FunctionCallNode(func_name, params), ptr 
+
+
+
+# [SHEET] CELLNAME / RANGE / NAME, optionally followed by : and a second 
+# reference for ranges the lexer didn't join (A1 : B2, Sheet1!A1:Sheet1!B2)
+def parse_reference(tokens, ptr, in_sheet):
+
+    sheet = in_sheet 
+    if tokens[ptr].type == "SHEET":
+        sheet = tokens[ptr].value 
+        ptr = ptr + 1
+        if ptr >= len(tokens):
+            raise Exception("Sheet " + str(sheet) + " without a reference")
+        if tokens[ptr].type == "ERROR":
+            return IRError(tokens[ptr].value), ptr + 1  # Sheet1!#REF!
+
+    token = tokens[ptr]
+    if token.type == "RANGE":
+        first, last = token.value.split(":")
+        node = IRVariableRange(first, last)
+        node.set_sheet_scope(sheet)
+        return node, ptr + 1
+
+    if token.type != "CELLNAME" and token.type != "NAME":
+        raise Exception("Expected a reference, got " + str(token.value) + " at column " + str(token.column))
+    ptr = ptr + 1
+
+    if ptr + 1 < len(tokens) and tokens[ptr].type == "COLON":
+        end = ptr + 1
+        if tokens[end].type == "SHEET" and tokens[end].value == sheet:
+            end = end + 1
+        if end < len(tokens) and (tokens[end].type == "CELLNAME" or tokens[end].type == "NAME"):
+            node = IRVariableRange(token.value, tokens[end].value)
+            node.set_sheet_scope(sheet)
+            return node, end + 1
+
+    node = IRVariable(token.value)
+    node.set_sheet_scope(sheet)
+    return node, ptr 
+
+
+
+def expect(tokens, ptr, token_type):
+    if ptr >= len(tokens):
+        raise Exception("Formula ended, expected " + token_type)
+    if tokens[ptr].type != token_type:
+        raise Exception("Expected " + token_type + ", got " + str(tokens[ptr].value) + " at column " + str(tokens[ptr].column))
+    return ptr + 1
+
+
+
+# shared formulas (see ExcelScanResults.record_shared_formula) come through 
+# as a single entry with "ref" set to the range they apply to, and are 
+# only parsed once for the master cell. Use expand_shared_formula to get 
+# the AST of the other cells in the range 
+# the same formula copied to other cells is only parsed once when a 
+# parse_cache.FormulaParseCache is passed in 
+def parse_formulas_csv(formulas_csv, cache=None):
+    with open(formulas_csv, "r") as f:
+        rdr = csv.DictReader(f)
+        return parse_formula_rows(rdr, cache=cache)
 
-# this could also be a range of cells (cell ref : cell ref)
-def tokens_to_ast_CellRef(tokens, ptr, in_sheet=None):
-    inc_ptr = ptr
 
-    cellname = None 
-    sheetname = None 
 
-    is_range = False 
+# same as parse_formulas_csv for the binary file from gen.dump_scanned_formulas_bin 
+def parse_formulas_bin(formulas_bin, cache=None):
+    with IntermediateFile(formulas_bin) as f:
+        return parse_formula_rows(f, cache=cache)
 
-    range_cellname_end = None 
 
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "variable":
-        is_variable = True 
-        cellname =  tokens[inc_ptr].get_varname()
-        inc_ptr = inc_ptr + 1
 
-        # no sheet ref, so implied to be in the same sheet
-        sheetname = in_sheet
-    else:
-        if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "constant":
-            is_const = True  
-            sheetname = tokens[inc_ptr].get_value()
-            inc_ptr = inc_ptr + 1
-        else:
-            return None, ptr 
+# rows are dicts with formula_id, sheet, cell_or_name, formula and ref. 
+# Without errors the first formula that fails raises, with a 
+# ParseErrorReport the failure is recorded there and parsing goes on 
+def parse_formula_rows(rows, cache=None, errors=None):
+    formulas_parsed = []
+    for row in rows:
+        formula_id = int(row["formula_id"])
+        sheet = row["sheet"]
+        name = row["cell_or_name"]
+        formula = row["formula"]
+        ref = row.get("ref") or None 
         
+        try:
 
-        if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-            if tokens[inc_ptr].get_symbol() == "!":
-                pass # ! to indicate sheet name before the symbol
-                inc_ptr = inc_ptr + 1
+            if cache is not None:
+                nodes = cache.parse(formula, in_sheet=sheet, cell=name)
             else:
-                return None, ptr 
-        else:
-            return None, ptr 
+                nodes = excel_formula_to_IR(formula, in_sheet=sheet)
+            formulas_parsed.append({
+                "formula_id" : formula_id,  # unique formula id 
+                "sheet" : sheet,  # sheet it was in 
+                "name" : name,  # cell ref or variable name. This will also be unique! I think?
+                "formula" : formula,  # text of the formula from excel 
+                "parsed" : nodes,  # AST object of this formula 
+                "ref" : ref,  # range a shared formula applies to, None for single cells 
+            })
+        except Exception as e:
+            if errors is not None:
+                errors.record(formula_id, sheet, name, formula, e)
+                continue 
+            raise Exception("Could not parse formula_id " + str(formula_id) + ", " + str(sheet) + "!" + str(name) + " " + str(formula) + ": " + str(e))
 
-        if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "variable":
-            is_variable = True  
-            cellname =  tokens[inc_ptr].get_varname()
-            inc_ptr = inc_ptr + 1
-        else:
-            return None, ptr 
+    return formulas_parsed
 
 
-    # check for : here to see if it's a range! 
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "symbol":
-        if tokens[inc_ptr].get_symbol() == ":":
-            inc_ptr = inc_ptr + 1
 
-            # this is a range, the next symbol must be a variable 
+# the formulas that failed to parse in a batch, one entry per formula 
+class ParseErrorReport:
 
-            if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "variable":
-                is_variable = True  
-                range_cellname_end =  tokens[inc_ptr].get_varname()
-                is_range = True
-                inc_ptr = inc_ptr + 1
-            else:
-                return None, ptr 
+    def __init__(self):
+        self.errors = []
+
+    def record(self, formula_id, sheet, name, formula, e):
+        self.errors.append({
+            "formula_id" : formula_id,
+            "sheet" : sheet,
+            "name" : name,
+            "formula" : formula,
+            "error_type" : type(e).__name__,
+            "message" : str(e),
+            "traceback" : traceback.format_exc(),
+        })
+
+    def merge(self, other):
+        self.errors.extend(other.errors)
+
+    def get_errors(self):
+        return self.errors 
+
+    def count(self):
+        return len(self.errors)
+
+    # number of failures for each error type 
+    def summary(self):
+        counts = dict()
+        for err in self.errors:
+            counts[err["error_type"]] = counts.get(err["error_type"], 0) + 1
+        return counts 
+
+    def sort(self):
+        self.errors.sort(key=lambda err: err["formula_id"])
+
+    def write_csv(self, path):
+        with open(path, "w", newline="") as f:
+            fields = ["formula_id", "sheet", "name", "formula", "error_type", "message"]
+            wrtr = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            wrtr.writeheader()
+            for err in self.errors:
+                wrtr.writerow(err)
+
+    def print_report(self, limit=20):
+        print(str(self.count()) + " formulas failed to parse " + str(self.summary()))
+        for err in self.errors[:limit]:
+            print("  formula_id " + str(err["formula_id"]) + " " + str(err["sheet"]) + "!" + str(err["name"]) + " " + str(err["formula"]))
+            print("    " + err["error_type"] + ": " + err["message"])
+        if self.count() > limit:
+            print("  ...")
+
+
+
+# parses a formulas file (excel_formulas.csv or excel_formulas.bin) in 
+# chunks of chunk_size formulas spread over a pool of worker processes. 
+# Returns (parsed formulas in formula_id order, ParseErrorReport), a bad 
+# formula doesn't stop the others. workers=1 parses in this process. 
+# Each worker keeps its own parse cache when use_cache is set 
+def parse_formulas_batch(formulas_path, workers=None, chunk_size=2000, use_cache=True):
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    is_bin = formulas_path.endswith(".bin")
+    if is_bin:
+        with IntermediateFile(formulas_path) as f:
+            count = f.count 
+        chunks = [(start, min(start + chunk_size, count)) for start in range(0, count, chunk_size)]
+    else:
+        with open(formulas_path, "r") as f:
+            rows = list(csv.DictReader(f))
+        chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
 
+    formulas_parsed = []
+    errors = ParseErrorReport()
+
+    if workers <= 1:
+        open_worker_formulas(formulas_path if is_bin else None, use_cache)
+        try:
+            for parsed, chunk_errors in map(parse_chunk, chunks):
+                formulas_parsed.extend(parsed)
+                errors.merge(chunk_errors)
+        finally:
+            close_worker_formulas()
+    else:
+        import concurrent.futures  # not imported with the module, most runs parse in one process 
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=open_worker_formulas, initargs=(formulas_path if is_bin else None, use_cache, diagnostics.get_level())) as pool:
+            for parsed, chunk_errors in pool.map(parse_chunk, chunks):
+                formulas_parsed.extend(parsed)
+                errors.merge(chunk_errors)
 
-    # parsed the cell name
-    if is_range:
-        rangenode = IRVariableRange(cellname, range_cellname_end)
-        if sheetname is not None:
-            rangenode.set_sheet_scope(sheetname)
+    formulas_parsed.sort(key=lambda formula_obj: formula_obj["formula_id"])
+    errors.sort()
 
-        return rangenode, inc_ptr
-    else:
-        varnode = IRVariable(cellname)
-        if sheetname is not None:
-            varnode.set_sheet_scope(sheetname)
-    
-        return varnode, inc_ptr
+    return formulas_parsed, errors 
 
 
 
-def tokens_to_ast_Constant(tokens, ptr):
-    inc_ptr = ptr
-    if inc_ptr < len(tokens) and tokens[inc_ptr].nodetype() == "constant":
-        pass 
-    else:
-        return None, ptr 
-    const_node = tokens[inc_ptr]
-    inc_ptr = inc_ptr + 1
-    return const_node, inc_ptr
+# like gen.open_worker_workbook, each worker opens the binary formulas 
+# file once and is then handed index ranges of it 
+worker_formulas = None 
+worker_cache = None 
 
 
+def open_worker_formulas(formulas_bin, use_cache, diagnostics_level=None):
+    global worker_formulas, worker_cache
+    if diagnostics_level is not None:
+        diagnostics.set_level(diagnostics_level)
+    worker_formulas = IntermediateFile(formulas_bin) if formulas_bin is not None else None 
+    worker_cache = None 
+    if use_cache:
+        from .parse_cache import FormulaParseCache  # parse_cache imports this module 
+        worker_cache = FormulaParseCache()
 
-def parse_formulas_csv(formulas_csv):
-    formulas_parsed = []
-    with open(formulas_csv, "r") as f:
-        rdr = csv.DictReader(f)
-        for row in rdr:
-            formula_id = int(row["formula_id"])
-            sheet = row["sheet"]
-            name = row["cell_or_name"]
-            formula = row["formula"]
-            
-            try:
 
-                nodes = excel_formula_to_IR(formula, in_sheet=sheet)
-                formulas_parsed.append({
-                    "formula_id" : formula_id,  # unique formula id 
-                    "sheet" : sheet,  # sheet it was in 
-                    "name" : name,  # cell ref or variable name. This will also be unique! I think?
-                    "formula" : formula,  # text of the formula from excel 
-                    "parsed" : nodes,  # AST object of this formula 
-                })
-            except Exception as e:
-                print("formula_id = " + str(formula_id))
-                print("Exception: " + str(e))
-                print(traceback.format_exc())
-                quit()
 
-    return formulas_parsed
+def close_worker_formulas():
+    global worker_formulas, worker_cache
+    if worker_formulas is not None:
+        worker_formulas.close()
+    worker_formulas = None 
+    worker_cache = None 
 
 
 
+# chunk is a (start, end) range of the binary file or a list of csv rows 
+def parse_chunk(chunk):
+    if worker_formulas is not None:
+        rows = [worker_formulas.row(k) for k in range(chunk[0], chunk[1])]
+    else:
+        rows = chunk 
+    errors = ParseErrorReport()
+    parsed = parse_formula_rows(rows, cache=worker_cache, errors=errors)
+    return parsed, errors 
+
+
+
+# the AST with its relative references moved by drow rows and dcol 
+# columns, the same as copying the formula to another cell. Names and $ 
+# anchored parts are left alone, parts without references are shared 
+# with node. Built with rebuild_ast so long chains don't recurse 
+def shift_ast(node, drow, dcol):
+
+    def shift(node, children):
+        t = node.nodetype()
+        if t == "variable":
+            shifted = IRVariable(shift_ref(node.get_varname(), drow, dcol))
+            shifted.set_sheet_scope(node.get_sheet_scope())
+            return shifted 
+        elif t == "variablerange":
+            shifted = IRVariableRange(shift_ref(node.get_varname1(), drow, dcol), shift_ref(node.get_varname2(), drow, dcol))
+            shifted.set_sheet_scope(node.get_sheet_scope())
+            return shifted 
+        return with_children(node, children)  # constants don't move 
+
+    return rebuild_ast(node, shift)
+
+
+
+# (cell, AST) for every cell a shared formula applies to, the master cell 
+# first. The master AST is shifted, nothing is parsed again 
+def expand_shared_formula(formula_obj):
+    nodes = formula_obj["parsed"]
+    ref = formula_obj.get("ref")
+    if ref is None:
+        yield formula_obj["name"], nodes 
+        return 
+
+    mcol, mrow = split_coordinate(formula_obj["name"])
+    c1, r1, c2, r2 = parse_range(ref)
+    for row in range(r1, r2 + 1):
+        for col in range(c1, c2 + 1):
+            cell = format_cell_ref(col, row)
+            if row == mrow and col == mcol:
+                yield cell, nodes 
+            else:
+                yield cell, shift_ast(nodes, row - mrow, col - mcol)
@@ -0,0 +1,224 @@
+
+# memoizing layer in front of excel_formula_to_IR. Most formulas in a
+# sheet are the same formula copied down or across (=B2*C2, =B3*C3, ...),
+# so each formula is turned into a key where the relative references are
+# written as offsets from the cell (R1C1 style, =R[0]C[-2]*R[0]C[-1]).
+# Each distinct key is parsed once, and the cached AST is rebuilt for the
+# target cell with its references moved, instead of parsing again.
+#
+# The AST that comes back is shared: the cell a shape was first parsed
+# for gets the cached AST itself, and every rebuilt AST shares its
+# constant nodes with it. That is only safe because an AST is never
+# changed once it is built: shift_ast and the optimize.py passes build
+# new nodes, the code generators only read them. Keep it that way.
+
+from collections import OrderedDict
+
+from .parse import excel_formula_to_IR, walk, IRVariable, IRVariableRange, BinaryOperationNode, UnaryOperationNode, FunctionCallNode
+from .refs import parse_cell_ref, map_formula_refs, shift_ref, column_to_index, index_to_column, FORMULA_REF_RE, MAX_COL, MAX_ROW
+
+
+# the kinds of step in a rebinder, see make_rebinder
+MOVE = 0
+CONSTANT = 1
+BINARY = 2
+UNARY = 3
+FUNCTION = 4
+
+
+class FormulaParseCache:
+
+    # maxsize is the number of distinct formula shapes kept, least
+    # recently used ones are dropped first
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # (sheet, key) -> (AST, rebinder, origin col, origin row)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def parse(self, formula, in_sheet="$$$GLOBAL$$$", cell=None):
+
+        origin = None
+        if cell is not None:
+            parsed = parse_cell_ref(cell)
+            if parsed is not None:
+                origin = (parsed[0], parsed[1])
+
+        if origin is None:
+            key = (in_sheet, formula)  # defined names etc, nothing to be relative to
+        else:
+            key = (in_sheet, relative_key(formula, origin[0], origin[1]))
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+            nodes, rebind, ocol, orow = entry
+            if nodes is None or origin is None or (ocol == origin[0] and orow == origin[1]):
+                return nodes
+            return rebind(origin[1] - orow, origin[0] - ocol)
+
+        self.misses = self.misses + 1
+        nodes = excel_formula_to_IR(formula, in_sheet=in_sheet)
+        if origin is None or nodes is None:
+            self.entries[key] = (nodes, None, None, None)
+        else:
+            self.entries[key] = (nodes, make_rebinder(nodes), origin[0], origin[1])
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+        return nodes
+
+
+    def clear(self):
+        self.entries.clear()
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+            "size" : len(self.entries),
+            "hit_rate" : (self.hits / lookups) if lookups > 0 else 0.0,
+        }
+
+
+
+# the formula text with relative references replaced by their offset from
+# (col, row), absolute parts stay as they are
+def relative_key(formula, col, row):
+
+    if '"' in formula or "'" in formula:
+        # strings and quoted sheet names have to be skipped, the slower way
+        def relative(ref_col, ref_row, col_abs, row_abs):
+            r = ""
+            c = ""
+            if ref_row is not None:
+                r = "R" + str(ref_row) if row_abs else "R[" + str(ref_row - row) + "]"
+            if ref_col is not None:
+                c = "C" + str(ref_col) if col_abs else "C[" + str(ref_col - col) + "]"
+            return r + c
+
+        return map_formula_refs(formula, relative)
+
+    # the common case, the text with the references blanked out plus the
+    # list of offsets. findall does the matching without a python callback.
+    # Relative offsets are pushed below zero (by MAX_COL / MAX_ROW) so they
+    # can't be mistaken for an absolute column or row
+    offsets = []
+    for cell, cabs, letters, rabs, digits, cols, rows in FORMULA_REF_RE.findall(formula):
+        if cell:
+            ref_col = column_to_index(letters)
+            ref_row = int(digits)
+            if ref_col > MAX_COL or ref_row < 1 or ref_row > MAX_ROW:
+                offsets.append(cell)  # off the sheet, a name like ZZZ1 that doesn't move
+                offsets.append(None)
+                continue
+            offsets.append(ref_col if cabs else ref_col - col - MAX_COL)
+            offsets.append(ref_row if rabs else ref_row - row - MAX_ROW)
+        else:
+            # whole columns / rows, rare enough to do as text
+            for side in (cols or rows).split(":"):
+                part = side.lstrip("$")
+                if side.startswith("$"):
+                    offsets.append(side)
+                elif part.isdigit():
+                    offsets.append("R[" + str(int(part) - row) + "]")
+                else:
+                    offsets.append("C[" + str(column_to_index(part) - col) + "]")
+
+    return (FORMULA_REF_RE.sub("\x00", formula), tuple(offsets))
+
+
+
+# does the same as parse.shift_ast, but the references are taken apart
+# once up front, so rebuilding the AST for another cell is only integer
+# arithmetic. Returns a function (drow, dcol) -> AST. The tree is turned
+# into a list of steps in reverse walk order (children before parents,
+# last child first) that run with a stack of built nodes, so neither
+# making nor running a rebinder recurses on long chains
+def make_rebinder(formula_ast):
+    steps = []
+    for node in reversed(list(walk(formula_ast))):
+        t = node.nodetype()
+        if t == "variable":
+            steps.append((MOVE, make_variable_mover(node)))
+        elif t == "variablerange":
+            steps.append((MOVE, make_range_mover(node)))
+        elif t == "binary":
+            steps.append((BINARY, node.get_operator()))
+        elif t == "unary":
+            steps.append((UNARY, node.get_operator()))
+        elif t == "function":
+            steps.append((FUNCTION, (node.get_func_name(), len(node.get_params()))))
+        else:
+            steps.append((CONSTANT, node))  # constants don't move, the node is shared
+
+    def rebind(drow, dcol):
+        stack = []
+        for kind, arg in steps:
+            if kind == MOVE:
+                stack.append(arg(drow, dcol))
+            elif kind == CONSTANT:
+                stack.append(arg)
+            elif kind == BINARY:
+                left = stack.pop()
+                stack.append(BinaryOperationNode(left, arg, stack.pop()))
+            elif kind == UNARY:
+                stack.append(UnaryOperationNode(arg, stack.pop()))
+            else:
+                func_name, nparams = arg
+                stack.append(FunctionCallNode(func_name, [stack.pop() for i in range(0, nparams)]))
+        return stack[0]
+
+    return rebind
+
+
+def make_variable_mover(node):
+    sheet = node.get_sheet_scope()
+    move = make_ref_mover(node.get_varname())
+    def rebind_variable(drow, dcol):
+        v = IRVariable(move(drow, dcol))
+        v.set_sheet_scope(sheet)
+        return v
+    return rebind_variable
+
+
+def make_range_mover(node):
+    sheet = node.get_sheet_scope()
+    move1 = make_ref_mover(node.get_varname1())
+    move2 = make_ref_mover(node.get_varname2())
+    def rebind_range(drow, dcol):
+        v = IRVariableRange(move1(drow, dcol), move2(drow, dcol))
+        v.set_sheet_scope(sheet)
+        return v
+    return rebind_range
+
+
+
+# function (drow, dcol) -> moved reference text, see refs.shift_ref
+def make_ref_mover(ref):
+    parsed = parse_cell_ref(ref)
+    if parsed is None:
+        return lambda drow, dcol: shift_ref(ref, drow, dcol)  # names, whole columns/rows
+
+    col, row, col_abs, row_abs = parsed
+    col_prefix = "$" if col_abs else ""
+    row_prefix = "$" if row_abs else ""
+
+    if col_abs and row_abs:
+        return lambda drow, dcol: ref
+
+    def move(drow, dcol):
+        c = col if col_abs else col + dcol
+        r = row if row_abs else row + drow
+        if c < 1 or c > MAX_COL or r < 1 or r > MAX_ROW:
+            return "#REF!"
+        return col_prefix + index_to_column(c) + row_prefix + str(r)
+
+    return move
@@ -0,0 +1,164 @@
+
+# the whole scan -> parse -> codegen run that test/test.py does by hand,
+# as one function, with each step timed as a profiling phase
+#
+#   profile = profiling.PipelineProfile(trace_memory=True)
+#   with profile:
+#       build("model.xlsx", "workspace")
+#   profile.write_json("workspace/profile.json")
+
+import os
+
+from . import gen
+from . import parse
+from . import profiling
+from .graph import build_dependency_graph
+from .ast_to_python import GLOBAL_SCOPE, ProgramInfo, generate_module
+from .cone import FormulaCone
+from .optimize import optimize_program
+from .straight_line import generate_straight_module
+from .intermediate import IntermediateFile
+from .parse_cache import FormulaParseCache
+from .incremental import IncrementalBuild
+
+
+# returns a dict with the scan results, the parsed formulas, the
+# ProgramInfo, the graph.DependencyGraph and the path of the generated code. Scan options (backend,
+# workers, ...) are passed through to gen.scan_excel. parse_workers > 1
+# parses with parse.parse_formulas_batch, and then formulas that fail are
+# left out and listed in "parse_errors" instead of stopping the build.
+# straight_line generates the module with straight_line.py instead of a
+# function per formula. optimize runs the optimize.py passes over the
+# formulas first, folding the constant cells that aren't in inputs (see
+# optimize_program), and the report is in "optimize_report". outputs, a
+# list of (sheet, cell) or (sheet or GLOBAL_SCOPE, defined name), keeps
+# only the formulas and constants they depend on (cone.FormulaCone, in
+# "cone"), the rest are never parsed. Those are parsed in this process.
+# incremental is a cache folder for incremental.IncrementalBuild: only
+# the sheets that changed since the last build with it are scanned
+# (always with the xml reader) and parsed, and only the code that
+# changed is generated, the counts are in "incremental". It can't be
+# used with parse_workers, optimize, outputs or straight_line
+def build(input_excel, workspace, use_cache=True, parse_workers=None, code_file="code.py", straight_line=False,
+          optimize=False, inputs=None, outputs=None, incremental=None, **scan_options):
+
+    incremental_build = None
+    if incremental is not None:
+        if parse_workers is not None or optimize or outputs is not None or straight_line:
+            raise Exception("An incremental build can't use parse_workers, optimize, outputs or straight_line")
+        incremental_build = IncrementalBuild(incremental)
+
+    os.makedirs(workspace, exist_ok=True)
+    profile = profiling.active
+    if profile is not None:
+        profile.set_workbook(input_excel)
+
+    with profiling.phase("scan"):
+        if incremental_build is not None:
+            scan_r = incremental_build.scan(input_excel, report_every=scan_options.get("report_every", 0))
+        else:
+            scan_r = gen.scan_excel(input_excel, **scan_options)
+
+    if profile is not None:
+        nformulas = sum(len(scan_r.formulas[scope]) for scope in scan_r.formulas)
+        nconsts = sum(len(scan_r.const[scope]) for scope in scan_r.const)
+        profile.count("cells_visited", nformulas + nconsts)
+        profile.count("formulas", nformulas)
+        profile.count("constants", nconsts)
+
+    with profiling.phase("dump"):
+        gen.dump_scanned_formulas_bin(scan_r, workspace)
+        gen.dump_scanned_constants_bin(scan_r, workspace)
+    formulas_bin = gen.dump_scanned_formulas_bin_path(workspace)
+    constants_bin = gen.dump_scanned_constants_bin_path(workspace)
+
+    cone = None
+    if outputs is not None:
+        with profiling.phase("cone"):
+            with IntermediateFile(formulas_bin) as rows:
+                cone = FormulaCone(rows, outputs)
+        if profile is not None:
+            profile.count("formulas_in_cone", len(cone.needed))
+
+    parse_errors = None
+    with profiling.phase("parse"):
+        if incremental_build is not None:
+            formulas_parsed = incremental_build.parse(scan_r, cache=FormulaParseCache() if use_cache else None)
+        elif parse_workers is not None and parse_workers > 1 and cone is None:
+            formulas_parsed, parse_errors = parse.parse_formulas_batch(formulas_bin, workers=parse_workers, use_cache=use_cache)
+        else:
+            cache = FormulaParseCache() if use_cache else None
+            if cone is not None:
+                formulas_parsed = parse.parse_formula_rows(cone.get_rows(), cache=cache)
+            else:
+                formulas_parsed = parse.parse_formulas_bin(formulas_bin, cache=cache)
+            if profile is not None and cache is not None:
+                stats = cache.stats()
+                profile.count("parse_cache_hits", stats["hits"])
+                profile.count("parse_cache_misses", stats["misses"])
+
+    if profile is not None:
+        nnodes = 0
+        for formula_obj in formulas_parsed:
+            if formula_obj["parsed"] is not None:
+                for node in parse.walk(formula_obj["parsed"]):
+                    nnodes = nnodes + 1
+        profile.count("ast_nodes", nnodes)
+        if parse_errors is not None:
+            profile.count("parse_errors", parse_errors.count())
+
+    program_info = ProgramInfo()
+    code_path = os.path.join(workspace, code_file)
+
+    with IntermediateFile(constants_bin) as constants:
+        for rw in constants:
+            if cone is None or cone.has_constant(rw["sheet"], rw["cell_or_name"]):
+                program_info.define_const(rw["sheet"], rw["cell_or_name"], rw["value"])
+
+    if cone is not None:
+        constant_keys = set((key[0], key[1].upper()) for key in program_info.program_constants)
+        for sheet, name in cone.unresolved:
+            if (sheet, name.upper()) not in constant_keys and (GLOBAL_SCOPE, name.upper()) not in constant_keys:
+                raise Exception("Output " + str(sheet) + "!" + str(name) + " is not a formula or a constant in " + str(input_excel))
+
+    optimize_report = None
+    if optimize:
+        with profiling.phase("optimize"):
+            formulas_parsed, optimize_report = optimize_program(formulas_parsed, program_info, inputs=inputs)
+        if profile is not None:
+            for stats in optimize_report:
+                profile.count("optimize_" + stats["pass"] + "_removed", stats["removed"])
+
+    with profiling.phase("graph"):
+        graph = build_dependency_graph(formulas_parsed, program_info)
+    if profile is not None:
+        profile.count("graph_nodes", graph.node_count())
+        profile.count("graph_edges", graph.edge_count())
+        profile.count("circular_references", len(graph.find_cycles()))
+
+    with profiling.phase("codegen"):
+        if straight_line:
+            code = generate_straight_module(formulas_parsed, program_info, graph)
+        elif incremental_build is not None:
+            code = incremental_build.generate_code(formulas_parsed, program_info, graph)
+        else:
+            code = generate_module(formulas_parsed, program_info, graph)
+        with open(code_path, "w") as codefp:
+            codefp.write(code)
+        if not straight_line:
+            profiling.count("functions_emitted", len(program_info.formula_name_to_function_name) + len(program_info.ranges_used))
+    if profile is not None and incremental_build is not None:
+        for name in incremental_build.stats:
+            profile.count("incremental_" + name, incremental_build.stats[name])
+
+    return {
+        "scan" : scan_r,
+        "formulas" : formulas_parsed,
+        "parse_errors" : parse_errors,
+        "optimize_report" : optimize_report,
+        "cone" : cone,
+        "incremental" : incremental_build.stats if incremental_build is not None else None,
+        "program_info" : program_info,
+        "graph" : graph,
+        "code_path" : code_path,
+    }
@@ -0,0 +1,202 @@
+
+# timing, memory and counters for the scan -> parse -> codegen pipeline.
+#
+#   profile = PipelineProfile(trace_memory=True)
+#   with profile:
+#       pipeline.build("model.xlsx", "workspace")
+#   profile.print_report()
+#   profile.write_json("workspace/profile.json")
+#
+# While a profile is active (inside the with, or between activate() and
+# deactivate()) the module level phase(), add_time() and count() record
+# into it. With no active profile they do nothing, so the pipeline code
+# can call them unconditionally. Hot paths check `profiling.active is not
+# None` first so they don't even time themselves when nothing listens.
+#
+# Work done in pool worker processes (scan_excel(workers=N),
+# parse_formulas_batch) is timed as a whole by the parent, the counters
+# inside the workers are not collected.
+
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+
+active = None
+
+
+
+class PipelineProfile:
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        # name -> {"seconds", "calls", "peak_bytes", "depth"}, in the order first seen.
+        # peak_bytes is the highest traced memory while the phase ran
+        self.phases = dict()
+        self.counters = dict()
+        self.info = dict()
+        self.open_phases = []  # [name, peak seen so far] for the phases currently running
+        self.started_tracemalloc = False
+        self.start_time = None
+        self.total_seconds = 0.0
+
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.deactivate()
+        return False
+
+
+    def activate(self):
+        global active
+        active = self
+        self.start_time = time.perf_counter()
+        self.info.setdefault("started", time.strftime("%Y-%m-%dT%H:%M:%S"))
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def deactivate(self):
+        global active
+        if active is self:
+            active = None
+        if self.start_time is not None:
+            self.total_seconds = self.total_seconds + time.perf_counter() - self.start_time
+            self.start_time = None
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+
+    def set_info(self, key, value):
+        self.info[key] = value
+
+    # name, size and hash of the input, so runs on different versions of a
+    # workbook can be told apart
+    def set_workbook(self, path):
+        h = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                h.update(block)
+        self.info["workbook"] = os.path.basename(path)
+        self.info["workbook_bytes"] = os.path.getsize(path)
+        self.info["workbook_sha256"] = h.hexdigest()
+
+
+    def _entry(self, name):
+        entry = self.phases.get(name)
+        if entry is None:
+            entry = {"seconds" : 0.0, "calls" : 0, "peak_bytes" : None, "depth" : len(self.open_phases)}
+            self.phases[name] = entry
+        return entry
+
+    # the traced peak since the last call is folded into every open phase,
+    # then reset so a nested phase sees only its own peak
+    def _fold_peak(self):
+        if not tracemalloc.is_tracing():
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_phase in self.open_phases:
+            if open_phase[1] is None or peak > open_phase[1]:
+                open_phase[1] = peak
+        tracemalloc.reset_peak()
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        entry = self._entry(name)
+        if self.trace_memory:
+            self._fold_peak()
+        self.open_phases.append([name, None])
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry["seconds"] = entry["seconds"] + time.perf_counter() - start
+            entry["calls"] = entry["calls"] + 1
+            if self.trace_memory:
+                self._fold_peak()
+            peak = self.open_phases.pop()[1]
+            if peak is not None and (entry["peak_bytes"] is None or peak > entry["peak_bytes"]):
+                entry["peak_bytes"] = peak
+
+
+    # time measured by the caller, for things that happen many times inside
+    # a phase (lexing each formula)
+    def add_time(self, name, seconds, calls=1):
+        entry = self._entry(name)
+        entry["seconds"] = entry["seconds"] + seconds
+        entry["calls"] = entry["calls"] + calls
+
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def get_counter(self, name):
+        return self.counters.get(name, 0)
+
+    def get_phase_seconds(self, name):
+        entry = self.phases.get(name)
+        return entry["seconds"] if entry is not None else 0.0
+
+
+    def to_dict(self):
+        info = dict(self.info)
+        info["python"] = sys.version.split()[0]
+        info["platform"] = platform.platform()
+        info["cpu_count"] = os.cpu_count()
+        return {
+            "info" : info,
+            "total_seconds" : self.total_seconds,
+            "phases" : [dict(name=name, **self.phases[name]) for name in self.phases],
+            "counters" : dict(self.counters),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def write_json(self, path):
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(self.to_json())
+            fp.write("\n")
+        os.replace(tmp_path, path)
+
+
+    def print_report(self):
+        print("phase                               seconds      calls    peak MB")
+        for name in self.phases:
+            entry = self.phases[name]
+            label = "  " * entry["depth"] + name
+            peak = "%10.1f" % (entry["peak_bytes"] / 1e6) if entry["peak_bytes"] is not None else "%10s" % "-"
+            print("%-32s %10.3f %10d %s" % (label, entry["seconds"], entry["calls"], peak))
+        print("total                            %10.3f" % self.total_seconds)
+        for name in sorted(self.counters):
+            print("%-32s %10d" % (name, self.counters[name]))
+
+
+
+# the module level versions, doing nothing without an active profile
+
+def phase(name):
+    if active is None:
+        return contextlib.nullcontext()
+    return active.phase(name)
+
+
+def add_time(name, seconds, calls=1):
+    if active is not None:
+        active.add_time(name, seconds, calls)
+
+
+def count(name, n=1):
+    if active is not None:
+        active.count(name, n)
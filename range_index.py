@@ -0,0 +1,223 @@
+
+# spatial index of the cells and range references of each sheet, so the
+# dependency graph can keep a range like SUM(A1:A100000) as one rectangle
+# instead of an edge to every cell in it. Answers the two questions the
+# graph needs:
+#
+#   index.points_in(sheet, c1, r1, c2, r2)   which cells feed this range
+#   index.rects_containing(sheet, col, row)  which ranges read this cell
+#
+# Cells are kept per column, each column's rows sorted, so a rectangle is
+# a binary search in each column it covers. Ranges go into a segment tree
+# over the columns (each range is stored in the O(log n) tree nodes that
+# together cover its columns) and each tree node keeps its ranges in an
+# interval tree over the rows. A cell is looked up by going from its
+# column's leaf to the root and asking each node's row tree, which is
+# O(log^2 n + answers).
+#
+# Points and rectangles can be added at any time, the sorted structures
+# are (re)built on the first query after something was added.
+
+from bisect import bisect_left, bisect_right
+
+
+
+# static centered interval tree over (lo, hi, value) items, both ends
+# inclusive. stab(x) gives the values of the items with lo <= x <= hi
+class IntervalTree:
+
+    def __init__(self, items):
+        self.root = self.build(items)
+
+
+    # a node is (center, left, right, los, by_lo, his, by_hi) where by_lo /
+    # by_hi are the items overlapping center sorted by lo / by hi reversed
+    def build(self, items):
+        if len(items) == 0:
+            return None
+        ends = sorted(item[0] for item in items)
+        center = ends[len(ends) // 2]
+        left = []
+        right = []
+        middle = []
+        for item in items:
+            if item[1] < center:
+                left.append(item)
+            elif item[0] > center:
+                right.append(item)
+            else:
+                middle.append(item)
+        by_lo = sorted(middle, key=lambda item: item[0])
+        by_hi = sorted(middle, key=lambda item: -item[1])
+        return (center, self.build(left), self.build(right),
+                [item[0] for item in by_lo], [item[2] for item in by_lo],
+                [-item[1] for item in by_hi], [item[2] for item in by_hi])
+
+
+    def stab(self, x, out):
+        node = self.root
+        while node is not None:
+            center, left, right, los, by_lo, neg_his, by_hi = node
+            if x < center:
+                # everything here reaches center, so only lo matters
+                out.extend(by_lo[:bisect_right(los, x)])
+                node = left
+            elif x > center:
+                out.extend(by_hi[:bisect_right(neg_his, -x)])
+                node = right
+            else:
+                out.extend(by_lo)
+                break
+        return out
+
+
+
+class SheetRangeIndex:
+
+    def __init__(self):
+        self.points = dict()  # col -> list of (row, value)
+        self.rects = []  # (c1, r1, c2, r2, value)
+        self.columns = None  # sorted columns that have points
+        self.column_rows = None  # col -> sorted rows, parallel to points[col]
+        self.tree = None  # segment tree, built when first needed
+        self.npoints = 0
+
+
+    def add_point(self, col, row, value):
+        rows = self.points.get(col)
+        if rows is None:
+            rows = []
+            self.points[col] = rows
+        rows.append((row, value))
+        self.npoints = self.npoints + 1
+        self.columns = None
+
+
+    def add_rect(self, c1, r1, c2, r2, value):
+        self.rects.append((c1, r1, c2, r2, value))
+        self.tree = None
+
+
+    def build_points(self):
+        self.columns = sorted(self.points)
+        self.column_rows = dict()
+        for col in self.columns:
+            rows = self.points[col]
+            rows.sort(key=lambda rv: rv[0])
+            self.column_rows[col] = [rv[0] for rv in rows]
+
+
+    # the segment tree is (xs, size, row trees): xs are the column
+    # boundaries, leaf i is the columns xs[i] .. xs[i + 1] - 1 and the row
+    # trees are kept in an array the usual way, node k has children 2k, 2k+1
+    def build_tree(self):
+        bounds = set()
+        for c1, r1, c2, r2, value in self.rects:
+            bounds.add(c1)
+            bounds.add(c2 + 1)
+        xs = sorted(bounds)
+        nleaves = max(1, len(xs) - 1)
+        size = 1
+        while size < nleaves:
+            size = size * 2
+        buckets = dict()  # tree node -> list of (r1, r2, value)
+        for c1, r1, c2, r2, value in self.rects:
+            lo = bisect_left(xs, c1) + size
+            hi = bisect_left(xs, c2 + 1) + size
+            while lo < hi:
+                if lo & 1:
+                    buckets.setdefault(lo, []).append((r1, r2, value))
+                    lo = lo + 1
+                if hi & 1:
+                    hi = hi - 1
+                    buckets.setdefault(hi, []).append((r1, r2, value))
+                lo = lo >> 1
+                hi = hi >> 1
+        trees = dict()
+        for k in buckets:
+            trees[k] = IntervalTree(buckets[k])
+        self.tree = (xs, size, trees)
+
+
+    def points_in(self, c1, r1, c2, r2):
+        if self.columns is None:
+            self.build_points()
+        found = []
+        columns = self.columns
+        for i in range(bisect_left(columns, c1), bisect_right(columns, c2)):
+            col = columns[i]
+            rows = self.column_rows[col]
+            lo = bisect_left(rows, r1)
+            hi = bisect_right(rows, r2)
+            if lo < hi:
+                found.extend(rv[1] for rv in self.points[col][lo:hi])
+        return found
+
+
+    def count_in(self, c1, r1, c2, r2):
+        if self.columns is None:
+            self.build_points()
+        n = 0
+        columns = self.columns
+        for i in range(bisect_left(columns, c1), bisect_right(columns, c2)):
+            rows = self.column_rows[columns[i]]
+            n = n + bisect_right(rows, r2) - bisect_left(rows, r1)
+        return n
+
+
+    def rects_containing(self, col, row):
+        if len(self.rects) == 0:
+            return []
+        if self.tree is None:
+            self.build_tree()
+        xs, size, trees = self.tree
+        i = bisect_right(xs, col) - 1
+        if i < 0 or i >= len(xs) - 1:
+            return []
+        found = []
+        k = i + size
+        while k >= 1:
+            tree = trees.get(k)
+            if tree is not None:
+                tree.stab(row, found)
+            k = k >> 1
+        return found
+
+
+
+# a SheetRangeIndex for each sheet
+class RangeIndex:
+
+    def __init__(self):
+        self.sheets = dict()
+
+    def get_sheet(self, sheet):
+        index = self.sheets.get(sheet)
+        if index is None:
+            index = SheetRangeIndex()
+            self.sheets[sheet] = index
+        return index
+
+    def add_point(self, sheet, col, row, value):
+        self.get_sheet(sheet).add_point(col, row, value)
+
+    def add_rect(self, sheet, c1, r1, c2, r2, value):
+        self.get_sheet(sheet).add_rect(c1, r1, c2, r2, value)
+
+    def points_in(self, sheet, c1, r1, c2, r2):
+        index = self.sheets.get(sheet)
+        if index is None:
+            return []
+        return index.points_in(c1, r1, c2, r2)
+
+    def count_in(self, sheet, c1, r1, c2, r2):
+        index = self.sheets.get(sheet)
+        if index is None:
+            return 0
+        return index.count_in(c1, r1, c2, r2)
+
+    def rects_containing(self, sheet, col, row):
+        index = self.sheets.get(sheet)
+        if index is None:
+            return []
+        return index.rects_containing(col, row)
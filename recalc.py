@@ -0,0 +1,113 @@
+
+# keeps the values of a generated module (ast_to_python.generate_module)
+# and works out again only what a change affects. Setting a constant cell
+# walks the dependency graph from that cell to everything that reads it,
+# directly or through a range or a name, and drops those values (the
+# formula_N functions and range functions memoize into the module's
+# values dict). recalculate() then works out the dropped formulas in
+# evaluation order, or get_value works out just what it needs.
+#
+#   engine = RecalcEngine(module, program_info, graph)
+#   engine.set_input("Sheet1", "B2", 0.07)
+#   engine.recalculate()
+#   engine.get_value("Sheet1", "C10")
+#
+# A range only has the cells that had something in them when the module
+# was generated, so a value put into a cell that was empty then would
+# never reach a SUM over it. set_input raises for such a cell, the
+# workbook needs a value in it and the module generated again. An empty
+# cell that is only named directly by formulas can be set.
+
+import time
+
+from .ast_to_python import range_function_name
+from .graph import RANGE
+from .refs import parse_cell_ref
+
+
+
+class RecalcEngine:
+
+    # module is the generated module, program_info and graph the ones it
+    # was generated with. Works out every formula to start with
+    def __init__(self, module, program_info, graph):
+        self.module = module
+        self.functions = vars(module)
+        self.program_info = program_info
+        self.graph = graph
+        self.position = dict((fnc, i) for i, fnc in enumerate(program_info.order))
+        self.dirty = set()  # function names of the formulas to work out again
+        self.stats = {
+            "inputs_set" : 0,
+            "marked_dirty" : 0,
+            "recalculated" : 0,
+            "seconds" : 0.0,
+        }
+        module.calculate()
+
+
+    def set_input(self, sheet, cell, value):
+        if self.program_info.find_func_name_for(sheet, cell) is not None:
+            raise Exception(str(sheet) + "!" + str(cell) + " is a formula, only constant cells can be set")
+        if (sheet, cell) not in self.program_info.program_constants:
+            parsed = parse_cell_ref(cell)
+            if parsed is not None and len(self.graph.range_index.rects_containing(sheet, parsed[0], parsed[1])) > 0:
+                raise Exception(str(sheet) + "!" + str(cell) + " was empty when the module was generated, the ranges it is in don't read it")
+        self.module.inputs[(sheet, cell)] = value
+        self.mark_dirty(sheet, cell)
+        self.stats["inputs_set"] = self.stats["inputs_set"] + 1
+
+
+    # everything that depends on the cell, not the cell itself
+    def mark_dirty(self, sheet, cell):
+        graph = self.graph
+        node = graph.get_node(sheet, cell)
+        if node is not None:
+            stack = list(graph.get_dependents(node))
+        else:
+            # not read by anything directly, but it can be in a range
+            parsed = parse_cell_ref(cell)
+            stack = graph.range_index.rects_containing(sheet, parsed[0], parsed[1]) if parsed is not None else []
+
+        values = self.module.values
+        seen = set()
+        while len(stack) > 0:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            key = graph.get_key(node)
+            if graph.get_kind(node) == RANGE:
+                values.pop(range_function_name(key[0], graph.get_rect(node)), None)
+            else:
+                fnc = self.program_info.get_func_name_for(key[0], key[1])
+                values.pop(fnc, None)
+                self.dirty.add(fnc)
+            stack.extend(graph.get_dependents(node))
+        self.stats["marked_dirty"] = self.stats["marked_dirty"] + len(seen)
+
+
+    # works out the formulas marked dirty, returns how many there were
+    def recalculate(self):
+        start = time.perf_counter()
+        order = sorted(self.dirty, key=self.position.__getitem__)
+        functions = self.functions
+        for fnc in order:
+            functions[fnc]()
+        self.dirty = set()
+        self.stats["recalculated"] = self.stats["recalculated"] + len(order)
+        self.stats["seconds"] = self.stats["seconds"] + time.perf_counter() - start
+        return len(order)
+
+
+    # dirty formulas it reads are worked out on the way
+    def get_value(self, sheet, cell):
+        return self.module.get_value(sheet, cell)
+
+
+    # every formula's value like the module's calculate(), after working
+    # out what is dirty
+    def get_values(self):
+        self.recalculate()
+        formulas = self.module.FORMULAS
+        return dict((key, formulas[key]()) for key in formulas)
@@ -0,0 +1,210 @@
+
+# helpers for working with A1 style cell references
+# (column letters, $ anchors, shifting relative references)
+
+import re
+
+
+MAX_ROW = 1048576
+MAX_COL = 16384
+
+
+CELL_REF_RE = re.compile(r'^(\$?)([A-Za-z]{1,3})(\$?)([0-9]+)$')
+
+# one side of a whole column (A:C) or whole row (1:3) reference
+COLUMN_OR_ROW_RE = re.compile(r'^(\$?[A-Za-z]{1,3}|\$?[0-9]+)$')
+
+
+# references inside formula text. This has to skip things that just
+# look like references: function names (LOG10( ), sheet names (S1!A1)
+# and parts of longer names (ABCD1, A1B, \A1). The characters around it
+# are the ones lexer.IDENT_RE takes in a name
+FORMULA_REF_RE = re.compile(
+    r'(?<![A-Za-z0-9_.$\\])'
+    r'(?:'
+    r'(?P<cell>(?P<cabs>\$?)(?P<col>[A-Za-z]{1,3})(?P<rabs>\$?)(?P<row>[0-9]+))'
+    r'|(?P<cols>\$?[A-Za-z]{1,3}:\$?[A-Za-z]{1,3})'
+    r'|(?P<rows>\$?[0-9]+:\$?[0-9]+)'
+    r')'
+    r'(?![A-Za-z0-9_(!.\\])'
+)
+
+
+
+# both directions are looked up a lot, so they are remembered
+column_index_cache = dict()
+column_letters_cache = dict()
+
+
+def column_to_index(letters):
+    idx = column_index_cache.get(letters)
+    if idx is None:
+        idx = 0
+        for ch in letters.upper():
+            idx = idx * 26 + (ord(ch) - 64)
+        column_index_cache[letters] = idx
+    return idx
+
+
+
+def index_to_column(idx):
+    letters = column_letters_cache.get(idx)
+    if letters is None:
+        letters = ""
+        n = idx
+        while n > 0:
+            n, rem = divmod(n - 1, 26)
+            letters = chr(65 + rem) + letters
+        column_letters_cache[idx] = letters
+    return letters
+
+
+
+# "$B$3" -> (2, 3, True, True), None if it isn't a cell reference
+def parse_cell_ref(ref):
+    m = CELL_REF_RE.match(ref)
+    if m is None:
+        return None
+    col = column_to_index(m.group(2))
+    row = int(m.group(4))
+    if col > MAX_COL or row < 1 or row > MAX_ROW:
+        return None
+    return col, row, m.group(1) == "$", m.group(3) == "$"
+
+
+
+def format_cell_ref(col, row, col_abs=False, row_abs=False):
+    return ("$" if col_abs else "") + index_to_column(col) + ("$" if row_abs else "") + str(row)
+
+
+
+# "A1" -> (1, 1), the coordinates recorded by the scanner never have $
+def split_coordinate(coordinate):
+    parsed = parse_cell_ref(coordinate)
+    if parsed is None:
+        raise Exception("Not a cell coordinate " + str(coordinate))
+    return parsed[0], parsed[1]
+
+
+
+# same cell whether or not it is anchored with $
+def normalize_cell(ref):
+    return ref.replace("$", "").upper()
+
+
+
+# "A1:C10" -> (1, 1, 3, 10) as (min col, min row, max col, max row)
+def parse_range(ref):
+    if ":" in ref:
+        first, last = ref.split(":", 1)
+    else:
+        first, last = ref, ref
+    c1, r1 = split_coordinate(normalize_cell(first))
+    c2, r2 = split_coordinate(normalize_cell(last))
+    return min(c1, c2), min(r1, r2), max(c1, c2), max(r1, r2)
+
+
+
+# calls fn(col, row, col_abs, row_abs) for each reference in the formula
+# text and substitutes what it returns. Whole column references (A:C)
+# call fn with row None and whole row references (1:3) with col None.
+# String literals and quoted sheet names are left alone.
+def map_formula_refs(formula, fn):
+
+    def replace(m):
+        if m.group("cell") is not None:
+            col = column_to_index(m.group("col"))
+            row = int(m.group("row"))
+            if col > MAX_COL or row < 1 or row > MAX_ROW:
+                return m.group(0)
+            return fn(col, row, m.group("cabs") == "$", m.group("rabs") == "$")
+        elif m.group("cols") is not None:
+            parts = []
+            for side in m.group("cols").split(":"):
+                col_abs = side.startswith("$")
+                parts.append(fn(column_to_index(side.lstrip("$")), None, col_abs, False))
+            return ":".join(parts)
+        else:
+            parts = []
+            for side in m.group("rows").split(":"):
+                row_abs = side.startswith("$")
+                parts.append(fn(None, int(side.lstrip("$")), False, row_abs))
+            return ":".join(parts)
+
+    if '"' not in formula and "'" not in formula:
+        return FORMULA_REF_RE.sub(replace, formula)
+
+    out = []
+    i = 0
+    n = len(formula)
+    while i < n:
+        # next quoted part, copied through untouched. Doubled quotes are escapes
+        j = min(k for k in (formula.find('"', i), formula.find("'", i), n) if k >= 0)
+        out.append(FORMULA_REF_RE.sub(replace, formula[i:j]))
+        if j >= n:
+            break
+        quote = formula[j]
+        k = j + 1
+        while k < n:
+            if formula[k] == quote:
+                if k + 1 < n and formula[k + 1] == quote:
+                    k = k + 2
+                    continue
+                break
+            k = k + 1
+        out.append(formula[j:k + 1])
+        i = k + 1
+
+    return "".join(out)
+
+
+
+# moves the relative references of a formula by drow rows and dcol
+# columns, like copying the cell in Excel. References pushed off the
+# sheet become #REF!
+def shift_formula(formula, drow, dcol):
+
+    def shift(col, row, col_abs, row_abs):
+        if col is not None and not col_abs:
+            col = col + dcol
+        if row is not None and not row_abs:
+            row = row + drow
+        if (col is not None and (col < 1 or col > MAX_COL)) or (row is not None and (row < 1 or row > MAX_ROW)):
+            return "#REF!"
+        if row is None:
+            return ("$" if col_abs else "") + index_to_column(col)
+        if col is None:
+            return ("$" if row_abs else "") + str(row)
+        return format_cell_ref(col, row, col_abs, row_abs)
+
+    return map_formula_refs(formula, shift)
+
+
+
+# shift_formula for a single reference ("B$2", "A", "3"), anything that
+# isn't a reference (a defined name) comes back unchanged
+def shift_ref(ref, drow, dcol):
+    parsed = parse_cell_ref(ref)
+    if parsed is not None:
+        col, row, col_abs, row_abs = parsed
+        if not col_abs:
+            col = col + dcol
+        if not row_abs:
+            row = row + drow
+        if col < 1 or col > MAX_COL or row < 1 or row > MAX_ROW:
+            return "#REF!"
+        return format_cell_ref(col, row, col_abs, row_abs)
+    if COLUMN_OR_ROW_RE.match(ref):
+        # one side of a whole column or whole row reference
+        anchored = ref.startswith("$")
+        part = ref.lstrip("$")
+        if part.isdigit():
+            row = int(part) if anchored else int(part) + drow
+            if row < 1 or row > MAX_ROW:
+                return "#REF!"
+            return ("$" if anchored else "") + str(row)
+        col = column_to_index(part) if anchored else column_to_index(part) + dcol
+        if col < 1 or col > MAX_COL:
+            return "#REF!"
+        return ("$" if anchored else "") + index_to_column(col)
+    return ref
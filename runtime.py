@@ -0,0 +1,1363 @@
+
+# what the generated code (and interpreter.py) runs on: Excel's values,
+# operators and worksheet functions.
+#
+# Values are python values: int / float for numbers, str, bool, None for
+# an empty cell, ExcelError for #DIV/0! and the rest, and CellRange for a
+# range reference. Errors are values like in Excel, an error going into
+# an operator or function comes back out of it. The one thing that raises
+# is a worksheet function called with the wrong number of arguments
+# (TypeError). Excel doesn't take a formula like that, the code generator
+# and the interpreter check with takes_arguments and give #VALUE! instead.
+#
+# The operators have a fast path for two numbers before doing Excel's
+# conversions (empty is 0, "3" is 3, TRUE is 1, text compares without
+# case, ...). Worksheet functions are in FUNCTIONS by their Excel name.
+# IF, IFERROR and IFNA are not functions, the code generator makes them
+# conditional expressions so the branch not taken isn't evaluated.
+
+import datetime
+import decimal
+import inspect
+import math
+import re
+
+
+
+class ExcelError:
+    __slots__ = ("code",)
+
+    def __init__(self, code):
+        self.code = code
+
+    def __eq__(self, other):
+        return isinstance(other, ExcelError) and other.code == self.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return "ExcelError(" + repr(self.code) + ")"
+
+    def __str__(self):
+        return self.code
+
+    # the generated code builds errors with error(code), so unpickled or
+    # copied ones are the same objects too
+    def __reduce__(self):
+        return (error, (self.code,))
+
+
+
+ERROR_CODES = ["#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A", "#GETTING_DATA", "#SPILL!", "#CALC!"]
+ERRORS = dict((code, ExcelError(code)) for code in ERROR_CODES)
+
+NULL_ERROR = ERRORS["#NULL!"]
+DIV0_ERROR = ERRORS["#DIV/0!"]
+VALUE_ERROR = ERRORS["#VALUE!"]
+REF_ERROR = ERRORS["#REF!"]
+NAME_ERROR = ERRORS["#NAME?"]
+NUM_ERROR = ERRORS["#NUM!"]
+NA_ERROR = ERRORS["#N/A"]
+
+
+def error(code):
+    e = ERRORS.get(code)
+    if e is None:
+        e = ExcelError(code)
+        ERRORS[code] = e
+    return e
+
+
+
+# the value of a range reference: nrows x ncols with only the cells that
+# have something in them, as (row offset, col offset, value) in row major
+# order. Empty cells are None
+class CellRange:
+    __slots__ = ("nrows", "ncols", "cells", "lookup")
+
+    def __init__(self, nrows, ncols, cells):
+        self.nrows = nrows
+        self.ncols = ncols
+        self.cells = cells
+        self.lookup = None
+
+    # the values of the cells that have something in them
+    def values(self):
+        return [c[2] for c in self.cells]
+
+    # 0 based
+    def get(self, i, j):
+        if self.lookup is None:
+            self.lookup = dict(((c[0], c[1]), c[2]) for c in self.cells)
+        return self.lookup.get((i, j))
+
+    def size(self):
+        return self.nrows * self.ncols
+
+    def __repr__(self):
+        return "CellRange(" + str(self.nrows) + "x" + str(self.ncols) + ")"
+
+
+
+# dates and times are numbers in Excel, the days since its epoch with
+# the time of day as the fraction. openpyxl gives date formatted cells as
+# datetime (or date, time, timedelta), this turns them back into the
+# number that is in the xlsx. The 1900 system counts a 29 Feb 1900 that
+# didn't exist, so from 1 Mar 1900 on the days are one more. Anything
+# else comes back as it is
+EPOCH_1900 = datetime.datetime(1899, 12, 31)
+EPOCH_1904 = datetime.datetime(1904, 1, 1)
+LEAP_BUG_FROM = datetime.datetime(1900, 3, 1)
+
+
+def excel_serial(v, date1904=False):
+    if isinstance(v, datetime.time):
+        days = 0
+        seconds = v.hour * 3600 + v.minute * 60 + v.second + v.microsecond / 1000000.0
+    elif isinstance(v, datetime.timedelta):
+        days = v.days
+        seconds = v.seconds + v.microseconds / 1000000.0
+    elif isinstance(v, datetime.date):
+        if not isinstance(v, datetime.datetime):
+            v = datetime.datetime(v.year, v.month, v.day)
+        v = v.replace(tzinfo=None)
+        delta = v - (EPOCH_1904 if date1904 else EPOCH_1900)
+        days = delta.days
+        seconds = delta.seconds + delta.microseconds / 1000000.0
+        if not date1904 and v >= LEAP_BUG_FROM:
+            days = days + 1
+    else:
+        return v
+    if seconds == 0:
+        return days
+    return days + seconds / 86400.0
+
+
+
+# conversions
+
+def is_number(v):
+    t = type(v)
+    return t is int or t is float
+
+
+def to_number(v):
+    t = type(v)
+    if t is int or t is float:
+        return v
+    if t is bool:
+        return int(v)
+    if v is None:
+        return 0
+    if t is str:
+        return text_to_number(v)
+    if t is ExcelError:
+        return v
+    return VALUE_ERROR  # a range where a single value is needed
+
+
+NUMBER_TEXT_RE = re.compile(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(%?)\s*$')
+
+def text_to_number(s):
+    m = NUMBER_TEXT_RE.match(s.replace(",", ""))
+    if m is None:
+        return VALUE_ERROR
+    n = float(m.group(1))
+    if m.group(2):
+        n = n / 100
+    if n == int(n) and "." not in m.group(1) and "e" not in m.group(1).lower() and not m.group(2):
+        return int(n)
+    return n
+
+
+def to_text(v):
+    t = type(v)
+    if t is str:
+        return v
+    if t is bool:
+        return "TRUE" if v else "FALSE"
+    if t is int:
+        return str(v)
+    if t is float:
+        return number_to_text(v)
+    if v is None:
+        return ""
+    if t is ExcelError:
+        return v
+    return VALUE_ERROR
+
+
+# Excel shows at most 15 significant digits
+def number_to_text(n):
+    if n == int(n) and abs(n) < 1e15:
+        return str(int(n))
+    s = "%.15g" % n
+    if "e" in s:
+        mantissa, exponent = s.split("e")
+        s = mantissa + "E" + ("+" if int(exponent) >= 0 else "-") + "%02d" % abs(int(exponent))
+    return s
+
+
+def to_bool(v):
+    t = type(v)
+    if t is bool:
+        return v
+    if t is int or t is float:
+        return v != 0
+    if v is None:
+        return False
+    if t is str:
+        upper = v.upper()
+        if upper == "TRUE":
+            return True
+        if upper == "FALSE":
+            return False
+        return VALUE_ERROR
+    if t is ExcelError:
+        return v
+    return VALUE_ERROR
+
+
+def is_error(v):
+    return type(v) is ExcelError
+
+
+# a number that isn't finite is #NUM! in Excel
+def checked(n):
+    if type(n) is float and (n != n or n in (math.inf, -math.inf)):
+        return NUM_ERROR
+    return n
+
+
+
+# operators
+
+def add(a, b):
+    ta = type(a)
+    tb = type(b)
+    if (ta is int or ta is float) and (tb is int or tb is float):
+        return a + b
+    a = to_number(a)
+    if type(a) is ExcelError:
+        return a
+    b = to_number(b)
+    if type(b) is ExcelError:
+        return b
+    return a + b
+
+
+def sub(a, b):
+    ta = type(a)
+    tb = type(b)
+    if (ta is int or ta is float) and (tb is int or tb is float):
+        return a - b
+    a = to_number(a)
+    if type(a) is ExcelError:
+        return a
+    b = to_number(b)
+    if type(b) is ExcelError:
+        return b
+    return a - b
+
+
+def mul(a, b):
+    ta = type(a)
+    tb = type(b)
+    if (ta is int or ta is float) and (tb is int or tb is float):
+        return a * b
+    a = to_number(a)
+    if type(a) is ExcelError:
+        return a
+    b = to_number(b)
+    if type(b) is ExcelError:
+        return b
+    return a * b
+
+
+def div(a, b):
+    ta = type(a)
+    tb = type(b)
+    if not ((ta is int or ta is float) and (tb is int or tb is float)):
+        a = to_number(a)
+        if type(a) is ExcelError:
+            return a
+        b = to_number(b)
+        if type(b) is ExcelError:
+            return b
+    if b == 0:
+        return DIV0_ERROR
+    return a / b
+
+
+def power(a, b):
+    a = to_number(a)
+    if type(a) is ExcelError:
+        return a
+    b = to_number(b)
+    if type(b) is ExcelError:
+        return b
+    if a == 0:
+        if b == 0:
+            return NUM_ERROR
+        if b < 0:
+            return DIV0_ERROR
+    if a < 0 and b != int(b):
+        return NUM_ERROR
+    try:
+        return checked(math.pow(a, b))
+    except OverflowError:
+        return NUM_ERROR
+
+
+def neg(a):
+    t = type(a)
+    if t is int or t is float:
+        return -a
+    a = to_number(a)
+    if type(a) is ExcelError:
+        return a
+    return -a
+
+
+def pos(a):
+    if type(a) is CellRange:
+        return VALUE_ERROR
+    return a
+
+
+def percent(a):
+    a = to_number(a)
+    if type(a) is ExcelError:
+        return a
+    return a / 100
+
+
+def concat(a, b):
+    a = to_text(a)
+    if type(a) is ExcelError:
+        return a
+    b = to_text(b)
+    if type(b) is ExcelError:
+        return b
+    return a + b
+
+
+# numbers < text < booleans, text without case, and an empty cell is
+# 0, "" or FALSE depending on what it is compared with. Returns -1, 0, 1
+# or an error
+def compare(a, b):
+    ta = type(a)
+    tb = type(b)
+    if ta is ExcelError:
+        return a
+    if tb is ExcelError:
+        return b
+    if ta is CellRange or tb is CellRange:
+        return VALUE_ERROR
+    if a is None:
+        a = "" if tb is str else (False if tb is bool else 0)
+        ta = type(a)
+    if b is None:
+        b = "" if ta is str else (False if ta is bool else 0)
+        tb = type(b)
+    ra = 2 if ta is bool else (1 if ta is str else 0)
+    rb = 2 if tb is bool else (1 if tb is str else 0)
+    if ra != rb:
+        return -1 if ra < rb else 1
+    if ra == 1:
+        a = a.lower()
+        b = b.lower()
+    if a < b:
+        return -1
+    if a > b:
+        return 1
+    return 0
+
+
+def eq(a, b):
+    ta = type(a)
+    if (ta is int or ta is float) and ta is type(b):
+        return a == b
+    c = compare(a, b)
+    return c if type(c) is ExcelError else c == 0
+
+
+def ne(a, b):
+    ta = type(a)
+    if (ta is int or ta is float) and ta is type(b):
+        return a != b
+    c = compare(a, b)
+    return c if type(c) is ExcelError else c != 0
+
+
+def lt(a, b):
+    ta = type(a)
+    if (ta is int or ta is float) and ta is type(b):
+        return a < b
+    c = compare(a, b)
+    return c if type(c) is ExcelError else c < 0
+
+
+def le(a, b):
+    ta = type(a)
+    if (ta is int or ta is float) and ta is type(b):
+        return a <= b
+    c = compare(a, b)
+    return c if type(c) is ExcelError else c <= 0
+
+
+def gt(a, b):
+    ta = type(a)
+    if (ta is int or ta is float) and ta is type(b):
+        return a > b
+    c = compare(a, b)
+    return c if type(c) is ExcelError else c > 0
+
+
+def ge(a, b):
+    ta = type(a)
+    if (ta is int or ta is float) and ta is type(b):
+        return a >= b
+    c = compare(a, b)
+    return c if type(c) is ExcelError else c >= 0
+
+
+BINARY_OPERATORS = {
+    "+" : add,
+    "-" : sub,
+    "*" : mul,
+    "/" : div,
+    "^" : power,
+    "&" : concat,
+    "=" : eq,
+    "<>" : ne,
+    "<" : lt,
+    "<=" : le,
+    ">" : gt,
+    ">=" : ge,
+}
+
+UNARY_OPERATORS = {
+    "-" : neg,
+    "+" : pos,
+    "%" : percent,
+}
+
+
+# the condition of IF, TRUE / FALSE or an error
+def condition(v):
+    if v is True or v is False:
+        return v
+    return to_bool(v)
+
+
+
+# worksheet functions
+
+FUNCTIONS = dict()
+
+
+# registers a worksheet function under its Excel name
+def excel_function(name):
+    def register(fn):
+        FUNCTIONS[name] = fn
+        return fn
+    return register
+
+
+# whether FUNCTIONS[name] can be called with nargs arguments, from its
+# python signature. The (fewest, most) of every function are remembered,
+# most is None for *args
+function_arities = dict()
+
+def takes_arguments(name, nargs):
+    arity = function_arities.get(name)
+    if arity is None:
+        fn = FUNCTIONS[name]
+        code = fn.__code__
+        fewest = code.co_argcount - len(fn.__defaults__ or ())
+        most = None if code.co_flags & inspect.CO_VARARGS else code.co_argcount
+        arity = function_arities[name] = (fewest, most)
+    return nargs >= arity[0] and (arity[1] is None or nargs <= arity[1])
+
+
+# the numbers of the arguments the way SUM / AVERAGE / MIN / MAX see
+# them: in ranges only numbers count, a value typed in directly is
+# converted (TRUE is 1, "3" is 3, "a" is #VALUE!). Returns the list of
+# numbers or the first error
+def collect_numbers(args):
+    numbers = []
+    for a in args:
+        if type(a) is CellRange:
+            for v in a.values():
+                t = type(v)
+                if t is int or t is float:
+                    numbers.append(v)
+                elif t is ExcelError:
+                    return v
+        elif a is not None:
+            n = to_number(a)
+            if type(n) is ExcelError:
+                return n
+            numbers.append(n)
+        else:
+            numbers.append(0)  # an empty argument, SUM(1,)
+    return numbers
+
+
+# every value of the arguments with ranges flattened out
+def flatten(args):
+    out = []
+    for a in args:
+        if type(a) is CellRange:
+            out.extend(a.values())
+        else:
+            out.append(a)
+    return out
+
+
+def number_arg(v):
+    if type(v) is CellRange:
+        return VALUE_ERROR
+    return to_number(v)
+
+
+def first_error(*values):
+    for v in values:
+        if type(v) is ExcelError:
+            return v
+    return None
+
+
+
+@excel_function("SUM")
+def fn_sum(*args):
+    numbers = collect_numbers(args)
+    if type(numbers) is ExcelError:
+        return numbers
+    return sum(numbers)
+
+
+@excel_function("PRODUCT")
+def fn_product(*args):
+    numbers = collect_numbers(args)
+    if type(numbers) is ExcelError:
+        return numbers
+    result = 1
+    for n in numbers:
+        result = result * n
+    return result
+
+
+@excel_function("AVERAGE")
+def fn_average(*args):
+    numbers = collect_numbers(args)
+    if type(numbers) is ExcelError:
+        return numbers
+    if len(numbers) == 0:
+        return DIV0_ERROR
+    return sum(numbers) / len(numbers)
+
+
+@excel_function("MIN")
+def fn_min(*args):
+    numbers = collect_numbers(args)
+    if type(numbers) is ExcelError:
+        return numbers
+    return min(numbers) if len(numbers) > 0 else 0
+
+
+@excel_function("MAX")
+def fn_max(*args):
+    numbers = collect_numbers(args)
+    if type(numbers) is ExcelError:
+        return numbers
+    return max(numbers) if len(numbers) > 0 else 0
+
+
+@excel_function("COUNT")
+def fn_count(*args):
+    n = 0
+    for a in args:
+        if type(a) is CellRange:
+            for v in a.values():
+                if is_number(v):
+                    n = n + 1
+        elif type(a) is bool or is_number(a) or (type(a) is str and is_number(text_to_number(a))):
+            n = n + 1
+    return n
+
+
+@excel_function("COUNTA")
+def fn_counta(*args):
+    n = 0
+    for v in flatten(args):
+        if v is not None:
+            n = n + 1
+    return n
+
+
+@excel_function("COUNTBLANK")
+def fn_countblank(rng):
+    if type(rng) is not CellRange:
+        return VALUE_ERROR
+    n = rng.size()
+    for v in rng.values():
+        if v is not None and v != "":
+            n = n - 1
+    return n
+
+
+@excel_function("SUMPRODUCT")
+def fn_sumproduct(*args):
+    if len(args) == 0:
+        return VALUE_ERROR
+    shape = None
+    products = None
+    for a in args:
+        if type(a) is CellRange:
+            if shape is None:
+                shape = (a.nrows, a.ncols)
+            elif shape != (a.nrows, a.ncols):
+                return VALUE_ERROR
+            values = []
+            for i in range(0, a.nrows):
+                for j in range(0, a.ncols):
+                    v = a.get(i, j)
+                    if type(v) is ExcelError:
+                        return v
+                    values.append(v if is_number(v) else 0)
+        else:
+            if type(a) is ExcelError:
+                return a
+            if shape is not None and shape != (1, 1):
+                return VALUE_ERROR
+            shape = (1, 1)
+            values = [a if is_number(a) else 0]
+        if products is None:
+            products = values
+        else:
+            products = [p * v for p, v in zip(products, values)]
+    return sum(products)
+
+
+@excel_function("ABS")
+def fn_abs(x):
+    x = number_arg(x)
+    if type(x) is ExcelError:
+        return x
+    return abs(x)
+
+
+@excel_function("SIGN")
+def fn_sign(x):
+    x = number_arg(x)
+    if type(x) is ExcelError:
+        return x
+    return (x > 0) - (x < 0)
+
+
+# half away from zero like Excel, not python's half to even
+@excel_function("ROUND")
+def fn_round(x, digits=0):
+    x = number_arg(x)
+    digits = number_arg(digits)
+    e = first_error(x, digits)
+    if e is not None:
+        return e
+    return round_with(x, digits, decimal.ROUND_HALF_UP)
+
+
+@excel_function("ROUNDUP")
+def fn_roundup(x, digits=0):
+    x = number_arg(x)
+    digits = number_arg(digits)
+    e = first_error(x, digits)
+    if e is not None:
+        return e
+    return round_with(x, digits, decimal.ROUND_UP)
+
+
+@excel_function("ROUNDDOWN")
+def fn_rounddown(x, digits=0):
+    x = number_arg(x)
+    digits = number_arg(digits)
+    e = first_error(x, digits)
+    if e is not None:
+        return e
+    return round_with(x, digits, decimal.ROUND_DOWN)
+
+
+# rounds the decimal the number is shown as (repr), so 1.005 is 1.01 like
+# in Excel and not 1.00 from the binary value 1.00499999...
+# ROUND_UP / ROUND_DOWN are away from / towards zero, same as Excel
+def round_with(x, digits, rounding):
+    try:
+        d = decimal.Decimal(repr(x)).quantize(decimal.Decimal(1).scaleb(-int(digits)), rounding=rounding)
+    except decimal.InvalidOperation:
+        return x  # more digits than there are
+    return float(d)
+
+
+@excel_function("INT")
+def fn_int(x):
+    x = number_arg(x)
+    if type(x) is ExcelError:
+        return x
+    return math.floor(x)
+
+
+@excel_function("TRUNC")
+def fn_trunc(x, digits=0):
+    x = number_arg(x)
+    digits = number_arg(digits)
+    e = first_error(x, digits)
+    if e is not None:
+        return e
+    return round_with(x, digits, decimal.ROUND_DOWN)
+
+
+@excel_function("MOD")
+def fn_mod(a, b):
+    a = number_arg(a)
+    b = number_arg(b)
+    e = first_error(a, b)
+    if e is not None:
+        return e
+    if b == 0:
+        return DIV0_ERROR
+    return a - b * math.floor(a / b)
+
+
+@excel_function("POWER")
+def fn_power(a, b):
+    return power(a, b)
+
+
+@excel_function("SQRT")
+def fn_sqrt(x):
+    x = number_arg(x)
+    if type(x) is ExcelError:
+        return x
+    if x < 0:
+        return NUM_ERROR
+    return math.sqrt(x)
+
+
+@excel_function("EXP")
+def fn_exp(x):
+    x = number_arg(x)
+    if type(x) is ExcelError:
+        return x
+    try:
+        return math.exp(x)
+    except OverflowError:
+        return NUM_ERROR
+
+
+@excel_function("LN")
+def fn_ln(x):
+    x = number_arg(x)
+    if type(x) is ExcelError:
+        return x
+    if x <= 0:
+        return NUM_ERROR
+    return math.log(x)
+
+
+@excel_function("LOG")
+def fn_log(x, base=10):
+    x = number_arg(x)
+    base = number_arg(base)
+    e = first_error(x, base)
+    if e is not None:
+        return e
+    if x <= 0 or base <= 0:
+        return NUM_ERROR
+    if base == 1:
+        return DIV0_ERROR
+    return math.log(x) / math.log(base)
+
+
+@excel_function("LOG10")
+def fn_log10(x):
+    x = number_arg(x)
+    if type(x) is ExcelError:
+        return x
+    if x <= 0:
+        return NUM_ERROR
+    return math.log10(x)
+
+
+@excel_function("PI")
+def fn_pi():
+    return math.pi
+
+
+@excel_function("TRUE")
+def fn_true():
+    return True
+
+
+@excel_function("FALSE")
+def fn_false():
+    return False
+
+
+# AND / OR skip text and empty cells in ranges, with nothing left to
+# look at it's #VALUE!
+def logical_values(args):
+    values = []
+    for a in args:
+        if type(a) is CellRange:
+            for v in a.values():
+                t = type(v)
+                if t is bool or t is int or t is float:
+                    values.append(bool(v))
+                elif t is ExcelError:
+                    return v
+        else:
+            b = to_bool(a)
+            if type(b) is ExcelError:
+                return b
+            values.append(b)
+    if len(values) == 0:
+        return VALUE_ERROR
+    return values
+
+
+@excel_function("AND")
+def fn_and(*args):
+    values = logical_values(args)
+    if type(values) is ExcelError:
+        return values
+    return all(values)
+
+
+@excel_function("OR")
+def fn_or(*args):
+    values = logical_values(args)
+    if type(values) is ExcelError:
+        return values
+    return any(values)
+
+
+@excel_function("XOR")
+def fn_xor(*args):
+    values = logical_values(args)
+    if type(values) is ExcelError:
+        return values
+    return sum(values) % 2 == 1
+
+
+@excel_function("NOT")
+def fn_not(x):
+    b = to_bool(x)
+    if type(b) is ExcelError:
+        return b
+    return not b
+
+
+# IF and friends as plain functions, for when the arguments are already
+# evaluated. The generated code doesn't use these
+@excel_function("IF")
+def fn_if(cond, if_true=True, if_false=False):
+    c = condition(cond)
+    if type(c) is ExcelError:
+        return c
+    return if_true if c else if_false
+
+
+@excel_function("IFERROR")
+def fn_iferror(v, alt):
+    return alt if type(v) is ExcelError else v
+
+
+@excel_function("IFNA")
+def fn_ifna(v, alt):
+    return alt if v == NA_ERROR else v
+
+
+@excel_function("ISERROR")
+def fn_iserror(v):
+    return type(v) is ExcelError
+
+
+@excel_function("ISERR")
+def fn_iserr(v):
+    return type(v) is ExcelError and v != NA_ERROR
+
+
+@excel_function("ISNA")
+def fn_isna(v):
+    return v == NA_ERROR
+
+
+@excel_function("ISNUMBER")
+def fn_isnumber(v):
+    return is_number(v)
+
+
+@excel_function("ISTEXT")
+def fn_istext(v):
+    return type(v) is str
+
+
+@excel_function("ISLOGICAL")
+def fn_islogical(v):
+    return type(v) is bool
+
+
+@excel_function("ISBLANK")
+def fn_isblank(v):
+    return v is None
+
+
+@excel_function("NA")
+def fn_na():
+    return NA_ERROR
+
+
+@excel_function("CHOOSE")
+def fn_choose(index, *options):
+    index = number_arg(index)
+    if type(index) is ExcelError:
+        return index
+    index = int(index)
+    if index < 1 or index > len(options):
+        return VALUE_ERROR
+    return options[index - 1]
+
+
+
+def text_arg(v):
+    if type(v) is CellRange:
+        return VALUE_ERROR
+    return to_text(v)
+
+
+@excel_function("CONCATENATE")
+def fn_concatenate(*args):
+    parts = []
+    for a in args:
+        s = text_arg(a)
+        if type(s) is ExcelError:
+            return s
+        parts.append(s)
+    return "".join(parts)
+
+
+@excel_function("CONCAT")
+def fn_concat(*args):
+    parts = []
+    for v in flatten(args):
+        s = to_text(v)
+        if type(s) is ExcelError:
+            return s
+        parts.append(s)
+    return "".join(parts)
+
+
+@excel_function("LEN")
+def fn_len(s):
+    s = text_arg(s)
+    if type(s) is ExcelError:
+        return s
+    return len(s)
+
+
+@excel_function("LEFT")
+def fn_left(s, n=1):
+    s = text_arg(s)
+    n = number_arg(n)
+    e = first_error(s, n)
+    if e is not None:
+        return e
+    if n < 0:
+        return VALUE_ERROR
+    return s[:int(n)]
+
+
+@excel_function("RIGHT")
+def fn_right(s, n=1):
+    s = text_arg(s)
+    n = number_arg(n)
+    e = first_error(s, n)
+    if e is not None:
+        return e
+    if n < 0:
+        return VALUE_ERROR
+    n = int(n)
+    return s[len(s) - n:] if n > 0 else ""
+
+
+@excel_function("MID")
+def fn_mid(s, start, n):
+    s = text_arg(s)
+    start = number_arg(start)
+    n = number_arg(n)
+    e = first_error(s, start, n)
+    if e is not None:
+        return e
+    if start < 1 or n < 0:
+        return VALUE_ERROR
+    start = int(start)
+    return s[start - 1:start - 1 + int(n)]
+
+
+@excel_function("UPPER")
+def fn_upper(s):
+    s = text_arg(s)
+    if type(s) is ExcelError:
+        return s
+    return s.upper()
+
+
+@excel_function("LOWER")
+def fn_lower(s):
+    s = text_arg(s)
+    if type(s) is ExcelError:
+        return s
+    return s.lower()
+
+
+@excel_function("TRIM")
+def fn_trim(s):
+    s = text_arg(s)
+    if type(s) is ExcelError:
+        return s
+    return " ".join(part for part in s.split(" ") if part != "")
+
+
+@excel_function("EXACT")
+def fn_exact(a, b):
+    a = text_arg(a)
+    b = text_arg(b)
+    e = first_error(a, b)
+    if e is not None:
+        return e
+    return a == b
+
+
+@excel_function("REPT")
+def fn_rept(s, n):
+    s = text_arg(s)
+    n = number_arg(n)
+    e = first_error(s, n)
+    if e is not None:
+        return e
+    if n < 0:
+        return VALUE_ERROR
+    return s * int(n)
+
+
+@excel_function("SUBSTITUTE")
+def fn_substitute(s, old, new, instance=None):
+    s = text_arg(s)
+    old = text_arg(old)
+    new = text_arg(new)
+    e = first_error(s, old, new)
+    if e is not None:
+        return e
+    if old == "":
+        return s
+    if instance is None:
+        return s.replace(old, new)
+    instance = number_arg(instance)
+    if type(instance) is ExcelError:
+        return instance
+    if instance < 1:
+        return VALUE_ERROR
+    idx = -1
+    for k in range(0, int(instance)):
+        idx = s.find(old, idx + 1)
+        if idx < 0:
+            return s
+    return s[:idx] + new + s[idx + len(old):]
+
+
+@excel_function("VALUE")
+def fn_value(s):
+    if type(s) is CellRange:
+        return VALUE_ERROR
+    if type(s) is str:
+        return text_to_number(s)
+    return to_number(s)
+
+
+
+# criteria of SUMIF / COUNTIF / AVERAGEIF: a value, or text like ">5",
+# "<>done", "a*". Returns a function value -> bool
+def make_criteria(criteria):
+    op = "="
+    target = criteria
+    if type(criteria) is str:
+        for prefix in ("<=", ">=", "<>", "<", ">", "="):
+            if criteria.startswith(prefix):
+                op = prefix
+                target = criteria[len(prefix):]
+                break
+        n = text_to_number(target)
+        if type(n) is not ExcelError:
+            target = n
+        elif target.upper() in ("TRUE", "FALSE"):
+            target = target.upper() == "TRUE"
+
+    if type(target) is str and op in ("=", "<>") and ("*" in target or "?" in target):
+        pattern = re.compile("^" + "".join(".*" if ch == "*" else ("." if ch == "?" else re.escape(ch)) for ch in target) + "$", re.IGNORECASE | re.DOTALL)
+        if op == "=":
+            return lambda v: type(v) is str and pattern.match(v) is not None
+        return lambda v: not (type(v) is str and pattern.match(v) is not None)
+
+    if op == "=" and target == "":
+        return lambda v: v is None or v == ""
+
+    def matches(v):
+        if v is None or type(v) is ExcelError:
+            return op == "<>"
+        if op == "=" or op == "<>":
+            same = compare(v, target) == 0 and (type(v) is str) == (type(target) is str)
+            return same if op == "=" else not same
+        if (type(v) is str) != (type(target) is str) or type(v) is bool or type(target) is bool:
+            return False
+        c = compare(v, target)
+        if op == "<":
+            return c < 0
+        if op == "<=":
+            return c <= 0
+        if op == ">":
+            return c > 0
+        return c >= 0
+
+    return matches
+
+
+def criteria_pairs(rng, criteria, sum_range):
+    if type(rng) is not CellRange:
+        return VALUE_ERROR
+    if type(criteria) is ExcelError:
+        return criteria
+    if type(criteria) is CellRange:
+        return VALUE_ERROR
+    test = make_criteria(criteria)
+    target = sum_range if type(sum_range) is CellRange else rng
+    pairs = []
+    for i in range(0, rng.nrows):
+        for j in range(0, rng.ncols):
+            if test(rng.get(i, j)):
+                pairs.append(target.get(i, j))
+    return pairs
+
+
+@excel_function("SUMIF")
+def fn_sumif(rng, criteria, sum_range=None):
+    values = criteria_pairs(rng, criteria, sum_range)
+    if type(values) is ExcelError:
+        return values
+    total = 0
+    for v in values:
+        if type(v) is ExcelError:
+            return v
+        if is_number(v):
+            total = total + v
+    return total
+
+
+@excel_function("COUNTIF")
+def fn_countif(rng, criteria):
+    values = criteria_pairs(rng, criteria, None)
+    if type(values) is ExcelError:
+        return values
+    return len(values)
+
+
+@excel_function("AVERAGEIF")
+def fn_averageif(rng, criteria, average_range=None):
+    values = criteria_pairs(rng, criteria, average_range)
+    if type(values) is ExcelError:
+        return values
+    numbers = [v for v in values if is_number(v)]
+    if len(numbers) == 0:
+        return DIV0_ERROR
+    return sum(numbers) / len(numbers)
+
+
+
+# INDEX(range, row, col), 1 based. A single row or column range can be
+# given just the one index
+@excel_function("INDEX")
+def fn_index(rng, row, col=None):
+    if type(rng) is not CellRange:
+        if type(rng) is ExcelError:
+            return rng
+        return rng if number_arg(row) in (0, 1) and (col is None or number_arg(col) in (0, 1)) else REF_ERROR
+    row = number_arg(row)
+    col = number_arg(col) if col is not None else None
+    e = first_error(row, col)
+    if e is not None:
+        return e
+    row = int(row)
+    if col is None:
+        if rng.nrows == 1:
+            row, col = 1, row
+        else:
+            col = 1
+    col = int(col)
+    if row < 1 or col < 1 or row > rng.nrows or col > rng.ncols:
+        return REF_ERROR
+    v = rng.get(row - 1, col - 1)
+    return 0 if v is None else v
+
+
+# the cells of a one row or one column range in order
+def vector(rng):
+    if rng.nrows == 1:
+        return [rng.get(0, j) for j in range(0, rng.ncols)]
+    if rng.ncols == 1:
+        return [rng.get(i, 0) for i in range(0, rng.nrows)]
+    return None
+
+
+# position (0 based) in values of target: match_type 0 is exact, 1 the
+# largest value <= target in ascending data, -1 the smallest >= target in
+# descending data. None if there isn't one
+def match_position(target, values, match_type):
+    if match_type == 0:
+        test = make_criteria(target) if type(target) is str and ("*" in target or "?" in target) else None
+        for k in range(0, len(values)):
+            v = values[k]
+            if test is not None:
+                if test(v):
+                    return k
+            elif v is not None and compare(v, target) == 0:
+                return k
+        return None
+    found = None
+    for k in range(0, len(values)):
+        v = values[k]
+        if v is None or (type(v) is str) != (type(target) is str):
+            continue
+        c = compare(v, target)
+        if type(c) is ExcelError:
+            continue
+        if match_type > 0:
+            if c <= 0:
+                found = k
+            else:
+                break
+        else:
+            if c >= 0:
+                found = k
+            else:
+                break
+    return found
+
+
+@excel_function("MATCH")
+def fn_match(target, rng, match_type=1):
+    if type(target) is ExcelError:
+        return target
+    if type(rng) is not CellRange:
+        return NA_ERROR
+    values = vector(rng)
+    if values is None:
+        return NA_ERROR
+    match_type = number_arg(match_type)
+    if type(match_type) is ExcelError:
+        return match_type
+    k = match_position(target, values, match_type)
+    return NA_ERROR if k is None else k + 1
+
+
+@excel_function("VLOOKUP")
+def fn_vlookup(target, table, col, approximate=True):
+    if type(target) is ExcelError:
+        return target
+    if type(table) is not CellRange:
+        return NA_ERROR
+    col = number_arg(col)
+    if type(col) is ExcelError:
+        return col
+    col = int(col)
+    if col < 1:
+        return VALUE_ERROR
+    if col > table.ncols:
+        return REF_ERROR
+    exact = to_bool(approximate) is False
+    k = match_position(target, [table.get(i, 0) for i in range(0, table.nrows)], 0 if exact else 1)
+    if k is None:
+        return NA_ERROR
+    v = table.get(k, col - 1)
+    return 0 if v is None else v
+
+
+@excel_function("HLOOKUP")
+def fn_hlookup(target, table, row, approximate=True):
+    if type(target) is ExcelError:
+        return target
+    if type(table) is not CellRange:
+        return NA_ERROR
+    row = number_arg(row)
+    if type(row) is ExcelError:
+        return row
+    row = int(row)
+    if row < 1:
+        return VALUE_ERROR
+    if row > table.nrows:
+        return REF_ERROR
+    exact = to_bool(approximate) is False
+    k = match_position(target, [table.get(0, j) for j in range(0, table.ncols)], 0 if exact else 1)
+    if k is None:
+        return NA_ERROR
+    v = table.get(row - 1, k)
+    return 0 if v is None else v
+
+
+
+@excel_function("NPV")
+def fn_npv(rate, *args):
+    rate = number_arg(rate)
+    if type(rate) is ExcelError:
+        return rate
+    numbers = collect_numbers(args)
+    if type(numbers) is ExcelError:
+        return numbers
+    if rate == -1:
+        return DIV0_ERROR
+    total = 0
+    for k in range(0, len(numbers)):
+        total = total + numbers[k] / (1 + rate) ** (k + 1)
+    return total
+
+
+@excel_function("PMT")
+def fn_pmt(rate, nper, pv, fv=0, when=0):
+    rate = number_arg(rate)
+    nper = number_arg(nper)
+    pv = number_arg(pv)
+    fv = number_arg(fv)
+    when = number_arg(when)
+    e = first_error(rate, nper, pv, fv, when)
+    if e is not None:
+        return e
+    if nper == 0:
+        return NUM_ERROR
+    if rate == 0:
+        return -(pv + fv) / nper
+    growth = (1 + rate) ** nper
+    return -(rate * (pv * growth + fv)) / ((1 + rate * (1 if when else 0)) * (growth - 1))
+
+
+
+# the name the function is called by in the generated code, or None if it
+# isn't supported. Newer functions are saved as _xlfn.NAME
+def function_key(func_name):
+    name = func_name.upper()
+    if name.startswith("_XLFN."):
+        name = name[len("_XLFN."):]
+    if name.startswith("_XLWS."):
+        name = name[len("_XLWS."):]
+    if name in FUNCTIONS:
+        return name
+    return None
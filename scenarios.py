@@ -0,0 +1,296 @@
+
+# running a workbook over many scenarios: inputs drawn from distributions
+# (Monte Carlo) or taken from a table of scenarios (a sweep), evaluated
+# chunk_size scenarios at a time with the numpy module from
+# numpy_backend.generate_numpy_module, so memory stays the same however
+# many scenarios there are. The module keeps an array for every formula
+# that depends on the inputs, so by default a chunk is as many scenarios
+# as fit MEMORY_BUDGET with an array for every slot of the module. The
+# outputs asked for are written into a .npy file each as the chunks
+# finish (memory mapped, nothing is kept around), with a manifest.json
+# saying which file is which cell.
+#
+#   runner = ScenarioRunner("workspace/code_numpy.py", [("Sheet1", "C5")])
+#   stats = runner.run_distributions({("Sheet1", "A1") : ("normal", 0.05, 0.01)}, 1000000, "workspace/mc")
+#   results = open_results("workspace/mc")   # (sheet, cell) -> array
+#
+# workers > 1 hands the chunks out to processes, each loads the module
+# once and writes its chunks straight into the same files. Each chunk
+# draws from its own seeded generator, so the results don't depend on
+# how many workers there were.
+
+import concurrent.futures
+import importlib.util
+import json
+import os
+import time
+
+import numpy as np
+
+from . import diagnostics
+from .numpy_backend import as_array
+
+
+MEMORY_BUDGET = 512 * 1024 * 1024  # bytes for the arrays of one chunk
+MAX_CHUNK_SIZE = 100000
+
+
+
+# a distribution is a tuple, so it can be handed to worker processes:
+#   ("normal", mean, sd)   ("lognormal", mean, sigma) of the log
+#   ("uniform", low, high)   ("triangular", low, mode, high)
+#   ("choice", [values], [probabilities] or None)   ("constant", value)
+# or a function (rng, n) -> array, for one process
+def draw(distribution, rng, n):
+    if callable(distribution):
+        return np.asarray(distribution(rng, n), dtype=np.float64)
+    kind = distribution[0]
+    args = distribution[1:]
+    if kind == "normal":
+        return rng.normal(args[0], args[1], n)
+    elif kind == "lognormal":
+        return rng.lognormal(args[0], args[1], n)
+    elif kind == "uniform":
+        return rng.uniform(args[0], args[1], n)
+    elif kind == "triangular":
+        return rng.triangular(args[0], args[1], args[2], n)
+    elif kind == "choice":
+        p = args[1] if len(args) > 1 else None
+        return rng.choice(np.asarray(args[0], dtype=np.float64), n, p=p)
+    elif kind == "constant":
+        return np.full(n, float(args[0]))
+    raise Exception("Unknown distribution " + str(kind))
+
+
+
+def load_module(code_path):
+    spec = importlib.util.spec_from_file_location("scenario_model", code_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def output_file_name(i):
+    return "output_" + str(i) + ".npy"
+
+
+# scenarios per chunk for a module with nslots slots
+def chunk_size_for(nslots, memory_budget=MEMORY_BUDGET):
+    return max(1, min(MAX_CHUNK_SIZE, memory_budget // (8 * max(1, nslots))))
+
+
+# (sheet, cell) -> memory mapped array of the outputs of a run
+def open_results(out_dir, mode="r"):
+    with open(os.path.join(out_dir, "manifest.json")) as fp:
+        manifest = json.load(fp)
+    results = dict()
+    for entry in manifest["outputs"]:
+        results[(entry["sheet"], entry["cell"])] = np.load(os.path.join(out_dir, entry["file"]), mmap_mode=mode)
+    return results
+
+
+
+class ScenarioRunner:
+
+    # code_path is a module from numpy_backend.generate_numpy_module,
+    # outputs the (sheet, cell or name) to keep. chunk_size None works it
+    # out from the size of the module, see chunk_size_for
+    def __init__(self, code_path, outputs, chunk_size=None):
+        self.code_path = code_path
+        self.outputs = list(outputs)
+        self.chunk_size = chunk_size
+        self.module = None  # loaded when first needed in this process
+        self.files = None  # the memory mapped outputs while running
+
+
+    def get_module(self):
+        if self.module is None:
+            self.module = load_module(self.code_path)
+        return self.module
+
+
+    def get_chunk_size(self):
+        if self.chunk_size is None:
+            self.chunk_size = chunk_size_for(self.get_module().NSLOTS)
+        return self.chunk_size
+
+
+    # inputs is (sheet, cell) -> distribution, see draw
+    def run_distributions(self, inputs, nscenarios, out_dir, seed=0, workers=None, report_every=None):
+        job = ("distributions", list(inputs.items()), seed)
+        return self.run(job, nscenarios, out_dir, workers, report_every)
+
+
+    # table is (sheet, cell) -> array of the value in each scenario, all
+    # the same length. With workers the arrays are saved in out_dir
+    # first so the workers can memory map them
+    def run_table(self, table, out_dir, workers=None, report_every=None):
+        keys = list(table)
+        if len(keys) == 0:
+            raise Exception("Empty scenario table")
+        nscenarios = len(table[keys[0]])
+        for key in keys:
+            if len(table[key]) != nscenarios:
+                raise Exception("Scenario table column " + str(key) + " has " + str(len(table[key])) + " rows, not " + str(nscenarios))
+        os.makedirs(out_dir, exist_ok=True)
+        columns = []
+        for i, key in enumerate(keys):
+            if workers is not None and workers > 1:
+                path = os.path.join(out_dir, "input_" + str(i) + ".npy")
+                np.save(path, np.asarray(table[key], dtype=np.float64))
+                columns.append((key, path))
+            else:
+                columns.append((key, table[key]))
+        job = ("table", columns, None)
+        return self.run(job, nscenarios, out_dir, workers, report_every)
+
+
+    # creates the output files, runs the chunks here or in workers and
+    # returns the stats (also kept in the manifest). report_every is in
+    # scenarios, like the rows of gen.scan_excel
+    def run(self, job, nscenarios, out_dir, workers=None, report_every=None):
+        self.check_inputs([key for key, column in job[1]])
+        os.makedirs(out_dir, exist_ok=True)
+        chunk_size = self.get_chunk_size()
+        manifest = {
+            "code_path" : self.code_path,
+            "scenarios" : nscenarios,
+            "chunk_size" : chunk_size,
+            "outputs" : [],
+        }
+        for i, key in enumerate(self.outputs):
+            file_name = output_file_name(i)
+            out = np.lib.format.open_memmap(os.path.join(out_dir, file_name), mode="w+", dtype=np.float64, shape=(nscenarios,))
+            del out  # created, the chunks open it again to write
+            manifest["outputs"].append({"sheet" : key[0], "cell" : key[1], "file" : file_name})
+
+        nchunks = (nscenarios + chunk_size - 1) // chunk_size
+        diagnostics.info("running " + str(nscenarios) + " scenarios in " + str(nchunks) + " chunks of " + str(chunk_size))
+        start = time.perf_counter()
+        done = 0
+        next_report = report_every
+
+        if workers is None or workers <= 1:
+            self.open_files(out_dir)
+            job = open_columns(job)
+            for chunk in range(0, nchunks):
+                done = done + self.run_chunk(job, chunk, nscenarios)
+                if next_report is not None and done >= next_report:
+                    report(done, nscenarios, start)
+                    next_report = next_report + report_every
+            self.close_files()
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=open_worker_runner,
+                                                        initargs=(self.code_path, self.outputs, chunk_size, out_dir, job, nscenarios, diagnostics.get_level())) as pool:
+                for n in pool.map(run_worker_chunk, range(0, nchunks)):
+                    done = done + n
+                    if next_report is not None and done >= next_report:
+                        report(done, nscenarios, start)
+                        next_report = next_report + report_every
+
+        seconds = time.perf_counter() - start
+        stats = {
+            "scenarios" : nscenarios,
+            "chunks" : nchunks,
+            "workers" : workers if workers is not None and workers > 1 else 1,
+            "seconds" : seconds,
+            "scenarios_per_sec" : nscenarios / seconds if seconds > 0 else 0.0,
+        }
+        diagnostics.info("Done, " + str(nscenarios) + " scenarios in " + str(round(seconds, 3)) + " s, " + str(round(stats["scenarios_per_sec"], 1)) + " scenarios/sec")
+        manifest["stats"] = stats
+        with open(os.path.join(out_dir, "manifest.json"), "w") as fp:
+            json.dump(manifest, fp, indent=2)
+        return stats
+
+
+    # set_input of a cell the module doesn't read from its inputs would
+    # be dropped without a word, so a scenario column has to be a
+    # constant cell of the workbook or an empty cell a formula reads
+    def check_inputs(self, keys):
+        module = self.get_module()
+        known = set(module.inputs)
+        known.update(key for slot, key in module.INPUT_SLOTS)
+        for key in keys:
+            if tuple(key) not in known:
+                raise Exception("Scenario input " + str(key[0]) + "!" + str(key[1]) + " is not an input cell of " + str(self.code_path))
+
+
+    def open_files(self, out_dir):
+        self.files = [np.load(os.path.join(out_dir, output_file_name(i)), mmap_mode="r+") for i in range(0, len(self.outputs))]
+
+
+    def close_files(self):
+        for out in self.files:
+            out.flush()
+        self.files = None
+
+
+    # sets the inputs for one chunk, works it out and writes the outputs
+    # into the files. Returns the number of scenarios in the chunk
+    def run_chunk(self, job, chunk, nscenarios):
+        module = self.get_module()
+        chunk_size = self.get_chunk_size()
+        first = chunk * chunk_size
+        last = min(first + chunk_size, nscenarios)
+        n = last - first
+
+        kind, inputs, seed = job
+        if kind == "distributions":
+            rng = np.random.default_rng([seed, chunk])
+            for key, distribution in inputs:
+                module.set_input(key[0], key[1], draw(distribution, rng, n))
+        else:
+            for key, column in inputs:
+                module.set_input(key[0], key[1], np.asarray(column[first:last], dtype=np.float64))
+
+        module.calculate()
+        for i, key in enumerate(self.outputs):
+            self.files[i][first:last] = as_array(module.get_value(key[0], key[1]), n)
+        return n
+
+
+
+# the job with the columns that were saved for workers (file names)
+# memory mapped, once for the whole run
+def open_columns(job):
+    kind, inputs, seed = job
+    if kind != "table":
+        return job
+    columns = []
+    for key, column in inputs:
+        if isinstance(column, str):
+            column = np.load(column, mmap_mode="r")
+        columns.append((key, column))
+    return (kind, columns, seed)
+
+
+
+def report(done, nscenarios, start):
+    if diagnostics.info_enabled:
+        elapsed = time.perf_counter() - start
+        rate = str(round(done / elapsed, 1)) if elapsed > 0 else "-"
+        diagnostics.info(str(done) + " / " + str(nscenarios) + " scenarios, " + rate + " scenarios/sec")
+
+
+
+# each worker process loads the module and opens the output files and
+# the scenario columns once, and reuses them for every chunk it is handed
+worker_runner = None
+worker_job = None
+worker_nscenarios = None
+
+
+def open_worker_runner(code_path, outputs, chunk_size, out_dir, job, nscenarios, diagnostics_level=diagnostics.ERROR):
+    global worker_runner, worker_job, worker_nscenarios
+    diagnostics.set_level(diagnostics_level)  # not inherited when processes are spawned
+    worker_runner = ScenarioRunner(code_path, outputs, chunk_size)
+    worker_runner.open_files(out_dir)
+    worker_job = open_columns(job)
+    worker_nscenarios = nscenarios
+
+
+def run_worker_chunk(chunk):
+    n = worker_runner.run_chunk(worker_job, chunk, worker_nscenarios)
+    for out in worker_runner.files:
+        out.flush()
+    return n
@@ -0,0 +1,268 @@
+
+# the whole workbook as straight line code: instead of a memoized function
+# per cell, every formula is one assignment into a list of slots, in the
+# evaluation order from the dependency graph, so a formula reads the cells
+# it depends on as s[i] after they have been worked out. No call, no
+# memo lookup and no recursion per formula. The assignments are split into
+# chunk functions of chunk_size statements (one huge function compiles
+# slowly), and each chunk gets the runtime functions it uses as default
+# arguments so they are local variables.
+#
+#   code = generate_straight_module(formulas_parsed, program_info)
+#
+# The module has the same calculate(), get_value(sheet, cell) and
+# set_input(sheet, cell, value) as the one from ast_to_python.generate_module.
+# The runtime module and the expression generator can be swapped for
+# other ones, numpy_backend.py does that
+
+import re
+
+from .ast_to_python import ExpressionGenerator, prepare_program, formula_cells, function_variable, function_names_in, literal, RUNTIME_IMPORTS
+from .optimize import lazy_function
+from .parse import child_nodes
+from .refs import format_cell_ref, split_coordinate, parse_cell_ref
+from .runtime import function_key
+
+
+CHUNK_SIZE = 1000
+
+WORD = re.compile(r"[A-Za-z_]\w*")
+
+
+
+# the slot of every formula, constant cell and range the code reads
+class SlotLayout:
+
+    def __init__(self, program_info):
+        self.program_info = program_info
+        self.slots = dict()  # function name, (sheet, cell) of a constant or ("range", sheet, rect) -> slot
+        self.input_slots = []  # (slot, (sheet, cell)) of the constant cells that are read
+        self.nslots = 0
+
+    def new_slot(self, key):
+        slot = self.nslots
+        self.slots[key] = slot
+        self.nslots = self.nslots + 1
+        return slot
+
+    def formula_slot(self, func_name):
+        slot = self.slots.get(func_name)
+        if slot is None:
+            slot = self.new_slot(func_name)
+        return slot
+
+    def cell_slot(self, sheet, cell):
+        fnc = self.program_info.find_func_name_for(sheet, cell)
+        if fnc is not None:
+            return self.formula_slot(fnc)
+        slot = self.slots.get((sheet, cell))
+        if slot is None:
+            slot = self.new_slot((sheet, cell))
+            self.input_slots.append((slot, (sheet, cell)))
+        return slot
+
+
+
+# expressions that read slots. Ranges are built the first time one is
+# read, the statements for that are left in pending for the caller to put
+# in front of the formula. So are the parts of a deeply nested formula
+# (see ExpressionGenerator.hoist), each one is worked out into a local
+# variable of the chunk. A part that is only in the branches of an IF /
+# IFERROR / IFNA (see optimize.lazy_function) isn't always worked out,
+# it is kept in the variable as a lambda and called where it is used
+class SlotExpressionGenerator(ExpressionGenerator):
+
+    def __init__(self, layout, drow=0, dcol=0, func_name=None):
+        ExpressionGenerator.__init__(self, layout.program_info, drow, dcol, func_name)
+        self.layout = layout
+        self.pending = []
+        self.lazy = set()  # id() of the nodes that aren't always worked out
+
+    def expression(self, node):
+        self.lazy = lazy_nodes(node)
+        return ExpressionGenerator.expression(self, node)
+
+    def cell_reference(self, sheet, cell):
+        return "s[" + str(self.layout.cell_slot(sheet, cell)) + "]"
+
+    def name_reference(self, fnc):
+        return "s[" + str(self.layout.formula_slot(fnc)) + "]"
+
+    def range_reference(self, sheet, rect):
+        key = ("range", sheet, rect)
+        slot = self.layout.slots.get(key)
+        if slot is None:
+            c1, r1, c2, r2 = rect
+            items = []
+            for row, col, cell in self.program_info.cells_in(sheet, c1, r1, c2, r2):
+                items.append("(" + str(row - r1) + ", " + str(col - c1) + ", s[" + str(self.layout.cell_slot(sheet, cell)) + "])")
+            slot = self.layout.new_slot(key)
+            self.pending.append(("s[" + str(slot) + "] = CellRange(" + str(r2 - r1 + 1) + ", " + str(c2 - c1 + 1) + ", [" + ", ".join(items) + "])",
+                                 str(sheet) + "!" + format_cell_ref(c1, r1) + ":" + format_cell_ref(c2, r2)))
+        return "s[" + str(slot) + "]"
+
+    def hoist(self, code, node=None):
+        self.nparts = self.nparts + 1
+        name = "_p" + str(self.nparts)
+        if node is None or id(node) in self.lazy:
+            self.pending.append((name + " = lambda: " + code, "part of " + str(self.func_name) + ", in a branch"))
+            return name + "()"
+        self.pending.append((name + " = " + code, "part of " + str(self.func_name)))
+        return name
+
+
+
+# the id() of every node of the AST that sits in a branch of an IF /
+# IFERROR / IFNA, going down with a stack like optimize.count_subtrees.
+# A node that is in the AST twice counts as lazy if either one is
+def lazy_nodes(formula_ast):
+    lazy = set()
+    stack = [(formula_ast, False)]
+    while len(stack) > 0:
+        node, in_branch = stack.pop()
+        if in_branch:
+            lazy.add(id(node))
+        children = child_nodes(node)
+        branches = node.nodetype() == "function" and lazy_function(function_key(node.get_func_name()), children)
+        for i, c in enumerate(children):
+            stack.append((c, in_branch or (branches and i > 0)))
+    return lazy
+
+
+
+# (statement, comment) pairs for every formula in evaluation order
+def straight_statements(formulas_parsed, program_info, layout, generator_class=None):
+    if generator_class is None:
+        generator_class = SlotExpressionGenerator
+
+    # function name -> (sheet, cell, AST, drow, dcol)
+    formulas = dict()
+    for formula_obj in formulas_parsed:
+        sheet = formula_obj["sheet"]
+        master = formula_obj["name"]
+        shared = formula_obj.get("ref") is not None and parse_cell_ref(master) is not None
+        if shared:
+            mcol, mrow = split_coordinate(master)
+        for cell in formula_cells(formula_obj):
+            drow, dcol = 0, 0
+            if shared:
+                col, row = split_coordinate(cell)
+                drow, dcol = row - mrow, col - mcol
+            formulas[program_info.get_func_name_for(sheet, cell)] = (sheet, cell, formula_obj["parsed"], drow, dcol)
+
+    statements = []
+    for func_name in program_info.order:
+        sheet, cell, nodes, drow, dcol = formulas[func_name]
+        slot = layout.formula_slot(func_name)
+        if nodes is None:
+            expression = "None"  # didn't parse
+        else:
+            generator = generator_class(layout, drow, dcol, func_name)
+            expression = generator.expression(nodes)
+            statements.extend(generator.pending)
+        statements.append(("s[" + str(slot) + "] = " + expression, str(sheet) + "!" + str(cell)))
+    return statements
+
+
+
+# a chunk of statements as a function of the slot list
+def chunk_function(name, statements, runtime_imports=RUNTIME_IMPORTS):
+    body = []
+    for statement, comment in statements:
+        body.append("    " + statement + "  # " + comment)
+    used = set()
+    for line in body:
+        used.update(WORD.findall(line))
+    bound = [nm for nm in runtime_imports if nm in used and nm != "FUNCTIONS"]
+    bound.extend(nm for nm in sorted(used) if nm.startswith("fn_"))
+    lines = ["def " + name + "(s" + "".join(", " + nm + "=" + nm for nm in bound) + "):"]
+    lines.extend(body)
+    lines.append("")
+    lines.append("")
+    return lines
+
+
+
+# runtime_module is the module of the package the generated code imports
+# runtime_imports from
+def generate_straight_module(formulas_parsed, program_info, graph=None, chunk_size=CHUNK_SIZE,
+                             generator_class=None, runtime_module="runtime", runtime_imports=RUNTIME_IMPORTS):
+
+    prepare_program(formulas_parsed, program_info, graph)
+    layout = SlotLayout(program_info)
+    statements = straight_statements(formulas_parsed, program_info, layout, generator_class)
+
+    functions = []
+    nchunks = 0
+    for start in range(0, len(statements), chunk_size):
+        functions.extend(chunk_function("chunk_" + str(nchunks), statements[start:start + chunk_size], runtime_imports))
+        nchunks = nchunks + 1
+    functions_code = "\n".join(functions)
+
+    package = __name__.rsplit(".", 1)[0]
+    lines = []
+    lines.append("")
+    lines.append("# generated from an Excel workbook, see straight_line.py. calculate() works out")
+    lines.append("# every formula, set_input(sheet, cell, value) changes a constant cell")
+    lines.append("")
+    lines.append("from " + package + "." + runtime_module + " import " + ", ".join(runtime_imports))
+    lines.append("")
+    for name in function_names_in(functions_code):
+        lines.append(function_variable(name) + " = FUNCTIONS[" + repr(name) + "]")
+    lines.append("")
+
+    lines.append("inputs = {")
+    for key in program_info.program_constants:
+        lines.append("    " + repr(key) + " : " + literal(program_info.program_constants[key]) + ",")
+    lines.append("}")
+    lines.append("")
+    lines.append("NSLOTS = " + str(layout.nslots))
+    lines.append("INPUT_SLOTS = [")
+    for slot, key in layout.input_slots:
+        lines.append("    (" + str(slot) + ", " + repr(key) + "),")
+    lines.append("]")
+    lines.append("FORMULA_SLOTS = {")
+    for key in program_info.formula_name_to_function_name:
+        lines.append("    " + repr(key) + " : " + str(layout.formula_slot(program_info.formula_name_to_function_name[key])) + ",")
+    lines.append("}")
+    # a cell on a circular reference reads 0 when it is read through a
+    # range before it is worked out
+    lines.append("CYCLIC_SLOTS = " + repr(sorted(layout.formula_slot(fnc) for fnc in program_info.cyclic)))
+    lines.append("")
+    lines.append("slots = None")
+    lines.append("")
+    lines.append("")
+    lines.append(functions_code)
+    lines.append("CHUNKS = [" + ", ".join("chunk_" + str(i) for i in range(0, nchunks)) + "]")
+    lines.append("")
+    lines.append("")
+    lines.append("def set_input(sheet, cell, value):")
+    lines.append("    global slots")
+    lines.append("    inputs[(sheet, cell)] = value")
+    lines.append("    slots = None")
+    lines.append("")
+    lines.append("")
+    lines.append("def get_value(sheet, cell):")
+    lines.append("    slot = FORMULA_SLOTS.get((sheet, cell))")
+    lines.append("    if slot is None:")
+    lines.append("        return inputs.get((sheet, cell))")
+    lines.append("    if slots is None:")
+    lines.append("        calculate()")
+    lines.append("    return slots[slot]")
+    lines.append("")
+    lines.append("")
+    lines.append("# every formula's value, by (sheet, cell or name)")
+    lines.append("def calculate():")
+    lines.append("    global slots")
+    lines.append("    s = [None] * NSLOTS")
+    lines.append("    for slot, key in INPUT_SLOTS:")
+    lines.append("        s[slot] = inputs.get(key)")
+    lines.append("    for slot in CYCLIC_SLOTS:")
+    lines.append("        s[slot] = 0")
+    lines.append("    for chunk in CHUNKS:")
+    lines.append("        chunk(s)")
+    lines.append("    slots = s")
+    lines.append("    return dict((key, s[FORMULA_SLOTS[key]]) for key in FORMULA_SLOTS)")
+    lines.append("")
+
+    return "\n".join(lines)
@@ -0,0 +1,117 @@
+
+# bytes per AST node of the parsed formulas of a synthetic workbook, with
+# the __slots__ node classes against the old layout (a __dict__ per node
+# plus the unused parent and children fields), measured with tracemalloc
+# run from this folder: python bench_ast_memory.py [nsheets] [rows]
+
+import os
+import sys
+import tracemalloc
+
+sys.path.append("../../")
+
+import transpiler_thing.gen
+import transpiler_thing.parse
+from transpiler_thing.parse import IRVisitor, walk, IRConstant, IRVariable, IRVariableRange, UnaryOperationNode, BinaryOperationNode, FunctionCallNode
+
+from synthetic_workbook import make_many_sheet_workbook
+
+
+nsheets = 4
+rows = 500
+if len(sys.argv) > 1:
+    nsheets = int(sys.argv[1])
+if len(sys.argv) > 2:
+    rows = int(sys.argv[2])
+
+os.makedirs("workspace", exist_ok=True)
+input_excel = os.path.join("workspace", "bench_ast_memory.xlsx")
+make_many_sheet_workbook(input_excel, nsheets=nsheets, rows=rows)
+
+result = transpiler_thing.gen.scan_excel(input_excel, backend="xml", report_every=0)
+transpiler_thing.gen.dump_scanned_formulas_bin(result, "workspace")
+formulas_bin = transpiler_thing.gen.dump_scanned_formulas_bin_path("workspace")
+
+parsed = transpiler_thing.parse.parse_formulas_bin(formulas_bin)
+
+
+# the node layout before, with the same fields as the slotted classes
+class OldNode:
+    def __init__(self, **fields):
+        self.parent = None
+        self.children = []
+        for k in fields:
+            setattr(self, k, fields[k])
+
+
+class CopyToOldNodes(IRVisitor):
+
+    def visit_constant(self, node):
+        return OldNode(value=node.get_value())
+
+    def visit_variable(self, node):
+        return OldNode(varname=node.get_varname(), sheet_scope=node.get_sheet_scope())
+
+    def visit_variablerange(self, node):
+        return OldNode(varname1=node.get_varname1(), varname2=node.get_varname2(), sheet_scope=node.get_sheet_scope())
+
+    def visit_unary(self, node):
+        return OldNode(op=node.get_operator(), node=self.visit(node.get_node()))
+
+    def visit_binary(self, node):
+        return OldNode(left=self.visit(node.get_left()), op=node.get_operator(), right=self.visit(node.get_right()))
+
+    def visit_function(self, node):
+        return OldNode(func_name=node.get_func_name(), params=[self.visit(p) for p in node.get_params()])
+
+
+# fresh copy of the slotted tree, sharing the strings like the copy above
+class CopySlottedNodes(IRVisitor):
+
+    def visit_constant(self, node):
+        return IRConstant(node.get_value())
+
+    def visit_variable(self, node):
+        v = IRVariable(node.get_varname())
+        v.set_sheet_scope(node.get_sheet_scope())
+        return v
+
+    def visit_variablerange(self, node):
+        v = IRVariableRange(node.get_varname1(), node.get_varname2())
+        v.set_sheet_scope(node.get_sheet_scope())
+        return v
+
+    def visit_unary(self, node):
+        return UnaryOperationNode(node.get_operator(), self.visit(node.get_node()))
+
+    def visit_binary(self, node):
+        return BinaryOperationNode(self.visit(node.get_left()), node.get_operator(), self.visit(node.get_right()))
+
+    def visit_function(self, node):
+        return FunctionCallNode(node.get_func_name(), [self.visit(p) for p in node.get_params()])
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    trees = [build(f) for f in parsed]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return trees, after - before
+
+
+nnodes = 0
+for f in parsed:
+    for node in walk(f["parsed"]):
+        nnodes = nnodes + 1
+
+old_copier = CopyToOldNodes()
+old_trees, old_bytes = measure(lambda f: old_copier.visit(f["parsed"]))
+old_trees = None
+new_copier = CopySlottedNodes()
+new_trees, new_bytes = measure(lambda f: new_copier.visit(f["parsed"]))
+
+print("")
+print(str(len(parsed)) + " formulas, " + str(nnodes) + " nodes")
+print("  __dict__ + parent/children %10d bytes %8.1f bytes/node" % (old_bytes, old_bytes / nnodes))
+print("  __slots__                  %10d bytes %8.1f bytes/node  %.1fx smaller" % (new_bytes, new_bytes / nnodes, old_bytes / new_bytes))
@@ -0,0 +1,75 @@
+# building a generated model workbook for a few output cells with
+# pipeline.build(outputs=...), which parses and generates only the cone of
+# formulas those outputs depend on, against building all of it. Prints the
+# time of each phase both ways, calculate() of both modules, and checks
+# the outputs come out the same.
+# run from this folder: python bench_cone.py [formulas per sheet] [outputs]
+
+import importlib.util
+import os
+import random
+import sys
+import time
+
+sys.path.append("../../")
+
+import transpiler_thing.pipeline
+import transpiler_thing.profiling
+
+from synthetic_workbook import make_model_workbook
+
+
+nformulas = 10000
+if len(sys.argv) > 1:
+    nformulas = int(sys.argv[1])
+
+noutputs = 20
+if len(sys.argv) > 2:
+    noutputs = int(sys.argv[2])
+
+os.makedirs("workspace", exist_ok=True)
+input_excel = os.path.join("workspace", "bench_cone.xlsx")
+fill_down = 1000
+make_model_workbook(input_excel, nsheets=4, formulas=nformulas, fill_down=fill_down, depth=5)
+
+random.seed(1)
+ncols = (nformulas + fill_down - 1) // fill_down
+outputs = []
+for i in range(0, noutputs):
+    col = random.randint(0, ncols - 1)
+    outputs.append(("Sheet" + str(random.randint(1, 4)), chr(66 + col) + str(random.randint(1, min(fill_down, nformulas - col * fill_down)))))
+
+
+def load(path):
+    spec = importlib.util.spec_from_file_location("bench_cone_" + os.path.basename(path)[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed_build(code_file, **options):
+    profile = transpiler_thing.profiling.PipelineProfile()
+    start = time.perf_counter()
+    with profile:
+        build = transpiler_thing.pipeline.build(input_excel, "workspace", backend="xml", report_every=0, code_file=code_file, **options)
+    seconds = time.perf_counter() - start
+    module = load(build["code_path"])
+    start = time.perf_counter()
+    module.calculate()
+    return build, profile, seconds, module, time.perf_counter() - start
+
+
+full, full_profile, full_seconds, full_module, full_calc = timed_build("bench_cone_full.py")
+cone, cone_profile, cone_seconds, cone_module, cone_calc = timed_build("bench_cone_outputs.py", outputs=outputs)
+
+stats = cone["cone"].stats()
+print("%d outputs, cone has %d of %d formula rows, %d cells, %d of %d constants" % (
+    noutputs, stats["formulas_in_cone"], stats["formulas"], stats["cells_in_cone"],
+    len(cone["program_info"].program_constants), len(full["program_info"].program_constants)))
+print("%-10s %10s %10s" % ("phase", "all", "cone"))
+for name in ["scan", "dump", "cone", "parse", "graph", "codegen"]:
+    print("%-10s %10.3f %10.3f" % (name, full_profile.get_phase_seconds(name), cone_profile.get_phase_seconds(name)))
+print("%-10s %10.3f %10.3f" % ("build", full_seconds, cone_seconds))
+print("%-10s %10.3f %10.3f" % ("calculate", full_calc, cone_calc))
+differ = sum(1 for sheet, cell in outputs if repr(full_module.get_value(sheet, cell)) != repr(cone_module.get_value(sheet, cell)))
+print("%d outputs differ" % differ)
@@ -0,0 +1,70 @@
+# rebuilding a model workbook after editing one cell with
+# pipeline.build(incremental=...), against a full build. Each rebuild
+# has to scan, parse and generate again only what the edit touches (the
+# counts are checked, a formula that another sheet reads turned into a
+# number means that sheet's code is generated again too), and the
+# module has to give the same values as the one from the full build.
+# run from this folder: python bench_incremental.py [formulas per sheet]
+
+import os
+import shutil
+import sys
+import time
+
+sys.path.append("../../")
+
+import transpiler_thing.pipeline
+import transpiler_thing.scenarios
+
+from synthetic_workbook import make_model_workbook
+
+
+nformulas = 2000
+if len(sys.argv) > 1:
+    nformulas = int(sys.argv[1])
+
+# (what, edits, (sheets scanned, scopes parsed, scopes generated)). Each
+# has the edits before it too. The scopes are the 4 sheets and the
+# defined names, Sheet3 reads column B of Sheet2
+STEPS = [
+    ("first build", {}, (4, 5, 5)),
+    ("nothing changed", {}, (0, 0, 0)),
+    ("a number in Sheet2", {(5, 1) : 123.0}, (1, 0, 0)),
+    ("a formula in Sheet2", {(5, 2) : "=A5*3"}, (1, 1, 1)),
+    ("a formula in Sheet2 made a number", {(5, 2) : 7.0}, (1, 1, 2)),
+    ("a number in Sheet2 made a formula", {(5, 1) : "=A6+1"}, (1, 1, 1)),
+]
+
+os.makedirs("workspace", exist_ok=True)
+input_excel = os.path.join("workspace", "bench_incremental.xlsx")
+cache_dir = os.path.join("workspace", "bench_incremental_cache")
+shutil.rmtree(cache_dir, ignore_errors=True)
+
+edits = dict()
+print("%d formulas per sheet, one formula in every cell" % nformulas)
+print("%-36s %10s %10s   %s" % ("edit", "full s", "incr s", "scanned / parsed / generated, reused"))
+for title, step_edits, expected in STEPS:
+    edits.update(step_edits)
+    make_model_workbook(input_excel, nsheets=4, formulas=nformulas, fill_down=500, depth=5, shared=False, edits={"Sheet2" : edits})
+
+    start = time.perf_counter()
+    full = transpiler_thing.pipeline.build(input_excel, "workspace", backend="xml", report_every=0, code_file="bench_incremental_full.py")
+    full_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    build = transpiler_thing.pipeline.build(input_excel, "workspace", report_every=0, code_file="bench_incremental_code.py",
+                                            incremental=cache_dir)
+    seconds = time.perf_counter() - start
+
+    stats = build["incremental"]
+    got = (stats["sheets_scanned"], stats["scopes_parsed"], stats["code_generated"])
+    print("%-36s %10.3f %10.3f   %d / %d / %d, %d / %d / %d" % (title, full_seconds, seconds, got[0], got[1], got[2],
+                                                              stats["sheets_reused"], stats["scopes_reused"], stats["code_reused"]))
+    if got != expected:
+        raise Exception(title + ": scanned, parsed and generated " + repr(got) + " instead of " + repr(expected))
+
+    expected_values = transpiler_thing.scenarios.load_module(full["code_path"]).calculate()
+    values = transpiler_thing.scenarios.load_module(build["code_path"]).calculate()
+    differ = sum(1 for key in expected_values if repr(expected_values[key]) != repr(values.get(key)))
+    if differ > 0 or len(values) != len(expected_values):
+        raise Exception(title + ": " + str(differ) + " values differ from the full build")
@@ -0,0 +1,69 @@
+
+# tokens/sec of the lexit based ExcelFormulaLexer against the hand written
+# lexer (compat mode and the finished tokens the parser uses), on the
+# formulas of the test workbook plus formulas with long string literals.
+# Also checks that compat mode gives the same tokens as the old lexer.
+# run from this folder: python bench_lexer.py [repeat] [string_length]
+
+import sys
+import time
+
+sys.path.append("../../")
+
+import transpiler_thing.gen
+import transpiler_thing.lexer
+from transpiler_thing.lexit_lexer import ExcelFormulaLexer
+
+
+repeat = 200
+if len(sys.argv) > 1:
+    repeat = int(sys.argv[1])
+
+string_length = 2000
+if len(sys.argv) > 2:
+    string_length = int(sys.argv[2])
+
+
+result = transpiler_thing.gen.scan_excel("simple_formula_testing.xlsx", backend="xml", report_every=0)
+formulas = []
+for sheet in result.formulas:
+    for name in result.formulas[sheet]:
+        formulas.append(result.formulas[sheet][name])
+
+formulas = formulas + [
+    "=IF(AND($B$2>=10,C3<>\"\"),SUM(A1:A100)/COUNT(A1:A100),-1.5E-3)",
+    "='another, sheet'!A5*(B7-C7)^2&\" units\"",
+    "=CONCATENATE(\"" + ("word, \"\"quoted\"\" " * (string_length // 16)) + "\",A1)",
+]
+
+# same tokens from both, before timing anything
+for formula in formulas:
+    old = list(ExcelFormulaLexer.lex(formula))
+    new = transpiler_thing.lexer.lex_compat(formula)
+    if old != new:
+        raise Exception("lex_compat differs from ExcelFormulaLexer on " + formula)
+
+
+def time_lexer(lex):
+    ntokens = 0
+    start = time.perf_counter()
+    for i in range(0, repeat):
+        for formula in formulas:
+            ntokens = ntokens + len(list(lex(formula)))
+    return ntokens, time.perf_counter() - start
+
+
+lexers = [
+    ("lexit ExcelFormulaLexer", ExcelFormulaLexer.lex),
+    ("lex_compat", transpiler_thing.lexer.lex_compat),
+    ("tokenize", transpiler_thing.lexer.tokenize),
+]
+
+print("")
+print(str(len(formulas)) + " formulas x " + str(repeat))
+base = None
+for label, lex in lexers:
+    ntokens, elapsed = time_lexer(lex)
+    if base is None:
+        base = elapsed
+    print("  %-25s %10d tokens %10.3f s %12.0f tokens/s  %.1fx" % (label, ntokens, elapsed, ntokens / elapsed, base / elapsed))
@@ -0,0 +1,68 @@
+# cold starts of a model with module_cache.ModuleCache: building it from
+# the workbook, against a fresh process loading it from the cache. Then
+# a few fresh processes starting at once on an empty cache, the way
+# service workers would, all with the same workspace. They have to end up
+# with one entry and the same values.
+# run from this folder: python bench_module_cache.py [formulas per sheet] [workers]
+
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+sys.path.append("../../")
+
+from synthetic_workbook import make_model_workbook
+
+
+input_excel = os.path.join("workspace", "bench_module_cache.xlsx")
+cache_dir = os.path.join("workspace", "bench_module_cache")
+
+
+# in a fresh process: the seconds to import the cache and get the module,
+# the cache stats and the values. Nothing of the package is imported at
+# the top of this file so the import is timed too
+def cold_start(worker):
+    start = time.perf_counter()
+    import transpiler_thing.module_cache
+    cache = transpiler_thing.module_cache.ModuleCache(cache_dir)
+    module = cache.load_or_build(input_excel, os.path.join("workspace", "bench_module_cache_build"), backend="xml", report_every=0)
+    seconds = time.perf_counter() - start
+    return seconds, cache.stats, repr(sorted(module.calculate().items()))
+
+
+if __name__ == "__main__":
+
+    nformulas = 5000
+    if len(sys.argv) > 1:
+        nformulas = int(sys.argv[1])
+
+    nworkers = 4
+    if len(sys.argv) > 2:
+        nworkers = int(sys.argv[2])
+
+    os.makedirs("workspace", exist_ok=True)
+    make_model_workbook(input_excel, nsheets=4, formulas=nformulas, fill_down=1000, depth=5)
+
+    spawn = multiprocessing.get_context("spawn")
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    with spawn.Pool(1) as pool:
+        build_seconds, build_stats, expected = pool.apply(cold_start, (0,))
+    with spawn.Pool(1) as pool:
+        load_seconds, load_stats, values = pool.apply(cold_start, (0,))
+    print("%d formulas per sheet, cold start of a fresh process:" % nformulas)
+    print("  build and store  %8.3f s   %s" % (build_seconds, build_stats))
+    print("  from the cache   %8.3f s   %s" % (load_seconds, load_stats))
+    print("  %.0fx faster" % (build_seconds / load_seconds))
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    start = time.perf_counter()
+    with spawn.Pool(nworkers) as pool:
+        started = pool.map(cold_start, range(0, nworkers))
+    print("%d workers on an empty cache at once: %.3f s" % (nworkers, time.perf_counter() - start))
+    for seconds, stats, worker_values in started:
+        print("  %8.3f s   %s" % (seconds, stats))
+    print("%d entries in the cache, %d workers got other values" % (
+        len(os.listdir(cache_dir)), sum(1 for started_values in [values] + [s[2] for s in started] if started_values != expected)))
@@ -0,0 +1,98 @@
+# the optimize.py passes on a generated workbook with what they are for:
+# assumption cells in column B read through $B$1*$B$2 and the like in
+# columns of shared formulas, and parts that are all constants. Run twice,
+# with column A the inputs so the assumptions are folded in, and with
+# every constant cell an input so only common parts can go. Prints the
+# report, then the calculate() time of the module with and without the
+# passes (and of the straight line module), the values have to be the same.
+# run from this folder: python bench_optimize.py [rows]
+
+import importlib.util
+import os
+import sys
+import time
+
+sys.path.append("../../")
+
+import transpiler_thing.pipeline
+import transpiler_thing.optimize
+import transpiler_thing.straight_line
+from transpiler_thing.ast_to_python import ProgramInfo
+
+from synthetic_workbook import SharedFormula, write_xlsx
+
+
+nrows = 5000
+if len(sys.argv) > 1:
+    nrows = int(sys.argv[1])
+
+COLUMNS = [
+    "=A1*($B$1*$B$2)+A1*($B$3/12)",
+    "=C1-($B$1*$B$2)*ROUND($B$3/12,4)+0",
+    "=IF($B$4>0,D1*1,D1*$B$4)+MAX(C1,$B$1*$B$2)",
+    "=E1/(1+$B$3/12)^12+SUM($B$1:$B$4)*($B$1*$B$2)",
+]
+
+
+def cells():
+    assumptions = [0.25, 4.0, 0.06, 1.0]
+    for row in range(1, nrows + 1):
+        yield row, 1, float(row % 89) + 0.5
+        if row <= len(assumptions):
+            yield row, 2, assumptions[row - 1]
+        for k, formula in enumerate(COLUMNS):
+            if row == 1:
+                yield row, k + 3, SharedFormula(k, formula, chr(67 + k) + "1:" + chr(67 + k) + str(nrows))
+            else:
+                yield row, k + 3, SharedFormula(k)
+
+
+def load(path):
+    spec = importlib.util.spec_from_file_location("bench_optimize_" + str(abs(hash(path))), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_calculate(module, repeat=5):
+    best = None
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        values = module.calculate()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return values, best
+
+
+def straight_module(build, path):
+    info = ProgramInfo()
+    for key in build["program_info"].program_constants:
+        info.define_const(key[0], key[1], build["program_info"].program_constants[key])
+    with open(path, "w") as fp:
+        fp.write(transpiler_thing.straight_line.generate_straight_module(build["formulas"], info, build["graph"]))
+    return load(path)
+
+
+os.makedirs("workspace", exist_ok=True)
+input_excel = os.path.join("workspace", "bench_optimize.xlsx")
+write_xlsx(input_excel, [("Model", cells(), None)])
+
+plain = transpiler_thing.pipeline.build(input_excel, "workspace", backend="xml", report_every=0, code_file="bench_plain.py")
+expected, plain_time = best_calculate(load(plain["code_path"]))
+_, plain_straight = best_calculate(straight_module(plain, os.path.join("workspace", "bench_plain_straight.py")))
+
+for title, inputs in (("column A inputs", [("Model", "A" + str(row)) for row in range(1, nrows + 1)]), ("every constant an input", None)):
+    start = time.perf_counter()
+    optimized = transpiler_thing.pipeline.build(input_excel, "workspace", backend="xml", report_every=0, code_file="bench_optimized.py",
+                                                optimize=True, inputs=inputs)
+    print("")
+    print("%s: %d formulas, build with the passes %.3f s" % (title, nrows * len(COLUMNS), time.perf_counter() - start))
+    transpiler_thing.optimize.print_report(optimized["optimize_report"])
+
+    got, optimized_time = best_calculate(load(optimized["code_path"]))
+    straight_values, optimized_straight = best_calculate(straight_module(optimized, os.path.join("workspace", "bench_optimized_straight.py")))
+
+    differ = sum(1 for key in expected if repr(expected[key]) != repr(got[key]) or repr(expected[key]) != repr(straight_values[key]))
+    print("calculate      %8.3f s -> %8.3f s  (%.2fx)" % (plain_time, optimized_time, plain_time / optimized_time))
+    print("straight line  %8.3f s -> %8.3f s  (%.2fx)" % (plain_straight, optimized_straight, plain_straight / optimized_straight))
+    print("%d values differ" % differ)
@@ -0,0 +1,79 @@
+
+# times parsing the formulas of a synthetic workbook at the default
+# (quiet) diagnostics level and with per-formula tracing, with and without
+# the relative-shape parse cache, then the batch parse with 1 worker up to
+# one per core
+# run from this folder: python bench_parse.py [nsheets] [rows]
+
+import io 
+import os 
+import sys 
+import time 
+
+sys.path.append("../../")
+
+import transpiler_thing.gen
+import transpiler_thing.parse
+import transpiler_thing.parse_cache
+import transpiler_thing.diagnostics
+
+from synthetic_workbook import make_many_sheet_workbook
+
+
+nsheets = 4
+rows = 500
+if len(sys.argv) > 1:
+    nsheets = int(sys.argv[1])
+if len(sys.argv) > 2:
+    rows = int(sys.argv[2])
+
+os.makedirs("workspace", exist_ok=True)
+input_excel = os.path.join("workspace", "bench_parse.xlsx")
+make_many_sheet_workbook(input_excel, nsheets=nsheets, rows=rows)
+
+result = transpiler_thing.gen.scan_excel(input_excel, backend="xml", report_every=0)
+transpiler_thing.gen.dump_scanned_formulas_bin(result, "workspace")
+formulas_bin = transpiler_thing.gen.dump_scanned_formulas_bin_path("workspace")
+
+
+def time_parse(cache):
+    start = time.perf_counter()
+    parsed = transpiler_thing.parse.parse_formulas_bin(formulas_bin, cache=cache)
+    return parsed, time.perf_counter() - start
+
+
+# the trace output is thrown away, this is the cost of producing it 
+transpiler_thing.diagnostics.set_output(io.StringIO())
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.TRACE)
+traced, traced_time = time_parse(None)
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.ERROR)
+transpiler_thing.diagnostics.set_output(None)
+
+plain, plain_time = time_parse(None)
+cache = transpiler_thing.parse_cache.FormulaParseCache()
+cached, cached_time = time_parse(cache)
+
+print("")
+print(str(len(plain)) + " formulas")
+print("  tracing    %10.3f s" % traced_time)
+print("  quiet      %10.3f s  speedup %.1fx" % (plain_time, traced_time / plain_time))
+print("  cache      %10.3f s  speedup %.1fx over quiet" % (cached_time, plain_time / cached_time))
+print("  " + str(cache.stats()))
+
+
+def time_batch(workers):
+    start = time.perf_counter()
+    parsed, errors = transpiler_thing.parse.parse_formulas_batch(formulas_bin, workers=workers)
+    return parsed, errors, time.perf_counter() - start
+
+
+print("")
+print("batch parse, " + str(os.cpu_count()) + " cores")
+one_worker_time = None
+workers = 1
+while workers <= (os.cpu_count() or 1):
+    parsed, errors, elapsed = time_batch(workers)
+    if one_worker_time is None:
+        one_worker_time = elapsed
+    print("  %2d workers %10.3f s  speedup %.1fx  %d formulas  %d errors" % (workers, elapsed, one_worker_time / elapsed, len(parsed), errors.count()))
+    workers = workers * 2
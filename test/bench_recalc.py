@@ -0,0 +1,92 @@
+# one-cell edits on a generated model workbook with recalc.RecalcEngine,
+# against working out the whole module again with calculate(). The edits
+# are to any number cell. The values after all the edits have to be the
+# same either way. Then the empty cells in a summed range have to be
+# refused by set_input, while a cell in it with a value and an empty
+# cell a formula names directly can be set.
+# run from this folder: python bench_recalc.py [formulas per sheet] [edits]
+
+import os
+import random
+import sys
+import time
+
+sys.path.append("../../")
+
+import transpiler_thing.pipeline
+import transpiler_thing.recalc
+import transpiler_thing.scenarios
+
+from synthetic_workbook import make_model_workbook
+
+
+nformulas = 5000
+if len(sys.argv) > 1:
+    nformulas = int(sys.argv[1])
+
+nedits = 50
+if len(sys.argv) > 2:
+    nedits = int(sys.argv[2])
+
+os.makedirs("workspace", exist_ok=True)
+input_excel = os.path.join("workspace", "bench_recalc.xlsx")
+make_model_workbook(input_excel, nsheets=4, formulas=nformulas, fill_down=1000, depth=5, gaps=20)
+
+build = transpiler_thing.pipeline.build(input_excel, "workspace", backend="xml", report_every=0, code_file="bench_recalc_code.py")
+program_info = build["program_info"]
+graph = build["graph"]
+
+engine_module = transpiler_thing.scenarios.load_module(build["code_path"])
+full_module = transpiler_thing.scenarios.load_module(build["code_path"])
+
+start = time.perf_counter()
+engine = transpiler_thing.recalc.RecalcEngine(engine_module, program_info, graph)
+first_time = time.perf_counter() - start
+
+inputs = [key for key in program_info.program_constants if type(program_info.program_constants[key]) in (int, float)]
+random.seed(1)
+edit_times = []
+full_times = []
+counts = []
+for i in range(0, nedits):
+    sheet, cell = random.choice(inputs)
+    value = random.uniform(-10, 10)
+
+    start = time.perf_counter()
+    engine.set_input(sheet, cell, value)
+    counts.append(engine.recalculate())
+    edit_times.append(time.perf_counter() - start)
+
+    full_module.set_input(sheet, cell, value)
+    start = time.perf_counter()
+    expected = full_module.calculate()
+    full_times.append(time.perf_counter() - start)
+
+got = engine.get_values()
+differ = sum(1 for key in expected if repr(expected[key]) != repr(got[key]))
+
+refused = 0
+for row in range(2, 41, 2):
+    try:
+        engine.set_input("Gaps", "A" + str(row), 1.0)
+    except Exception:
+        refused = refused + 1
+if refused != 20:
+    raise Exception("set_input took " + str(20 - refused) + " empty cells in the summed range")
+
+for cell, value in (("A1", 5.0), ("C1", 3.0)):
+    engine.set_input("Gaps", cell, value)
+    full_module.set_input("Gaps", cell, value)
+engine.recalculate()
+if repr(engine.get_value("Gaps", "B2")) != repr(full_module.calculate()[("Gaps", "B2")]):
+    raise Exception("Gaps!B2 is " + repr(engine.get_value("Gaps", "B2")) + " after setting the cells it reads")
+
+edit_times.sort()
+counts.sort()
+print("%d formulas, %d number cells, first calculate %.3f s" % (len(expected), len(inputs), first_time))
+print("%d one-cell edits:" % nedits)
+print("  recalc  median %8.3f ms  max %8.3f ms  formulas recalculated median %d max %d" % (
+    edit_times[len(edit_times) // 2] * 1000, edit_times[-1] * 1000, counts[len(counts) // 2], counts[-1]))
+print("  full    median %8.3f ms" % (sorted(full_times)[len(full_times) // 2] * 1000))
+print("%d values differ" % differ)
+print("%d empty cells in a summed range refused" % refused)
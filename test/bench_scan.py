@@ -0,0 +1,71 @@
+
+# compares the scan_excel backends on a sparse synthetic workbook whose
+# used range runs to row 1,000,000, and on the test workbook, then the
+# worker count of the parallel scan on a workbook with many sheets.
+# run from this folder: python bench_scan.py [max_row] [nsheets]
+
+import os 
+import sys 
+import time 
+
+sys.path.append("../../")
+
+import transpiler_thing.gen
+
+from synthetic_workbook import make_sparse_workbook, make_many_sheet_workbook
+
+
+def time_scan(input_excel, **kwargs):
+    start = time.perf_counter()
+    result = transpiler_thing.gen.scan_excel(input_excel, **kwargs)
+    elapsed = time.perf_counter() - start
+    return result, elapsed
+
+
+max_row = 1000000
+if len(sys.argv) > 1:
+    max_row = int(sys.argv[1])
+
+nsheets = 40
+if len(sys.argv) > 2:
+    nsheets = int(sys.argv[2])
+
+os.makedirs("workspace", exist_ok=True)
+sparse_excel = os.path.join("workspace", "bench_sparse.xlsx")
+make_sparse_workbook(sparse_excel, max_row=max_row)
+
+backends = [
+    ("openpyxl", dict(backend="openpyxl")),
+    ("openpyxl streaming", dict(backend="openpyxl", streaming=True, report_every=0)),
+    ("xml", dict(backend="xml", report_every=0)),
+]
+
+for input_excel in ["simple_formula_testing.xlsx", sparse_excel]:
+    print("")
+    print(input_excel)
+    baseline = None
+    for label, kwargs in backends:
+        result, elapsed = time_scan(input_excel, **kwargs)
+        if baseline is None:
+            baseline = result
+        same = result.formulas == baseline.formulas and result.const == baseline.const
+        print("  %-20s %10.3f s  same results: %s" % (label, elapsed, same))
+
+
+many_excel = os.path.join("workspace", "bench_many_sheets.xlsx")
+make_many_sheet_workbook(many_excel, nsheets=nsheets)
+
+worker_counts = [1]
+while worker_counts[-1] * 2 <= (os.cpu_count() or 1):
+    worker_counts.append(worker_counts[-1] * 2)
+
+for backend in ["openpyxl", "xml"]:
+    print("")
+    print(many_excel + " (" + str(nsheets) + " sheets, " + backend + ")")
+    baseline = None
+    for workers in worker_counts:
+        result, elapsed = time_scan(many_excel, backend=backend, workers=workers, streaming=True, report_every=0)
+        if baseline is None:
+            baseline = (result, elapsed)
+        same = result.assigned_indexes == baseline[0].assigned_indexes and result.const_indexes == baseline[0].const_indexes
+        print("  %2d workers %10.3f s  speedup %5.2fx  same ids: %s" % (workers, elapsed, baseline[1] / elapsed, same))
@@ -0,0 +1,107 @@
+# scenarios/sec of scenarios.ScenarioRunner on a generated model workbook:
+# a Monte Carlo run over some of its input cells with 1, 2, 4 ... worker
+# processes (the results have to come out the same), then a sweep over a
+# table of scenarios checked against working out a few of them one at a
+# time with the straight line module.
+# run from this folder: python bench_scenarios.py [scenarios] [formulas per sheet]
+
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append("../../")
+
+import transpiler_thing.pipeline
+import transpiler_thing.numpy_backend
+import transpiler_thing.straight_line
+import transpiler_thing.scenarios
+from transpiler_thing.ast_to_python import ProgramInfo
+
+from synthetic_workbook import make_model_workbook
+
+
+nscenarios = 200000
+if len(sys.argv) > 1:
+    nscenarios = int(sys.argv[1])
+
+nformulas = 500
+if len(sys.argv) > 2:
+    nformulas = int(sys.argv[2])
+
+os.makedirs("workspace", exist_ok=True)
+input_excel = os.path.join("workspace", "bench_scenarios.xlsx")
+make_model_workbook(input_excel, nsheets=2, formulas=nformulas, fill_down=200, depth=5)
+
+build = transpiler_thing.pipeline.build(input_excel, "workspace", backend="xml", report_every=0)
+constants = build["program_info"].program_constants
+graph = build["graph"]
+
+
+def program_info():
+    info = ProgramInfo()
+    for key in constants:
+        info.define_const(key[0], key[1], constants[key])
+    return info
+
+
+numpy_path = os.path.join("workspace", "bench_scenarios_numpy.py")
+with open(numpy_path, "w") as fp:
+    fp.write(transpiler_thing.numpy_backend.generate_numpy_module(build["formulas"], program_info(), graph))
+straight_path = os.path.join("workspace", "bench_scenarios_straight.py")
+with open(straight_path, "w") as fp:
+    fp.write(transpiler_thing.straight_line.generate_straight_module(build["formulas"], program_info(), graph))
+
+# the number inputs the formulas read, and the formulas nothing reads
+inputs = [graph.get_key(node) for node in graph.get_inputs() if type(constants.get(graph.get_key(node))) in (int, float)][:8]
+outputs = [graph.get_key(node) for node in graph.get_outputs()][:8]
+distributions = dict((key, ("normal", constants[key], abs(constants[key]) * 0.1 + 0.1)) for key in inputs)
+print("%d scenarios, %d inputs, %d outputs" % (nscenarios, len(inputs), len(outputs)))
+
+
+worker_counts = [1]
+while worker_counts[-1] * 2 <= (os.cpu_count() or 1):
+    worker_counts.append(worker_counts[-1] * 2)
+
+print("")
+print("monte carlo")
+first = None
+for workers in worker_counts:
+    out_dir = os.path.join("workspace", "bench_mc_" + str(workers))
+    runner = transpiler_thing.scenarios.ScenarioRunner(numpy_path, outputs)
+    stats = runner.run_distributions(distributions, nscenarios, out_dir, seed=1, workers=workers)
+    results = transpiler_thing.scenarios.open_results(out_dir)
+    if first is None:
+        first = dict((key, np.array(results[key])) for key in results)
+    same = all(np.array_equal(first[key], results[key], equal_nan=True) for key in first)
+    print("  %2d workers %10.3f s %12.0f scenarios/s  chunk %d  same results: %s" % (
+        workers, stats["seconds"], stats["scenarios_per_sec"], runner.get_chunk_size(), same))
+
+
+print("")
+print("sweep")
+rng = np.random.default_rng(2)
+table = dict((key, rng.uniform(-2, 2, nscenarios) * constants[key]) for key in inputs)
+out_dir = os.path.join("workspace", "bench_sweep")
+runner = transpiler_thing.scenarios.ScenarioRunner(numpy_path, outputs)
+stats = runner.run_table(table, out_dir)
+results = transpiler_thing.scenarios.open_results(out_dir)
+
+straight = transpiler_thing.scenarios.load_module(straight_path)
+checked = 0
+wrong = 0
+start = time.perf_counter()
+for i in range(0, min(20, nscenarios)):
+    for key in inputs:
+        straight.set_input(key[0], key[1], float(table[key][i]))
+    for key in outputs:
+        expected = transpiler_thing.numpy_backend.numbers(straight.get_value(key[0], key[1]))
+        got = results[key][i]
+        if not ((math.isnan(expected) and math.isnan(got)) or math.isclose(expected, got, rel_tol=1e-9, abs_tol=1e-12)):
+            wrong = wrong + 1
+        checked = checked + 1
+one_at_a_time = min(20, nscenarios) / (time.perf_counter() - start)
+print("  %10.3f s %12.0f scenarios/s, one at a time %.0f scenarios/s, %d of %d checked values differ" % (
+    stats["seconds"], stats["scenarios_per_sec"], one_at_a_time, wrong, checked))
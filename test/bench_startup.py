@@ -0,0 +1,62 @@
+# import time of the parts of the package a short lived worker needs, each
+# in a fresh python process: the runtime generated code imports, the
+# parser, the code generator and the module cache. None of them may pull
+# in openpyxl, lexit, numpy or process pools, those are only imported when
+# a workbook is scanned with openpyxl, the numpy backend is used and so
+# on. Stops with an exception when one does, or when an import takes more
+# than the budget (milliseconds, the median of the runs) if one is given.
+# run from this folder: python bench_startup.py [runs] [budget ms]
+
+import subprocess
+import sys
+
+
+runs = 5
+if len(sys.argv) > 1:
+    runs = int(sys.argv[1])
+
+budget = None
+if len(sys.argv) > 2:
+    budget = float(sys.argv[2])
+
+HEAVY = ["openpyxl", "lexit", "numpy", "concurrent.futures"]
+
+MODULES = [
+    "transpiler_thing.runtime",
+    "transpiler_thing.parse",
+    "transpiler_thing.ast_to_python",
+    "transpiler_thing.module_cache",
+    "transpiler_thing.gen",
+]
+
+CHILD = """
+import sys
+import time
+sys.path.append("../../")
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(seconds)
+print(" ".join(name for name in %r if name in sys.modules))
+"""
+
+
+def import_once(module):
+    out = subprocess.run([sys.executable, "-c", CHILD % (module, HEAVY)], capture_output=True, text=True, check=True).stdout
+    lines = out.split("\n")
+    return float(lines[0]), lines[1].split()
+
+
+print("%-34s %10s %10s" % ("module", "median ms", "min ms"))
+for module in MODULES:
+    times = []
+    for i in range(0, runs):
+        seconds, heavy = import_once(module)
+        if len(heavy) > 0:
+            raise Exception("importing " + module + " imports " + ", ".join(heavy))
+        times.append(seconds * 1000)
+    times.sort()
+    median = times[len(times) // 2]
+    print("%-34s %10.1f %10.1f" % (module, median, times[0]))
+    if budget is not None and median > budget:
+        raise Exception("importing " + module + " takes " + ("%.1f" % median) + " ms, more than " + str(budget) + " ms")
@@ -0,0 +1,190 @@
+
+# benchmark of the whole pipeline on a generated workbook: scan_excel,
+# dumping the formulas csv, parse_formulas_csv, code generation, and
+# the generated module (compiling it, then calculate() on every formula),
+# the same for the straight line module from straight_line.py, and the
+# calculation by interpreter.py for comparison. Each stage is run --repeat times and the best time is kept,
+# the report has the same lines every run so releases can be compared.
+# The workbook has a sheet with a --chain terms long formula too, which
+# has to compile and come out the same as the interpreter like the rest.
+# Runs offline, the workbook is written by synthetic_workbook.py.
+# run from this folder: python benchmark.py [--sheets 4] [--formulas 2000] ...
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append("../../")
+
+import transpiler_thing.gen
+import transpiler_thing.parse
+import transpiler_thing.parse_cache
+import transpiler_thing.ast_to_python
+import transpiler_thing.interpreter
+import transpiler_thing.straight_line
+import transpiler_thing.refs
+
+from synthetic_workbook import make_model_workbook
+
+
+parser = argparse.ArgumentParser(description="scan / parse / codegen / eval benchmark")
+parser.add_argument("--sheets", type=int, default=4)
+parser.add_argument("--formulas", type=int, default=2000, help="formulas per sheet")
+parser.add_argument("--fill-down", type=int, default=500, help="rows each formula column is filled down")
+parser.add_argument("--depth", type=int, default=4, help="nesting depth of the formulas")
+parser.add_argument("--range-size", type=int, default=10, help="rows in the SUM ranges")
+parser.add_argument("--names", type=int, default=4, help="defined names")
+parser.add_argument("--no-shared", action="store_true", help="a formula in every cell instead of shared formulas")
+parser.add_argument("--chain", type=int, default=1500, help="terms in the long chain formulas (=A1+A2-A3+...), 0 for none")
+parser.add_argument("--backend", default="xml", help="scan_excel backend")
+parser.add_argument("--no-cache", action="store_true", help="parse without the parse cache")
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--json", default=None, help="also write the results to this file")
+args = parser.parse_args()
+
+
+os.makedirs("workspace", exist_ok=True)
+input_excel = os.path.join("workspace", "benchmark.xlsx")
+
+start = time.perf_counter()
+make_model_workbook(input_excel, nsheets=args.sheets, formulas=args.formulas, fill_down=args.fill_down,
+                    depth=args.depth, range_size=args.range_size, defined_names=args.names, shared=not args.no_shared,
+                    chain=args.chain)
+generate_time = time.perf_counter() - start
+
+
+def best_of(fn):
+    best = None
+    result = None
+    for i in range(0, args.repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def scan():
+    return transpiler_thing.gen.scan_excel(input_excel, backend=args.backend, report_every=0)
+
+
+def dump():
+    transpiler_thing.gen.dump_scanned_formulas(scan_r, "workspace")
+    transpiler_thing.gen.dump_scanned_constants(scan_r, "workspace")
+
+
+def parse():
+    cache = None if args.no_cache else transpiler_thing.parse_cache.FormulaParseCache()
+    return transpiler_thing.parse.parse_formulas_csv(os.path.join("workspace", "excel_formulas.csv"), cache=cache)
+
+
+def new_program_info():
+    program_info = transpiler_thing.ast_to_python.ProgramInfo()
+    for scope in scan_r.const:
+        for nm in scan_r.const[scope]:
+            program_info.define_const(scope, nm, scan_r.const[scope][nm])
+    return program_info
+
+
+def codegen():
+    return transpiler_thing.ast_to_python.generate_module(formulas_parsed, new_program_info())
+
+
+def straight_codegen():
+    return transpiler_thing.straight_line.generate_straight_module(formulas_parsed, new_program_info())
+
+
+def compile_module():
+    namespace = dict()
+    exec(compile(code, "benchmark_code.py", "exec"), namespace)
+    return namespace
+
+
+def compile_straight():
+    namespace = dict()
+    exec(compile(straight_code, "benchmark_straight.py", "exec"), namespace)
+    return namespace
+
+
+def evaluate():
+    return namespace["calculate"]()
+
+
+def evaluate_straight():
+    return straight_namespace["calculate"]()
+
+
+def interpret():
+    interpreter = transpiler_thing.interpreter.FormulaInterpreter(formulas_parsed, new_program_info())
+    start = time.perf_counter()
+    results = interpreter.calculate()
+    return results, time.perf_counter() - start
+
+
+scan_r, scan_time = best_of(scan)
+ncells = sum(len(scan_r.formulas[s]) for s in scan_r.formulas) + sum(len(scan_r.const[s]) for s in scan_r.const)
+nil, dump_time = best_of(dump)
+formulas_parsed, parse_time = best_of(parse)
+code, codegen_time = best_of(codegen)
+with open(os.path.join("workspace", "benchmark_code.py"), "w") as fp:
+    fp.write(code)
+namespace, compile_time = best_of(compile_module)
+results, eval_time = best_of(evaluate)
+straight_code, straight_codegen_time = best_of(straight_codegen)
+straight_namespace, straight_compile_time = best_of(compile_straight)
+straight_results, straight_eval_time = best_of(evaluate_straight)
+interpreted = None
+interp_time = None
+for i in range(0, args.repeat):
+    interpreted, seconds = interpret()
+    if interp_time is None or seconds < interp_time:
+        interp_time = seconds
+mismatches = [key for key in results if repr(results[key]) != repr(interpreted[key]) or repr(results[key]) != repr(straight_results[key])]
+
+nformulas = len(formulas_parsed)
+# a shared formula is one entry for its whole range
+ncovered = 0
+for formula_obj in formulas_parsed:
+    if formula_obj["ref"] is None:
+        ncovered = ncovered + 1
+    else:
+        c1, r1, c2, r2 = transpiler_thing.refs.parse_range(formula_obj["ref"])
+        ncovered = ncovered + (c2 - c1 + 1) * (r2 - r1 + 1)
+stages = [
+    ("scan_excel", scan_time, ncells, "cells"),
+    ("dump csv", dump_time, ncells, "cells"),
+    ("parse_formulas_csv", parse_time, nformulas, "formulas"),
+    ("codegen", codegen_time, nformulas, "formulas"),
+    ("compile", compile_time, ncovered, "cells"),
+    ("calculate", eval_time, ncovered, "cells"),
+    ("straight codegen", straight_codegen_time, nformulas, "formulas"),
+    ("straight compile", straight_compile_time, ncovered, "cells"),
+    ("straight calculate", straight_eval_time, ncovered, "cells"),
+    ("interpret", interp_time, ncovered, "cells"),
+]
+
+print("")
+print("workbook: sheets=%d formulas/sheet=%d fill_down=%d depth=%d range_size=%d names=%d shared=%s chain=%d" % (
+    args.sheets, args.formulas, args.fill_down, args.depth, args.range_size, args.names, not args.no_shared, args.chain))
+print("%d formula entries covering %d cells" % (nformulas, ncovered))
+print("generated in %.3f s, best of %d runs, backend=%s cache=%s" % (generate_time, args.repeat, args.backend, not args.no_cache))
+print("%-20s %10s %10s %14s" % ("stage", "seconds", "items", "items/s"))
+for name, seconds, items, unit in stages:
+    print("%-20s %10.4f %10d %14.0f %s" % (name, seconds, items, items / seconds if seconds > 0 else 0.0, unit))
+print("calculate is %.1fx the interpreter, straight calculate %.1fx, %d results differ" % (
+    interp_time / eval_time if eval_time > 0 else 0.0, interp_time / straight_eval_time if straight_eval_time > 0 else 0.0, len(mismatches)))
+
+if args.json is not None:
+    with open(args.json, "w") as fp:
+        json.dump({
+            "params" : vars(args),
+            "formula_entries" : nformulas,
+            "formula_cells" : ncovered,
+            "speedup_over_interpreter" : interp_time / eval_time if eval_time > 0 else 0.0,
+            "straight_speedup_over_interpreter" : interp_time / straight_eval_time if straight_eval_time > 0 else 0.0,
+            "mismatches" : len(mismatches),
+            "stages" : [{"stage" : name, "seconds" : seconds, "items" : items, "unit" : unit} for name, seconds, items, unit in stages],
+        }, fp, indent=2, sort_keys=True)
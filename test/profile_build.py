@@ -0,0 +1,24 @@
+
+# runs the whole build (scan, parse, codegen) on a workbook with profiling
+# on, prints the per phase report and writes it as json for comparing runs
+# run from this folder: python profile_build.py [workbook] [json path] [--memory]
+
+import sys
+
+sys.path.append("../../")
+
+import transpiler_thing.pipeline
+import transpiler_thing.profiling
+
+
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+input_excel = args[0] if len(args) > 0 else "simple_formula_testing.xlsx"
+json_path = args[1] if len(args) > 1 else "workspace/profile.json"
+
+profile = transpiler_thing.profiling.PipelineProfile(trace_memory="--memory" in sys.argv)
+with profile:
+    transpiler_thing.pipeline.build(input_excel, "workspace", code_file="profile_code.py")
+
+profile.print_report()
+profile.write_json(json_path)
+print("wrote " + json_path)
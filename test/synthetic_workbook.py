@@ -0,0 +1,320 @@
+
+# writes synthetic xlsx files for the benchmarks. The SpreadsheetML is
+# written directly with zipfile so generating a huge workbook is quick
+# and doesn't need anything installed
+
+import zipfile
+
+from xml.sax.saxutils import escape, quoteattr
+
+
+def col_letters(idx):
+    letters = ""
+    while idx > 0:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+
+# a cell of a shared formula block. The master cell carries the formula
+# text and the ref range, the other cells only the si
+class SharedFormula:
+
+    def __init__(self, si, formula=None, ref=None):
+        self.si = si
+        self.formula = formula
+        self.ref = ref
+
+
+
+def cell_xml(row, col, value):
+    ref = col_letters(col) + str(row)
+    if isinstance(value, SharedFormula):
+        if value.formula is None:
+            return '<c r="' + ref + '"><f t="shared" si="' + str(value.si) + '"/></c>'
+        return ('<c r="' + ref + '"><f t="shared" ref="' + value.ref + '" si="' + str(value.si) + '">'
+                + escape(value.formula[1:]) + '</f></c>')
+    elif isinstance(value, str) and value.startswith("="):
+        return '<c r="' + ref + '"><f>' + escape(value[1:]) + '</f></c>'
+    elif isinstance(value, bool):
+        return '<c r="' + ref + '" t="b"><v>' + ("1" if value else "0") + '</v></c>'
+    elif isinstance(value, (int, float)):
+        return '<c r="' + ref + '"><v>' + repr(value) + '</v></c>'
+    else:
+        return '<c r="' + ref + '" t="inlineStr"><is><t>' + escape(str(value)) + '</t></is></c>'
+
+
+
+# sheets is a list of (sheet name, cells, dimension) where cells is an
+# iterable of (row, col, value) sorted by row then column, and dimension
+# is the used range to claim (like "A1:Z1000000"), or None.
+# defined_names is a list of (name, localSheetId or None, text)
+def write_xlsx(path, sheets, defined_names=()):
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+
+        overrides = []
+        for i in range(1, len(sheets) + 1):
+            overrides.append('<Override PartName="/xl/worksheets/sheet' + str(i) + '.xml" '
+                             'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+
+        zf.writestr("[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            + "".join(overrides) +
+            '</Types>')
+
+        zf.writestr("_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>')
+
+        sheet_entries = []
+        rels = []
+        for i, (name, cells, dimension) in enumerate(sheets, start=1):
+            sheet_entries.append('<sheet name=' + quoteattr(name) + ' sheetId="' + str(i) + '" r:id="rId' + str(i) + '"/>')
+            rels.append('<Relationship Id="rId' + str(i) + '" '
+                        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                        'Target="worksheets/sheet' + str(i) + '.xml"/>')
+
+        names = []
+        for name, local_sheet_id, text in defined_names:
+            scope = '' if local_sheet_id is None else ' localSheetId="' + str(local_sheet_id) + '"'
+            names.append('<definedName name=' + quoteattr(name) + scope + '>' + escape(text) + '</definedName>')
+
+        zf.writestr("xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets>' + "".join(sheet_entries) + '</sheets>'
+            + ('<definedNames>' + "".join(names) + '</definedNames>' if names else '') +
+            '</workbook>')
+
+        zf.writestr("xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + "".join(rels) +
+            '</Relationships>')
+
+        for i, (name, cells, dimension) in enumerate(sheets, start=1):
+            with zf.open("xl/worksheets/sheet" + str(i) + ".xml", "w") as fp:
+                fp.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">')
+                if dimension is not None:
+                    fp.write(('<dimension ref="' + dimension + '"/>').encode("utf-8"))
+                fp.write(b'<sheetData>')
+
+                row_parts = []
+                current_row = None
+                for row, col, value in cells:
+                    if row != current_row:
+                        if current_row is not None:
+                            row_parts.append('</row>')
+                            fp.write("".join(row_parts).encode("utf-8"))
+                            row_parts = []
+                        row_parts.append('<row r="' + str(row) + '">')
+                        current_row = row
+                    row_parts.append(cell_xml(row, col, value))
+                if current_row is not None:
+                    row_parts.append('</row>')
+                    fp.write("".join(row_parts).encode("utf-8"))
+
+                fp.write(b'</sheetData></worksheet>')
+
+
+
+# a sheet whose used range claims max_row rows but only has a block of
+# inputs at the top and a column of formulas every `every` rows
+def sparse_sheet_cells(max_row, every=1000):
+    yield 1, 1, "inputs"
+    yield 2, 1, 1.5
+    yield 2, 2, 2
+    for row in range(every, max_row + 1, every):
+        yield row, 3, "=A2*B2+" + str(row)
+
+
+
+def make_sparse_workbook(path, max_row=1000000, every=1000, max_col=26):
+    dimension = "A1:" + col_letters(max_col) + str(max_row)
+    write_xlsx(path, [("Sparse", sparse_sheet_cells(max_row, every), dimension)],
+               defined_names=[("rate", None, "Sparse!$A$2"), ("local_rate", 0, "Sparse!$B$2")])
+
+
+
+# many independent sheets, each with a column of inputs and rows of
+# formulas referring to them
+def dense_sheet_cells(rows, cols):
+    for row in range(1, rows + 1):
+        yield row, 1, float(row)
+        for col in range(2, cols + 1):
+            yield row, col, "=A" + str(row) + "*" + str(col) + "+" + col_letters(col - 1) + str(row)
+
+
+
+def make_many_sheet_workbook(path, nsheets=40, rows=2000, cols=10):
+    sheets = []
+    for i in range(1, nsheets + 1):
+        sheets.append(("Sheet" + str(i), dense_sheet_cells(rows, cols), None))
+    write_xlsx(path, sheets)
+
+
+
+# inputs in column A and a formula filled down column B as a single
+# shared formula, the way Excel stores a fill-down
+def fill_down_cells(rows):
+    for row in range(1, rows + 1):
+        yield row, 1, float(row)
+        if row == 1:
+            yield row, 2, SharedFormula(0, "=A1*2+$A$1", "B1:B" + str(rows))
+        else:
+            yield row, 2, SharedFormula(0)
+
+
+
+def make_fill_down_workbook(path, rows=100000):
+    write_xlsx(path, [("FillDown", fill_down_cells(rows), None)])
+
+
+
+# a workbook shaped like a model, with everything the benchmarks vary:
+#   nsheets          sheets named Sheet1, Sheet2, ...
+#   formulas         formulas per sheet, in columns of fill_down rows
+#   fill_down        rows each formula column is filled down over
+#   depth            nesting depth of each formula (operators, IF, MAX)
+#   range_size       rows in the SUM ranges
+#   defined_names    names rate1, rate2, ... on inputs of the first sheet
+#   shared           store each column as one shared formula like Excel
+#                    does, or a separate formula in every cell
+#   chain            when more than 0, a sheet Chain with that many inputs
+#                    in column A, B1 adding and taking them all in one long
+#                    chain (=A1+A2-A3+...) and B2 the same chain in an IF
+#   gaps             when more than 0, a sheet Gaps with that many inputs
+#                    on every other row of column A, B1 summing them over
+#                    the empty cells in between and B2 reading empty C1
+#   edits            sheet name -> {(row, col) : value} of cells to put in
+#                    place of what is generated there, None to leave one
+#                    empty
+# Column A of each sheet holds the inputs. Each formula column refers to
+# the one before it, and the first one to the first formula column of the
+# previous sheet, so there are long chains of dependencies. Nothing is
+# random, the same arguments always give the same workbook
+def model_formula(sheet_idx, col, row, depth, range_size, defined_names):
+
+    prev_col = col_letters(col - 1)
+    window = "A" + str(row) + ":A" + str(row + range_size - 1)
+
+    leaves = ["A" + str(row)]
+    if col > 2:
+        leaves.append(prev_col + str(row))
+    elif sheet_idx > 1:
+        leaves.append("Sheet" + str(sheet_idx - 1) + "!B" + str(row))
+    if defined_names > 0:
+        leaves.append("rate" + str(1 + (col + sheet_idx) % defined_names))
+
+    def leaf(k):
+        return leaves[k % len(leaves)]
+
+    def nest(d):
+        if d <= 1:
+            return leaf(d + col)
+        pattern = (d + col) % 4
+        if pattern == 0:
+            return "(" + nest(d - 1) + "+" + leaf(d) + ")"
+        elif pattern == 1:
+            return nest(d - 1) + "*" + str(d)
+        elif pattern == 2:
+            return "IF(" + leaf(d) + ">" + str(d) + "," + nest(d - 1) + "," + leaf(d + 1) + ")"
+        else:
+            return "MAX(" + nest(d - 1) + ",SUM(" + window + "))"
+
+    return "=" + nest(depth)
+
+
+
+def model_sheet_cells(sheet_idx, formulas, fill_down, depth, range_size, defined_names, shared):
+    ncols = max(1, (formulas + fill_down - 1) // fill_down)
+    ninputs = fill_down + range_size
+    for row in range(1, ninputs + 1):
+        yield row, 1, float(row % 97) + 0.5
+        if row > fill_down:
+            continue
+        for k in range(0, ncols):
+            col = k + 2
+            if k * fill_down + row > formulas:
+                break
+            if not shared:
+                yield row, col, model_formula(sheet_idx, col, row, depth, range_size, defined_names)
+            elif row == 1:
+                ref = col_letters(col) + "1:" + col_letters(col) + str(min(fill_down, formulas - k * fill_down))
+                yield row, col, SharedFormula(k, model_formula(sheet_idx, col, row, depth, range_size, defined_names), ref)
+            else:
+                yield row, col, SharedFormula(k)
+
+
+
+def chain_sheet_cells(chain):
+    terms = "A1"
+    for row in range(2, chain + 1):
+        terms = terms + ("-" if row % 3 == 0 else "+") + "A" + str(row)
+    for row in range(1, chain + 1):
+        yield row, 1, float(row % 89) + 0.25
+        if row == 1:
+            yield row, 2, "=" + terms
+        elif row == 2:
+            yield row, 2, "=IF(A1>0," + terms + ",0)"
+
+
+
+# column A with every other cell empty, summed in B1, and C1 empty but
+# read directly by B2
+def gaps_sheet_cells(gaps):
+    for row in range(1, 2 * gaps + 1):
+        if row % 2 == 1:
+            yield row, 1, float(row % 89) + 0.75
+        if row == 1:
+            yield row, 2, "=SUM(A1:A" + str(2 * gaps) + ")"
+        elif row == 2:
+            yield row, 2, "=C1*2+B1"
+
+
+
+# cells with the ones in edits ((row, col) -> value) put in, in place of
+# a cell that is there or in between the others
+def edited_cells(cells, edits):
+    pending = sorted(edits.items())
+    i = 0
+    for row, col, value in cells:
+        while i < len(pending) and pending[i][0] < (row, col):
+            if pending[i][1] is not None:
+                yield pending[i][0][0], pending[i][0][1], pending[i][1]
+            i = i + 1
+        if i < len(pending) and pending[i][0] == (row, col):
+            value = pending[i][1]
+            i = i + 1
+        if value is not None:
+            yield row, col, value
+    for (row, col), value in pending[i:]:
+        if value is not None:
+            yield row, col, value
+
+
+
+def make_model_workbook(path, nsheets=4, formulas=2000, fill_down=500, depth=4, range_size=10, defined_names=4, shared=True, chain=0, gaps=0,
+                        edits=None):
+    sheets = []
+    for i in range(1, nsheets + 1):
+        cells = model_sheet_cells(i, formulas, fill_down, depth, range_size, defined_names, shared)
+        if edits is not None and ("Sheet" + str(i)) in edits:
+            cells = edited_cells(cells, edits["Sheet" + str(i)])
+        sheets.append(("Sheet" + str(i), cells, None))
+    if chain > 0:
+        sheets.append(("Chain", chain_sheet_cells(chain), None))
+    if gaps > 0:
+        sheets.append(("Gaps", gaps_sheet_cells(gaps), None))
+    names = [("rate" + str(k), None, "Sheet1!$A$" + str(k)) for k in range(1, defined_names + 1)]
+    write_xlsx(path, sheets, defined_names=names)
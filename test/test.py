@@ -1,4 +1,5 @@
 
+import os 
 import sys 
 import csv 
 import traceback 
@@ -12,44 +13,314 @@ sys.path.append("../../")
 import transpiler_thing.gen
 import transpiler_thing.parse 
 import transpiler_thing.ast_to_python
+import transpiler_thing.intermediate
+import transpiler_thing.diagnostics
+import transpiler_thing.graph
+
+# print every formula and its AST as it is parsed, batch runs leave this 
+# at the default (errors only) 
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.TRACE)
 
 input_excel = "simple_formula_testing.xlsx"
 
 result = transpiler_thing.gen.scan_excel(input_excel)
+transpiler_thing.gen.dump_scanned_formulas_bin(result, "workspace")
+transpiler_thing.gen.dump_scanned_constants_bin(result, "workspace")
+
+# csv versions of the same thing, for looking at 
 transpiler_thing.gen.dump_scanned_formulas(result, "workspace")
 transpiler_thing.gen.dump_scanned_constants(result, "workspace")
 
 
-# what to determine 
-# 1. build graph of references 
-# 2. find the leaves 
+# the xml backend and streaming openpyxl have to scan the same formulas
+# and values, date cells as the serial number that is in the xlsx
+for title, other in (("xml", transpiler_thing.gen.scan_excel(input_excel, backend="xml", report_every=0)),
+                      ("streaming", transpiler_thing.gen.scan_excel(input_excel, streaming=True, report_every=0))):
+    for scope in result.const:
+        for nm in result.const[scope]:
+            if repr(result.const[scope][nm]) != repr(other.const.get(scope, {}).get(nm)):
+                print(title + " scan gives " + scope + "!" + nm + " = " + repr(other.const.get(scope, {}).get(nm)) + " not " + repr(result.const[scope][nm]))
+    if other.const != result.const or other.formulas != result.formulas:
+        print(title + " scan doesn't give the same cells")
+print("date cells: Sheet1!A12 = " + repr(result.const["Sheet1"]["A12"]) + ", Sheet1!A13 = " + repr(result.const["Sheet1"]["A13"]))
+
 
+# a name can start with a backslash, the A1 in \A1 is not a reference. It
+# has to stay put when a formula is shifted, and the parse cache can't
+# give =\A2+1 the AST it made for =\A1+1 one row up
+import transpiler_thing.refs
+import transpiler_thing.parse_cache
 
-formulas_csv = transpiler_thing.gen.dump_scanned_formulas_path("workspace")
-formulas_nodes = transpiler_thing.parse.parse_formulas_csv(formulas_csv)
-constants_csv = transpiler_thing.gen.dump_scanned_constants_path("workspace")
+print("shifted: " + transpiler_thing.refs.shift_formula("=\\A1+1+A1", 3, 2))
+parse_cache = transpiler_thing.parse_cache.FormulaParseCache()
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.ERROR)
+for formula, cell in (("=\\A1+1", "B2"), ("=\\A2+1", "B3"), ("=\\A1+A1", "B2"), ("=\\A1+A2", "B3")):
+    cached_lines = []
+    transpiler_thing.parse.print_ast_nodes(parse_cache.parse(formula, "Sheet1", cell), cached_lines.append)
+    lines = []
+    transpiler_thing.parse.print_ast_nodes(transpiler_thing.parse.excel_formula_to_IR(formula, in_sheet="Sheet1"), lines.append)
+    if cached_lines != lines:
+        print("parse cache gives " + formula + " in " + cell + " as " + repr(cached_lines) + " not " + repr(lines))
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.TRACE)
+
+
+formulas_bin = transpiler_thing.gen.dump_scanned_formulas_bin_path("workspace")
+formulas_nodes = transpiler_thing.parse.parse_formulas_bin(formulas_bin)
+constants_bin = transpiler_thing.gen.dump_scanned_constants_bin_path("workspace")
 
 programInfo = transpiler_thing.ast_to_python.ProgramInfo()
 
-with open(constants_csv, "r") as cfp:
-    drdr = csv.DictReader(cfp)
-    for rw in drdr:
+with transpiler_thing.intermediate.IntermediateFile(constants_bin) as constants:
+    for rw in constants:
         _id = rw["const_id"] 
         sheet = rw["sheet"]
         name = rw["cell_or_name"]
-        val = rw["value"]
-        # parse the value as a string or a number?
+        val = rw["value"]  # already a number, string, bool, etc 
         
         programInfo.define_const(sheet, name, val)
 
 
+# graph of references, the leaves (inputs) and the order to evaluate in 
+graph = transpiler_thing.graph.build_dependency_graph(formulas_nodes, programInfo)
+graph.print_summary()
+print("inputs: " + ", ".join(graph.describe(node) for node in graph.get_inputs()))
+order, blocked = graph.topological_order()
+print("evaluation order: " + ", ".join(graph.describe(node) for node in order if graph.get_kind(node) == transpiler_thing.graph.FORMULA))
+
+
 with open("code.py", "w") as codefp:
-    
-    for formula_obj in formulas_nodes:
-        programInfo.set_func_name_for(formula_obj["sheet"], formula_obj["name"], "formula_" + str(formula_obj["formula_id"]))
+    codefp.write(transpiler_thing.ast_to_python.generate_module(formulas_nodes, programInfo, graph))
 
-    for formula_obj in formulas_nodes:
-        formula_code = transpiler_thing.ast_to_python.formula_to_python_function(formula_obj, programInfo)
-        codefp.write(formula_code)
-        codefp.write("\n")
-    
+
+# run the generated code, and check it against the interpreter 
+import importlib.util 
+import transpiler_thing.interpreter
+
+spec = importlib.util.spec_from_file_location("generated_code", "code.py")
+generated = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(generated)
+
+results = generated.calculate()
+interpreted = transpiler_thing.interpreter.FormulaInterpreter(formulas_nodes, programInfo, graph).calculate()
+for key in results:
+    print(str(key) + " = " + repr(results[key]))
+    if repr(results[key]) != repr(interpreted[key]):
+        print("  but the interpreter gives " + repr(interpreted[key]))
+
+
+# and the straight line version of the same module
+import transpiler_thing.straight_line
+import transpiler_thing.runtime
+import types
+
+with open("code_straight.py", "w") as codefp:
+    codefp.write(transpiler_thing.straight_line.generate_straight_module(formulas_nodes, programInfo, graph))
+
+spec = importlib.util.spec_from_file_location("generated_straight", "code_straight.py")
+straight = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(straight)
+
+straight_results = straight.calculate()
+for key in results:
+    if repr(results[key]) != repr(straight_results[key]):
+        print(str(key) + " straight line gives " + repr(straight_results[key]))
+
+# a part of a deep formula (see ast_to_python.MAX_DEPTH) that is only in
+# an IF branch that isn't taken must not be worked out, SQRT here counts
+# the times it is called
+deep_formula = "=IF(A1>0," + "ABS(" * 45 + "SQRT(A1)" + ")" * 45 + ",IFERROR(1," + "ABS(" * 45 + "SQRT(A1)" + ")" * 45 + "))"
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.ERROR)
+deep_formulas = [{"formula_id" : 1, "sheet" : "Sheet1", "name" : "B1", "formula" : deep_formula, "ref" : None,
+                  "parsed" : transpiler_thing.parse.excel_formula_to_IR(deep_formula, in_sheet="Sheet1")}]
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.TRACE)
+deep_info = transpiler_thing.ast_to_python.ProgramInfo()
+deep_info.define_const("Sheet1", "A1", 0)
+sqrt_calls = []
+sqrt = transpiler_thing.runtime.FUNCTIONS["SQRT"]
+transpiler_thing.runtime.FUNCTIONS["SQRT"] = lambda v: sqrt_calls.append(v) or sqrt(v)
+try:
+    deep_module = types.ModuleType("generated_deep")
+    exec(transpiler_thing.straight_line.generate_straight_module(deep_formulas, deep_info), deep_module.__dict__)
+    deep_result = deep_module.calculate()[("Sheet1", "B1")]
+finally:
+    transpiler_thing.runtime.FUNCTIONS["SQRT"] = sqrt
+if deep_result != 1 or len(sqrt_calls) > 0:
+    print("deep IF gives " + repr(deep_result) + " with SQRT called " + str(len(sqrt_calls)) + " times")
+
+
+# and the numpy version, with no arrays given it works out the same values
+import transpiler_thing.numpy_backend
+
+with open("code_numpy.py", "w") as codefp:
+    codefp.write(transpiler_thing.numpy_backend.generate_numpy_module(formulas_nodes, programInfo, graph))
+
+spec = importlib.util.spec_from_file_location("generated_numpy", "code_numpy.py")
+vectorized = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(vectorized)
+
+numpy_results = vectorized.calculate()
+for key in results:
+    if repr(results[key]) != repr(numpy_results[key]):
+        print(str(key) + " numpy backend gives " + repr(numpy_results[key]))
+
+# scenarios on that module: a table over Sheet1!A3, the outputs have to
+# be what the module gives for each row. A column for a cell that isn't an
+# input of the module is refused before anything runs
+import transpiler_thing.scenarios
+
+scenario_outputs = [key for key in results if key[0] == "Sheet1" and type(results[key]) in (int, float)][:3]
+runner = transpiler_thing.scenarios.ScenarioRunner("code_numpy.py", scenario_outputs, chunk_size=2)
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.ERROR)
+runner.run_table({("Sheet1", "A3") : [20.0, 21.0, 22.0]}, "workspace/scenarios")
+scenario_results = transpiler_thing.scenarios.open_results("workspace/scenarios")
+for row, value in enumerate([20.0, 21.0, 22.0]):
+    vectorized.set_input("Sheet1", "A3", value)
+    expected = vectorized.calculate()
+    for key in scenario_outputs:
+        if repr(float(scenario_results[key][row])) != repr(float(transpiler_thing.numpy_backend.numbers(expected[key]))):
+            print("scenario " + str(row) + " gives " + str(key) + " = " + repr(scenario_results[key][row]) + " not " + repr(expected[key]))
+vectorized.set_input("Sheet1", "A3", programInfo.program_constants[("Sheet1", "A3")])
+try:
+    runner.run_table({("Sheet1", "A3") : [1.0], ("Sheet1", "Z99") : [1.0]}, "workspace/scenarios")
+    print("scenario input Sheet1!Z99 was taken")
+except Exception as e:
+    print(str(e))
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.TRACE)
+
+# with B1 an array: a branch the scalar condition doesn't take isn't
+# worked out (it would raise, text can't change between scenarios), and
+# what overflows is an error
+import numpy
+
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.ERROR)
+array_formulas = []
+for i, formula in enumerate(["=IF(A1>0,B1&\"x\",B1)", "=IFERROR(B1+0,B1&\"x\")", "=B1+B1", "=B1*B1"]):
+    array_formulas.append({"formula_id" : i + 1, "sheet" : "Sheet1", "name" : "C" + str(i + 1), "formula" : formula, "ref" : None,
+                           "parsed" : transpiler_thing.parse.excel_formula_to_IR(formula, in_sheet="Sheet1")})
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.TRACE)
+array_info = transpiler_thing.ast_to_python.ProgramInfo()
+array_info.define_const("Sheet1", "A1", 0)
+array_info.define_const("Sheet1", "B1", 1)
+array_module = types.ModuleType("generated_numpy_arrays")
+exec(transpiler_thing.numpy_backend.generate_numpy_module(array_formulas, array_info), array_module.__dict__)
+array_module.set_input("Sheet1", "B1", numpy.array([1.0, 1e200, 1e308]))
+for key, value in sorted(array_module.calculate().items()):
+    print("numpy " + key[0] + "!" + key[1] + " = " + repr(value.tolist()))
+
+
+# what-if: change each number input by one and work out only what depends
+# on it, which has to match the interpreter working out everything
+import transpiler_thing.recalc
+
+engine = transpiler_thing.recalc.RecalcEngine(generated, programInfo, graph)
+what_if = transpiler_thing.interpreter.FormulaInterpreter(formulas_nodes, programInfo, graph)
+for node in graph.get_inputs():
+    sheet, cell = graph.get_key(node)
+    value = programInfo.program_constants.get((sheet, cell))
+    if type(value) not in (int, float):
+        continue
+    engine.set_input(sheet, cell, value + 1)
+    what_if.set_input(sheet, cell, value + 1)
+    print("what-if " + graph.describe(node) + " = " + repr(value + 1) + ": " + str(engine.recalculate()) + " formulas recalculated")
+    expected = what_if.calculate()
+    for key, v in engine.get_values().items():
+        if repr(v) != repr(expected[key]):
+            print("  " + str(key) + " = " + repr(v) + " but the interpreter gives " + repr(expected[key]))
+
+
+# the optimize.py passes with every constant cell kept as it is, folded
+# into the formulas. The module has to work out the same values
+import transpiler_thing.optimize
+
+optimizedInfo = transpiler_thing.ast_to_python.ProgramInfo()
+for key in programInfo.program_constants:
+    optimizedInfo.define_const(key[0], key[1], programInfo.program_constants[key])
+optimized_nodes, optimize_report = transpiler_thing.optimize.optimize_program(formulas_nodes, optimizedInfo, inputs=[])
+transpiler_thing.optimize.print_report(optimize_report)
+
+with open("code_optimized.py", "w") as codefp:
+    codefp.write(transpiler_thing.ast_to_python.generate_module(optimized_nodes, optimizedInfo))
+
+spec = importlib.util.spec_from_file_location("generated_optimized", "code_optimized.py")
+optimized = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(optimized)
+
+optimized_results = optimized.calculate()
+for key in results:
+    if repr(results[key]) != repr(optimized_results[key]):
+        print(str(key) + " optimized gives " + repr(optimized_results[key]))
+
+
+# an empty IF / IFERROR / IFNA branch is 0 like in Excel, and a function
+# with the wrong number of arguments is #VALUE! instead of raising. Every
+# way of working out the formulas has to agree
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.ERROR)
+odd_formulas = []
+for i, formula in enumerate(["=IF(TRUE,,1)", "=IF(FALSE,1,)", "=IFERROR(1/0,)", "=IFNA(NA(),)", "=SUM(1,,2)",
+                             "=ABS(1,2)", "=PI(1)", "=IF(TRUE,1,2,3)", "=IFERROR(1)"]):
+    odd_formulas.append({"formula_id" : i + 1, "sheet" : "Sheet1", "name" : "A" + str(i + 1), "formula" : formula, "ref" : None,
+                         "parsed" : transpiler_thing.parse.excel_formula_to_IR(formula, in_sheet="Sheet1")})
+odd_module = types.ModuleType("generated_odd")
+exec(transpiler_thing.ast_to_python.generate_module(odd_formulas, transpiler_thing.ast_to_python.ProgramInfo()), odd_module.__dict__)
+odd_results = odd_module.calculate()
+odd_straight = types.ModuleType("generated_odd_straight")
+exec(transpiler_thing.straight_line.generate_straight_module(odd_formulas, transpiler_thing.ast_to_python.ProgramInfo()), odd_straight.__dict__)
+odd_numpy = types.ModuleType("generated_odd_numpy")
+exec(transpiler_thing.numpy_backend.generate_numpy_module(odd_formulas, transpiler_thing.ast_to_python.ProgramInfo()), odd_numpy.__dict__)
+odd_info = transpiler_thing.ast_to_python.ProgramInfo()
+odd_folded = transpiler_thing.optimize.optimize_program(odd_formulas, odd_info, inputs=[])[0]
+odd_optimized = types.ModuleType("generated_odd_optimized")
+exec(transpiler_thing.ast_to_python.generate_module(odd_folded, odd_info), odd_optimized.__dict__)
+transpiler_thing.diagnostics.set_level(transpiler_thing.diagnostics.TRACE)
+odd_others = [("straight line", odd_straight.calculate()), ("numpy", odd_numpy.calculate()), ("optimized", odd_optimized.calculate()),
+              ("interpreter", transpiler_thing.interpreter.FormulaInterpreter(odd_formulas, transpiler_thing.ast_to_python.ProgramInfo()).calculate())]
+for formula_obj in odd_formulas:
+    key = ("Sheet1", formula_obj["name"])
+    print(formula_obj["formula"] + " = " + repr(odd_results[key]))
+    for title, other in odd_others:
+        if repr(other[key]) != repr(odd_results[key]):
+            print("  but " + title + " gives " + repr(other[key]))
+
+
+# the cone of a couple of the outputs, worked out from the formula text so
+# nothing else is parsed. Those cells have to come out the same
+import transpiler_thing.cone
+
+cone_outputs = [graph.get_key(node) for node in graph.get_outputs()][:2]
+with transpiler_thing.intermediate.IntermediateFile(formulas_bin) as rows:
+    cone = transpiler_thing.cone.FormulaCone(rows, cone_outputs)
+print("cone of " + ", ".join(str(key) for key in cone_outputs) + ": " + str(cone.stats()))
+cone_nodes = transpiler_thing.parse.parse_formula_rows(cone.get_rows())
+
+coneInfo = transpiler_thing.ast_to_python.ProgramInfo()
+for key in programInfo.program_constants:
+    if cone.has_constant(key[0], key[1]):
+        coneInfo.define_const(key[0], key[1], programInfo.program_constants[key])
+
+with open("code_cone.py", "w") as codefp:
+    codefp.write(transpiler_thing.ast_to_python.generate_module(cone_nodes, coneInfo))
+
+spec = importlib.util.spec_from_file_location("generated_cone", "code_cone.py")
+cone_module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cone_module)
+
+for key in cone_outputs:
+    if repr(results[key]) != repr(cone_module.get_value(key[0], key[1])):
+        print(str(key) + " cone gives " + repr(cone_module.get_value(key[0], key[1])))
+
+
+# the module cache: the first load builds and stores the module, the
+# second runs the stored bytecode. Both have to work out the same values
+import transpiler_thing.module_cache
+
+module_cache = transpiler_thing.module_cache.ModuleCache("workspace/module_cache")
+module_cache.prune(keep=[])
+for i in range(0, 2):
+    cached = module_cache.load_or_build(input_excel, "workspace", code_file="code_cached.py")
+    cached_results = cached.calculate()
+    for key in results:
+        if repr(results[key]) != repr(cached_results[key]):
+            print(str(key) + " cached module gives " + repr(cached_results[key]))
+print("module cache: " + str(module_cache.stats))
+if any(nm.startswith("build.") for nm in os.listdir("workspace")):
+    print("module cache left its build folder in the workspace")
@@ -0,0 +1,331 @@
+
+# reads formulas and constants straight out of the xlsx zip, without
+# going through openpyxl. Only the <c> elements that actually exist in
+# the sheet xml are looked at, so a sparse sheet whose used range runs
+# to the bottom of the sheet costs the same as a small one.
+
+import datetime
+import hashlib
+import posixpath
+import time
+import zipfile
+
+from xml.etree.ElementTree import iterparse
+
+from .refs import split_coordinate, parse_range, shift_formula
+from .runtime import excel_serial
+from . import diagnostics
+
+
+NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_DOC_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+OFFICE_DOCUMENT_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+
+# openpyxl moves these onto the sheet objects instead of keeping them as
+# defined names, so skip them to give the same results
+BOUND_RESERVED_NAMES = ("_xlnm.Print_Titles", "_xlnm.Print_Area")
+
+CELL_TAG = NS_MAIN + "c"
+ROW_TAG = NS_MAIN + "row"
+FORMULA_TAG = NS_MAIN + "f"
+VALUE_TAG = NS_MAIN + "v"
+INLINE_STR_TAG = NS_MAIN + "is"
+TEXT_TAG = NS_MAIN + "t"
+PHONETIC_TAG = NS_MAIN + "rPh"
+SHEET_DATA_TAG = NS_MAIN + "sheetData"
+
+
+
+class XlsxWorkbook:
+
+    def __init__(self, path):
+        self.path = path
+        self.zf = zipfile.ZipFile(path)
+        self.sheetnames = []
+        self.sheet_paths = dict()   # sheet name -> path in the zip, None for chart sheets
+        self.defined_names = []     # (name, localSheetId, text)
+        self.shared_strings = None  # loaded on first use
+        self.date1904 = False  # dates counted from 1904 instead of 1900
+
+        workbook_path = self._find_workbook_path()
+        self._read_workbook(workbook_path)
+
+
+    def close(self):
+        self.zf.close()
+
+
+    def _read_rels(self, rels_path):
+        rels = dict()
+        if rels_path not in self.zf.namelist():
+            return rels
+        with self.zf.open(rels_path) as fp:
+            for event, elem in iterparse(fp):
+                if elem.tag == NS_PKG_REL + "Relationship":
+                    rels[elem.get("Id")] = (elem.get("Type"), elem.get("Target"))
+        return rels
+
+
+    def _find_workbook_path(self):
+        for rel_type, target in self._read_rels("_rels/.rels").values():
+            if rel_type == OFFICE_DOCUMENT_REL:
+                return target.lstrip("/")
+        return "xl/workbook.xml"
+
+
+    def _read_workbook(self, workbook_path):
+        base = posixpath.dirname(workbook_path)
+        rels = self._read_rels(posixpath.join(base, "_rels", posixpath.basename(workbook_path) + ".rels"))
+
+        with self.zf.open(workbook_path) as fp:
+            for event, elem in iterparse(fp):
+                if elem.tag == NS_MAIN + "sheet":
+                    name = elem.get("name")
+                    rel = rels.get(elem.get(NS_DOC_REL + "id"))
+                    sheet_path = None
+                    if rel is not None and rel[0].endswith("/worksheet"):
+                        target = rel[1]
+                        if target.startswith("/"):
+                            sheet_path = target.lstrip("/")
+                        else:
+                            sheet_path = posixpath.normpath(posixpath.join(base, target))
+                    self.sheetnames.append(name)
+                    self.sheet_paths[name] = sheet_path
+
+                elif elem.tag == NS_MAIN + "workbookPr":
+                    self.date1904 = elem.get("date1904") in ("1", "true")
+
+                elif elem.tag == NS_MAIN + "definedName":
+                    name = elem.get("name")
+                    if name in BOUND_RESERVED_NAMES:
+                        continue
+                    local_sheet_id = elem.get("localSheetId")
+                    if local_sheet_id is not None:
+                        local_sheet_id = int(local_sheet_id)
+                    self.defined_names.append((name, local_sheet_id, elem.text or ""))
+
+        for rel_type, target in rels.values():
+            if rel_type.endswith("/sharedStrings"):
+                if target.startswith("/"):
+                    self.shared_strings_path = target.lstrip("/")
+                else:
+                    self.shared_strings_path = posixpath.normpath(posixpath.join(base, target))
+                break
+        else:
+            self.shared_strings_path = None
+
+
+    # sha256 of the raw bytes of a part of the zip, "" if there is no such part
+    def part_digest(self, part_path):
+        if part_path is None:
+            return ""
+        try:
+            self.zf.getinfo(part_path)
+        except KeyError:
+            return ""
+        h = hashlib.sha256()
+        with self.zf.open(part_path) as fp:
+            while True:
+                chunk = fp.read(1 << 20)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+
+
+    def _load_shared_strings(self):
+        self.shared_strings = []
+        if self.shared_strings_path is None:
+            return
+        with self.zf.open(self.shared_strings_path) as fp:
+            for event, elem in iterparse(fp):
+                if elem.tag == NS_MAIN + "si":
+                    self.shared_strings.append(rich_text(elem))
+                    elem.clear()
+
+
+    # yields ("formula" or "const", value, coordinate, sheet name) for
+    # each non empty cell, in the same form as gen.iter_excel_cells.
+    # With expand_shared, shared formulas are expanded to one formula per
+    # cell like openpyxl does. Otherwise each complete shared group comes
+    # out once, after the rest of the sheet, as
+    # ("shared", (master formula, ref), master coordinate, sheet name)
+    def iter_cells(self, sheet_name, report_every=100000, expand_shared=True):
+
+        sheet_path = self.sheet_paths[sheet_name]
+        if sheet_path is None:
+            return  # chart sheet, no cells
+
+        shared_masters = dict()  # si -> (formula, coordinate)
+        shared_groups = dict()   # si -> SharedGroup, only when not expanding
+
+        start = time.perf_counter()
+        nrows = 0
+        sheet_data = None
+
+        with self.zf.open(sheet_path) as fp:
+            for event, elem in iterparse(fp, events=("start", "end")):
+                tag = elem.tag
+
+                if event == "start":
+                    if tag == SHEET_DATA_TAG:
+                        sheet_data = elem
+                    continue
+
+                if tag == CELL_TAG:
+                    coordinate = elem.get("r")
+                    formula = elem.find(FORMULA_TAG)
+                    if not expand_shared and formula is not None and formula.get("t") == "shared":
+                        si = formula.get("si")
+                        if si in shared_groups:
+                            shared_groups[si].members.append(coordinate)
+                            continue
+                        elif formula.text is not None and formula.get("ref") is not None:
+                            shared_groups[si] = SharedGroup("=" + formula.text, coordinate, formula.get("ref"))
+                            continue
+
+                    kind, value = self._cell_value(elem, coordinate, shared_masters)
+                    if kind is not None:
+                        yield kind, value, coordinate, sheet_name
+
+                elif tag == ROW_TAG:
+                    nrows = nrows + 1
+                    # drop the finished rows so memory stays flat
+                    if sheet_data is not None:
+                        sheet_data.clear()
+                    if report_every and nrows % report_every == 0 and diagnostics.info_enabled:
+                        diagnostics.info("  " + sheet_name + ": " + str(nrows) + " rows, " + rows_per_sec(nrows, start) + " rows/sec")
+
+        for group in shared_groups.values():
+            if group.is_complete():
+                yield "shared", (group.formula, group.ref), group.master, sheet_name
+            else:
+                # some cells of the range were overwritten, fall back to per cell formulas
+                yield "formula", group.formula, group.master, sheet_name
+                for coordinate in group.members:
+                    yield "formula", translate_shared(group.formula, group.master, coordinate), coordinate, sheet_name
+
+        if report_every and diagnostics.info_enabled:
+            diagnostics.info("  " + sheet_name + ": " + str(nrows) + " rows total, " + rows_per_sec(nrows, start) + " rows/sec")
+
+
+    def _cell_value(self, elem, coordinate, shared_masters):
+
+        cell_type = elem.get("t", "n")
+        formula = elem.find(FORMULA_TAG)
+
+        if formula is not None:
+            value = "=" + (formula.text or "")
+            if formula.get("t") == "shared":
+                si = formula.get("si")
+                if si in shared_masters:
+                    master_value, master_coordinate = shared_masters[si]
+                    value = translate_shared(master_value, master_coordinate, coordinate)
+                elif value != "=":
+                    shared_masters[si] = (value, coordinate)
+            return "formula", value
+
+        if cell_type == "inlineStr":
+            inline = elem.find(INLINE_STR_TAG)
+            value = rich_text(inline) if inline is not None else None
+        else:
+            v = elem.find(VALUE_TAG)
+            if v is None or v.text is None:
+                return None, None
+            text = v.text
+            if cell_type == "s":
+                if self.shared_strings is None:
+                    self._load_shared_strings()
+                value = self.shared_strings[int(text)]
+            elif cell_type == "b":
+                value = bool(int(text))
+            elif cell_type == "n":
+                value = cast_number(text)
+            elif cell_type == "d":
+                value = iso_serial(text, self.date1904)
+            else:
+                value = text  # str and e (errors like #N/A) stay as text
+
+        if value is None or value == "":
+            return None, None
+        if isinstance(value, str) and value.startswith("="):
+            return "formula", value  # same as a text cell starting with = in openpyxl
+        return "const", value
+
+
+
+# a shared formula seen in the sheet, the master is the cell holding the
+# formula text and members are the other cells that point at it by si
+class SharedGroup:
+
+    def __init__(self, formula, master, ref):
+        self.formula = formula
+        self.master = master
+        self.ref = ref
+        self.members = []
+
+
+    # the group can only be kept as (formula, ref) when every cell of the
+    # ref range uses it and the master is the top left cell
+    def is_complete(self):
+        c1, r1, c2, r2 = parse_range(self.ref)
+        if split_coordinate(self.master) != (c1, r1):
+            return False
+        if len(self.members) + 1 != (c2 - c1 + 1) * (r2 - r1 + 1):
+            return False
+        for coordinate in self.members:
+            col, row = split_coordinate(coordinate)
+            if col < c1 or col > c2 or row < r1 or row > r2:
+                return False
+        return True
+
+
+
+# text of a <si> or <is> element, joining rich text runs and skipping
+# the phonetic guides
+def rich_text(elem):
+    parts = []
+    for child in elem:
+        if child.tag == TEXT_TAG:
+            parts.append(child.text or "")
+        elif child.tag == NS_MAIN + "r":
+            for t in child.iter(TEXT_TAG):
+                parts.append(t.text or "")
+    return "".join(parts)
+
+
+
+# a t="d" cell holds an ISO 8601 date, time or both. Dates are scanned as
+# the serial number Excel would have put in the cell instead (a date
+# formatted number cell already is one)
+def iso_serial(text, date1904=False):
+    try:
+        if "-" in text:
+            return excel_serial(datetime.datetime.fromisoformat(text.rstrip("Z")), date1904)
+        return excel_serial(datetime.time.fromisoformat(text), date1904)
+    except ValueError:
+        return text
+
+
+
+def cast_number(text):
+    if "." in text or "E" in text or "e" in text:
+        return float(text)
+    return int(text)
+
+
+
+def translate_shared(master_value, master_coordinate, coordinate):
+    mcol, mrow = split_coordinate(master_coordinate)
+    col, row = split_coordinate(coordinate)
+    return shift_formula(master_value, row - mrow, col - mcol)
+
+
+
+def rows_per_sec(nrows, start):
+    elapsed = time.perf_counter() - start
+    if elapsed <= 0:
+        return "-"
+    return str(round(nrows / elapsed, 1))